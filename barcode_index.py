@@ -0,0 +1,91 @@
+# バーコードから商品名を引くためのメモリ上のインデックス
+# 起動時に商品マスタ（product_master）のバーコードと商品名を読み込み、スキャンのたびにデータベースを検索しなくて済むようにする
+# main.py と main_ita_karioki.py の両方から使う
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from create_db import Product
+
+
+class BarcodeIndex:
+    def __init__(self, negative_ttl=60, max_negative_entries=10000):
+        self.negative_ttl = negative_ttl  # 見つからなかったバーコードを覚えておく秒数
+        self.max_negative_entries = max_negative_entries
+        self._names = {}  # バーコード -> 商品名
+        self._negative = OrderedDict()  # 見つからなかったバーコード -> 有効期限（古い順）
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    # 商品マスタからバーコードと商品名を全件読み込む
+    # 同じバーコードが複数ある場合は product_id が小さい商品を使う
+    def load(self, db):
+        names = {}
+        for barcode, product_name in db.execute(
+            select(Product.barcode_number, Product.product_name)
+            .where(Product.barcode_number.isnot(None))
+            .order_by(Product.product_id)
+        ):
+            names.setdefault(barcode, product_name)
+        with self._lock:
+            self._names = names
+            self._negative.clear()
+            self._loaded = True
+        return len(names)
+
+    # 商品を追加したときに呼ぶ（すでに登録されているバーコードは上書きしない）
+    def add(self, barcode, product_name):
+        with self._lock:
+            self._names.setdefault(barcode, product_name)
+            self._negative.pop(barcode, None)
+
+    # メモリ上で引けるバーコードを引く関数（{バーコード: 商品名または None}、未確認のバーコードは含まない）
+    def _lookup_cached(self, barcodes):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for barcode in barcodes:
+                if barcode in self._names:
+                    found[barcode] = self._names[barcode]
+                elif self._negative.get(barcode, 0) > now:
+                    found[barcode] = None
+        return found
+
+    # 複数のバーコードをまとめて引く関数（{バーコード: 商品名または None} を返す）
+    # メモリになく、見つからなかった記録もないバーコードだけを1回のクエリで検索する
+    # （他のワーカーで追加された商品を見つけるため）
+    def lookup_many(self, db, barcodes):
+        if not self._loaded:
+            self.load(db)
+
+        found = self._lookup_cached(barcodes)
+        unknown = list({barcode for barcode in barcodes if barcode not in found})
+        if unknown:
+            names = {}
+            for barcode, product_name in db.execute(
+                select(Product.barcode_number, Product.product_name)
+                .where(Product.barcode_number.in_(unknown))
+                .order_by(Product.product_id)
+            ):
+                names.setdefault(barcode, product_name)
+
+            expires_at = time.monotonic() + self.negative_ttl
+            with self._lock:
+                for barcode in unknown:
+                    if barcode in names:
+                        self._names.setdefault(barcode, names[barcode])
+                    else:
+                        # 見つからなかったバーコードを覚えておく（上限を超えたら古いものから削除）
+                        self._negative[barcode] = expires_at
+                        self._negative.move_to_end(barcode)
+                        while len(self._negative) > self.max_negative_entries:
+                            self._negative.popitem(last=False)
+            for barcode in unknown:
+                found[barcode] = names.get(barcode)
+        return found
+
+    # 1つのバーコードを引く関数（見つからなければ None）
+    def lookup(self, db, barcode):
+        return self.lookup_many(db, [barcode])[barcode]
@@ -18,7 +18,7 @@ class Product(Base):
     product_name = Column(String(255), nullable=False)
     product_category = Column(String(255))
     manufacturer_name = Column(String(255))
-    barcode_number = Column(VARCHAR(255))
+    barcode_number = Column(VARCHAR(255), index=True)  # バーコードでの検索用
     product_image_url = Column(VARCHAR(255))
 
 class InventoryProduct(Base):
@@ -76,6 +76,9 @@ def create_db():
     DATABASE_URL = os.getenv("DATABASE_URL")
     engine = create_engine(DATABASE_URL, echo=True)
     Base.metadata.create_all(engine)
+    # 既存の product_master テーブルにはバーコードのインデックスだけを作成する
+    for index in Product.__table__.indexes:
+        index.create(engine, checkfirst=True)
 
     return engine
 
@@ -0,0 +1,64 @@
+# 在庫の消費ペースと在庫切れまでの日数を予測するモジュール
+# 組織の全商品の日ごとの消費量を NumPy の配列（商品数 × 日数）にまとめ、1回の計算で全商品の予測を出す
+import numpy as np
+
+
+# 日ごとの消費量の配列（商品数 × 日数、古い日から順）を作る関数
+# rows: (商品ID, 日付, 数量) の並び。期間外や product_ids にない商品の行は無視する
+def build_daily_matrix(product_ids, rows, start_date, days):
+    matrix = np.zeros((len(product_ids), days))
+    index = {product_id: i for i, product_id in enumerate(product_ids)}
+    rows = [
+        (index[product_id], (day - start_date).days, quantity)
+        for product_id, day, quantity in rows
+        if product_id in index and 0 <= (day - start_date).days < days
+    ]
+    if rows:
+        product_index, day_index, quantities = (np.array(column) for column in zip(*rows))
+        np.add.at(matrix, (product_index, day_index), quantities)  # 同じ商品・日の行は合計する
+    return matrix
+
+
+# 全商品の消費ペース・在庫切れまでの日数・発注の提案をまとめて計算する関数
+# stock: 現在の在庫数（商品数）、consumption: 日ごとの消費量（商品数 × 日数、古い日から順）
+# 消費ペースは直近ほど重く見る指数加重平均（half_life 日で重みが半分になる）
+# 発注点 = 消費ペース × 納品までの日数 + 安全在庫（消費量のばらつきから計算）
+# 在庫が発注点以下になったら、納品までの日数 + target_days 日分になるように発注数を提案する
+# 在庫切れまでの日数が max_days を超える場合は予測できないものとして inf にする
+# （古い消費しかない商品は消費ペースがほぼ 0 になり、日数が極端に大きくなるため）
+def forecast_inventory(stock, consumption, short_window=7, half_life=7.0, lead_time_days=3, target_days=14, service_z=1.65, max_days=365):
+    stock = np.asarray(stock, dtype=float)
+    consumption = np.asarray(consumption, dtype=float)
+    days = consumption.shape[1]
+
+    long_rate = consumption.mean(axis=1) if days else np.zeros(len(stock))
+    short_rate = consumption[:, -short_window:].mean(axis=1) if days else np.zeros(len(stock))
+
+    ages = np.arange(days)[::-1]  # 一番新しい日が 0
+    weights = 0.5 ** (ages / half_life)
+    rate = consumption @ weights / weights.sum() if days else np.zeros(len(stock))
+    deviation = consumption.std(axis=1) if days else np.zeros(len(stock))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_remaining = np.where(rate > 0, stock / rate, np.inf)
+    days_remaining[days_remaining > max_days] = np.inf
+
+    safety_stock = service_z * deviation * np.sqrt(lead_time_days)
+    reorder_point = rate * lead_time_days + safety_stock
+    needs_reorder = (rate > 0) & (stock <= reorder_point)
+    suggested_quantity = np.where(
+        needs_reorder,
+        # 小数の誤差で 1 個多くならないよう、丸めてから切り上げる
+        np.ceil(np.round(np.maximum(rate * (lead_time_days + target_days) + safety_stock - stock, 0), 6)),
+        0,
+    ).astype(int)
+
+    return {
+        "daily_rate": rate,
+        "short_rate": short_rate,
+        "long_rate": long_rate,
+        "days_remaining": days_remaining,
+        "reorder_point": reorder_point,
+        "needs_reorder": needs_reorder,
+        "suggested_quantity": suggested_quantity,
+    }
@@ -1,35 +1,58 @@
 import os
 from pytz import timezone
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone, timedelta, date
 import pytz
 import logging
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, Depends, HTTPException, Response, File, UploadFile, Form, Response, File, UploadFile, Query
+from fastapi import FastAPI, Depends, HTTPException, Response, File, UploadFile, Form, Response, File, UploadFile, Query, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 
 from typing import Optional, List
 from pydantic import BaseModel  # Pydanticモデルをインポート
 from create_db import Product, IncomingInfo, IncomingProduct
 
-from sqlalchemy import create_engine, Column, Integer, String, select, DECIMAL, ForeignKey, Boolean, DateTime, Date, Text, func, desc
+from sqlalchemy import create_engine, Column, Integer, String, select, DECIMAL, ForeignKey, Boolean, DateTime, Date, Text, func, desc, Index, cast, update, bindparam, insert, literal
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session ,aliased, relationship
 
 from azure.storage.blob import BlobServiceClient,ContentSettings
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 
 import uuid
+from collections import Counter, OrderedDict, deque
+import heapq
+import math
+import numpy as np
+import unicodedata
+import threading
+import asyncio
+import queue
+import requests
 
 import jwt
 
 from wordcloud import WordCloud
 import io
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 import matplotlib.pyplot as plt
 import base64
-from janome.tokenizer import Tokenizer
+import json
+import csv
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import time
+
+import wordcloud_worker
+import inventory_forecast
+from barcode_index import BarcodeIndex
+from wordcloud_worker import split_into_filtered_words, split_texts_into_filtered_words
 
 # .env.local ファイルを明示的に指定して環境変数を読み込む
 load_dotenv(dotenv_path=".env.local")
@@ -230,6 +253,9 @@ class Message(Base):
     sender = relationship("UserInformation", foreign_keys=[sender_user_id], lazy="joined")
     receiver = relationship("UserInformation", foreign_keys=[receiver_user_id], lazy="joined")
 
+    # SQLite で削除した（保管した）メッセージのIDが再利用されないようにする（新しく作るデータベースのみ）
+    __table_args__ = {"sqlite_autoincrement": True}
+
 class UserInformation(Base):
     __tablename__ = "userinformation"
     user_id = Column(Integer, primary_key=True, index=True)
@@ -264,6 +290,250 @@ class ReplyComments(Base):
     message_content = Column(Text, nullable=True)  
     send_date = Column(DateTime, nullable=False, default=lambda: datetime.now(japan_timezone))  
 
+    # SQLite で削除した（保管した）コメントのIDが再利用されないようにする（新しく作るデータベースのみ）
+    __table_args__ = {"sqlite_autoincrement": True}
+
+# メッセージ・コメントを形態素解析した結果（単語ごとの出現回数）を保存するテーブル
+# 書き込み時に一度だけ解析しておくことで、ワードクラウド生成時は集計だけで済むようにする
+class MessageTerm(Base):
+    __tablename__ = 'message_terms'
+    message_term_id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(Integer, ForeignKey('message.message_id'), nullable=False, index=True)
+    reply_comment_id = Column(Integer, ForeignKey('reply_comments.reply_comment_id'), nullable=True, index=True)  # NULLならメッセージ本文の単語
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)  # 送信者の組織ID
+    product_id = Column(Integer, ForeignKey('integrated_products.product_id'), nullable=True)
+    term = Column(String(100), nullable=False)  # 単語
+    term_count = Column(Integer, nullable=False, default=1)  # メッセージ内での出現回数
+
+    # 組織・商品ごとに単語の出現回数を集計するためのインデックス
+    # 組織内で単語を含むメッセージを検索するためのインデックス（全文検索の転置インデックスとして使う）
+    __table_args__ = (
+        Index("ix_message_terms_org_product_term", "organization_id", "product_id", "term"),
+        Index("ix_message_terms_org_term", "organization_id", "term"),
+    )
+
+# 全文検索の対象文書（メッセージ本文またはコメント）ごとの単語数（BM25 の文書長に使う）
+class SearchDocument(Base):
+    __tablename__ = 'search_documents'
+    search_document_id = Column(Integer, primary_key=True, autoincrement=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)
+    message_id = Column(Integer, ForeignKey('message.message_id'), nullable=False)
+    reply_comment_id = Column(Integer, ForeignKey('reply_comments.reply_comment_id'), nullable=True)  # NULLならメッセージ本文
+    document_length = Column(Integer, nullable=False, default=0)  # 保存した単語の数
+
+    __table_args__ = (
+        Index("ix_search_documents_message_comment", "message_id", "reply_comment_id"),
+        Index("ix_search_documents_org_length", "organization_id", "document_length"),  # 組織の文書数・平均長の集計用
+    )
+
+# 名前の「同一人物」グループ（手入力の名前の揺れをまとめるための代表名）
+class NameIdentity(Base):
+    __tablename__ = 'name_identities'
+    name_identity_id = Column(Integer, primary_key=True, autoincrement=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False, index=True)
+    canonical_name = Column(String(255), nullable=False)  # 代表名（グループで最初に登録された名前）
+
+# 名前（ユーザー名または手入力の名前）と同一人物グループの対応表
+class NameAlias(Base):
+    __tablename__ = 'name_aliases'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    alias_name = Column(String(255), primary_key=True)
+    name_identity_id = Column(Integer, ForeignKey('name_identities.name_identity_id'), nullable=False, index=True)
+
+# ダッシュボード用の集計値（メッセージ追加時に更新し、表示時は集計済みの値を読むだけにする）
+# counter_type: "total"（送信数の合計）/ "sender"（送信者名ごと）/ "receiver"（受信者名ごと）/ "product"（商品IDごと）
+#               / "initialized"（この組織の集計値が作成済みであることを示す印）
+class DashboardCounter(Base):
+    __tablename__ = 'dashboard_counters'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    counter_type = Column(String(20), primary_key=True)
+    counter_key = Column(String(255), primary_key=True, default="")  # 送信者名・受信者名・商品ID（合計は空文字）
+    counter_value = Column(Integer, nullable=False, default=0)
+
+# 商品ごと・日ごとのメッセージ数（期間を指定したランキングを、メッセージ全件を読まずに集計するため）
+class ProductDailyCount(Base):
+    __tablename__ = 'product_daily_counts'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    count_date = Column(Date, primary_key=True)  # 送信日（日本時間）
+    product_id = Column(Integer, ForeignKey('integrated_products.product_id'), primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+# いいねしたユーザーの記録（同じユーザーが同じメッセージに何度もいいねできないようにする）
+class Likes(Base):
+    __tablename__ = 'Likes'
+    message_id = Column(Integer, ForeignKey('message.message_id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('userinformation.user_id'), primary_key=True)
+
+# 組織ごとのデータの更新番号（書き込みのたびに1つ増やし、一覧取得の ETag やキャッシュのキーに使う）
+# scope: "messages"（メッセージ・コメント・いいね）/ "inventory"（在庫・商品）/ "users"（ユーザー情報）
+# ※ API を通さずに変更されるユーザー・商品マスタは、一覧の ETag にマスタの版（get_master_data_version）も含めて検知する
+class OrganizationChangeVersion(Base):
+    __tablename__ = 'organization_change_versions'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    scope = Column(String(20), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# メッセージがどの会話（2人のユーザーと商品の組み合わせ）に属するかの対応表
+# 送信者・受信者の向きに関係なく同じ会話になるよう、ユーザーIDは小さい方と大きい方に並べ替えて保存する
+class MessageConversation(Base):
+    __tablename__ = 'message_conversations'
+    message_id = Column(Integer, ForeignKey('message.message_id'), primary_key=True)
+    user_low_id = Column(Integer, nullable=False)  # 2人のうち小さい方のユーザーID
+    user_high_id = Column(Integer, nullable=False)  # 2人のうち大きい方のユーザーID
+    product_id = Column(Integer, ForeignKey('integrated_products.product_id'), nullable=True)
+
+    # 会話ごとに新しい順で読むための複合インデックス
+    __table_args__ = (
+        Index("ix_message_conversations_pair_product", "user_low_id", "user_high_id", "product_id", "message_id"),
+    )
+
+# 古いメッセージの保管用テーブル（message と同じ列 + 保管日時）
+# 普段の一覧表示や集計は新しいメッセージ（message テーブル）だけを対象にし、保管分は指定されたときだけ読む
+class MessageArchive(Base):
+    __tablename__ = 'message_archive'
+    message_id = Column(Integer, primary_key=True, autoincrement=False)
+    sender_user_id = Column(Integer, ForeignKey('userinformation.user_id'), nullable=False, index=True)
+    sender_user_name_manual_input = Column(String(255), default=None)
+    receiver_user_id = Column(Integer, ForeignKey('userinformation.user_id'), nullable=False, index=True)
+    receiver_user_name_manual_input = Column(String(255), default=None)
+    product_id = Column(Integer, ForeignKey('integrated_products.product_id'), default=None)
+    message_content = Column(Text, nullable=True)
+    send_date = Column(DateTime, nullable=False)
+    count_of_likes = Column(Integer, default=0)
+    archived_at = Column(DateTime, nullable=False)  # 保管した日時（日本時間）
+
+    # 会話（2人のユーザーと商品）ごとに読むためのインデックス
+    __table_args__ = (
+        Index("ix_message_archive_conversation", "sender_user_id", "receiver_user_id", "product_id", "message_id"),
+    )
+
+# 保管したメッセージに付いていたコメント（reply_comments と同じ列）
+class ReplyCommentArchive(Base):
+    __tablename__ = 'reply_comments_archive'
+    reply_comment_id = Column(Integer, primary_key=True, autoincrement=False)
+    message_id = Column(Integer, ForeignKey('message_archive.message_id'), nullable=False, index=True)
+    comment_user_id = Column(Integer, ForeignKey('userinformation.user_id'), nullable=False)
+    comment_user_name_manual_input = Column(String(255), default=None)
+    message_content = Column(Text, nullable=True)
+    send_date = Column(DateTime, nullable=False)
+
+# 保管したメッセージ・コメントの単語（message_terms と同じ列。ワードクラウドと全文検索で include_archived を指定したときに使う）
+class MessageTermArchive(Base):
+    __tablename__ = 'message_terms_archive'
+    message_term_id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(Integer, ForeignKey('message_archive.message_id'), nullable=False, index=True)
+    reply_comment_id = Column(Integer, ForeignKey('reply_comments_archive.reply_comment_id'), nullable=True, index=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)
+    product_id = Column(Integer, ForeignKey('integrated_products.product_id'), nullable=True)
+    term = Column(String(100), nullable=False)
+    term_count = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        Index("ix_message_terms_archive_org_product_term", "organization_id", "product_id", "term"),
+        Index("ix_message_terms_archive_org_term", "organization_id", "term"),
+    )
+
+# 保管したメッセージ・コメントの全文検索用の文書長（search_documents と同じ列）
+class SearchDocumentArchive(Base):
+    __tablename__ = 'search_documents_archive'
+    search_document_id = Column(Integer, primary_key=True, autoincrement=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)
+    message_id = Column(Integer, ForeignKey('message_archive.message_id'), nullable=False)
+    reply_comment_id = Column(Integer, ForeignKey('reply_comments_archive.reply_comment_id'), nullable=True)
+    document_length = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_search_documents_archive_message_comment", "message_id", "reply_comment_id"),
+        Index("ix_search_documents_archive_org_length", "organization_id", "document_length"),
+    )
+
+# 保管したメッセージの月ごとの集計値（保管テーブルを読まずに過去の件数を表示するため）
+# counter_type: "messages"（メッセージ数）/ "comments"（コメント数）/ "likes"（いいね数）/ "product"（商品IDごとのメッセージ数）
+class MessageArchiveSummary(Base):
+    __tablename__ = 'message_archive_summaries'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    period = Column(String(7), primary_key=True)  # 送信月（YYYY-MM、日本時間）
+    counter_type = Column(String(20), primary_key=True)
+    counter_key = Column(String(255), primary_key=True, default="")  # 商品ID（それ以外は空文字）
+    counter_value = Column(Integer, nullable=False, default=0)
+
+# 在庫の増減の記録（追記のみ、更新・削除はしない）
+# event_type: "intake"（入荷）/ "purchase"（購入）/ "adjustment"（手動の調整）/ "reconciliation"（在庫数との照合による補正）
+class InventoryLedgerEntry(Base):
+    __tablename__ = 'inventory_ledger'
+    ledger_entry_id = Column(Integer, primary_key=True, autoincrement=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)
+    product_id = Column(Integer, nullable=False)
+    event_type = Column(String(20), nullable=False)
+    quantity_change = Column(Integer, nullable=False)  # 在庫数の増減（購入はマイナス）
+    created_at = Column(DateTime, nullable=False)  # 記録した日時（日本時間）
+    reference_id = Column(Integer, nullable=True)  # 入荷ID など
+    note = Column(String(255), nullable=True)
+
+    __table_args__ = (
+        Index("ix_inventory_ledger_org_entry", "organization_id", "ledger_entry_id"),  # スナップショット以降の再生用
+        Index("ix_inventory_ledger_org_type_created", "organization_id", "event_type", "created_at"),  # 期間ごとの消費量の集計用
+    )
+
+# 組織の在庫のスナップショット（ある時点までの記録を反映した在庫数）
+# 時点Tの在庫数は「T以前の最新のスナップショット + その後T までの記録」で計算する
+class InventorySnapshot(Base):
+    __tablename__ = 'inventory_snapshots'
+    snapshot_id = Column(Integer, primary_key=True, autoincrement=True)
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), nullable=False)
+    snapshot_at = Column(DateTime, nullable=False)  # スナップショットの日時（日本時間）
+    last_ledger_entry_id = Column(Integer, nullable=False, default=0)  # 反映済みの最後の記録（この ID 以下の記録を反映済み）
+
+    # 同じ位置のスナップショットは1つだけ（最初のスナップショットや定期作成が同時に実行された場合は、後の方が失敗する）
+    __table_args__ = (
+        Index("ix_inventory_snapshots_org_at", "organization_id", "snapshot_at"),
+        Index("ux_inventory_snapshots_org_entry", "organization_id", "last_ledger_entry_id", unique=True),
+    )
+
+class InventorySnapshotItem(Base):
+    __tablename__ = 'inventory_snapshot_items'
+    snapshot_id = Column(Integer, ForeignKey('inventory_snapshots.snapshot_id'), primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    stock_quantity = Column(Integer, nullable=False, default=0)
+
+# 在庫が少なくなったら通知するための、商品ごとの閾値
+# alert_active: 通知済みで、まだ在庫が回復していない場合 True（在庫が閾値を上回るまで同じ通知を繰り返さない）
+class LowStockThreshold(Base):
+    __tablename__ = 'low_stock_thresholds'
+    organization_id = Column(Integer, ForeignKey("organization.organization_id"), primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    threshold = Column(Integer, nullable=False)  # 在庫数がこの値以下になったら通知する
+    alert_active = Column(Boolean, nullable=False, default=False)
+    alerted_at = Column(DateTime, nullable=True)  # 最後に通知した日時（日本時間）
+
+# 起動時に一度だけ実行する移行作業（既存データのバックフィルなど）の記録
+# 複数のワーカーが同時に起動しても、最初に行を登録できたワーカーだけが実行する
+class MaintenanceTask(Base):
+    __tablename__ = 'maintenance_tasks'
+    task_name = Column(String(100), primary_key=True)
+    started_at = Column(DateTime, nullable=False)
+    completed_at = Column(DateTime, nullable=True)  # 実行中・失敗した場合は None
+
+# 新しく追加したテーブルを作成（既存テーブルには影響しない）
+Base.metadata.create_all(bind=engine, tables=[
+    MessageTerm.__table__, NameIdentity.__table__, NameAlias.__table__, DashboardCounter.__table__,
+    ProductDailyCount.__table__, Likes.__table__, OrganizationChangeVersion.__table__,
+    MessageConversation.__table__, SearchDocument.__table__,
+    MessageArchive.__table__, ReplyCommentArchive.__table__, MessageArchiveSummary.__table__,
+    MessageTermArchive.__table__, SearchDocumentArchive.__table__,
+    InventoryLedgerEntry.__table__, InventorySnapshot.__table__, InventorySnapshotItem.__table__,
+    LowStockThreshold.__table__, MaintenanceTask.__table__,
+])
+# 既存の message_terms テーブルには、後から追加したインデックスだけを作成する
+for index in MessageTerm.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+# 既存の inventory_snapshots テーブルにも、後から追加した一意のインデックスを作成する
+try:
+    for index in InventorySnapshot.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+except Exception as e:
+    logger.warning(f"inventory_snapshots のインデックス作成エラー（重複したスナップショットを削除してください）: {str(e)}")
+
 # お菓子のデータモデル（リクエスト/レスポンス用）
 class Candy(BaseModel):
     id: int
@@ -277,6 +547,10 @@ class ProductCreate(BaseModel):
     barcode: str
     name: str
 
+# バーコードをまとめて商品名に変換するリクエスト
+class BarcodeLookupRequest(BaseModel):
+    barcodes: List[str]
+
 # メッセージモデルの定義
 class MessageCreate(BaseModel):
     message_content: str
@@ -349,6 +623,27 @@ class SnackRankingResponse(BaseModel):
     product_name: str
     purchase_count: int
 
+# 会話のメッセージ（一覧表示に必要な項目だけ）
+class ConversationMessageResponse(BaseModel):
+    message_id: int
+    sender_user_id: int
+    sender_user_name_manual_input: Optional[str] = None
+    receiver_user_id: int
+    receiver_user_name_manual_input: Optional[str] = None
+    product_id: Optional[int] = None
+    message_content: Optional[str] = None
+    send_date: datetime
+    count_of_likes: Optional[int] = 0
+
+    class Config:
+        orm_mode = True
+        from_attributes = True
+
+# 会話のメッセージの1ページ分（next_before_message_id を次のリクエストの before_message_id に渡す）
+class ConversationPageResponse(BaseModel):
+    messages: List[ConversationMessageResponse]
+    next_before_message_id: Optional[int] = None
+
 # ルートエンドポイント: こんにちはを表示
 @app.get("/")
 def read_root():
@@ -380,41 +675,306 @@ def get_organization(
     # ステップ3: ユーザーが未登録の場合
     return {"organization_id": 404}
 
-#組織IDに応じて在庫情報を返すAPI
-@app.get("/products/{organization_id}", response_model=list[ProductResponse], tags=["Product Operations"])
-def get_products_by_organization(organization_id: int, db: Session = Depends(get_db)):
-    print(organization_id)
-    try:
-        meitex_products = db.query(
-            InventoryProduct.product_id,
+# 組織のデータの更新番号を1つ増やす関数（呼び出し元のトランザクションでコミットする）
+def bump_change_version(db, organization_id, scope):
+    increment_counter_row(
+        db, OrganizationChangeVersion, OrganizationChangeVersion.version,
+        dict(organization_id=organization_id, scope=scope)
+    )
+
+# 組織のデータの更新番号を返す関数（まだ書き込みがなければ 0）
+def get_change_version(db, organization_id, scope):
+    return db.query(OrganizationChangeVersion.version).filter_by(
+        organization_id=organization_id, scope=scope
+    ).scalar() or 0
+
+# If-None-Match ヘッダーに ETag が含まれているかを判定する関数（弱い比較なので W/ は無視する）
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    def strip_weak(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+    return strip_weak(etag) in [strip_weak(tag) for tag in if_none_match.split(",")]
+
+# 一覧取得の ETag を作り、クライアントのキャッシュが最新なら 304 Not Modified のレスポンスを返す関数
+# ETag は組織の更新番号、マスタ（ユーザー・商品マスタ）の版、URL（パスとクエリ）から作るので、重い一覧の検索より先に判定できる
+# 戻り値: (レスポンスに付けるヘッダー, 304レスポンス または None)
+def check_not_modified(request, db, organization_id, scope):
+    version = f"{get_change_version(db, organization_id, scope)}.{get_master_data_version(db, organization_id, scope)}"
+    query = sorted(request.query_params.multi_items())
+    digest = hashlib.sha1(f"{request.url.path}?{query}".encode("utf-8")).hexdigest()[:16]
+    etag = f'W/"{scope}-{organization_id}-{version}-{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}  # 毎回サーバーに確認させる
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+# 商品カタログのキャッシュの設定
+# CATALOG_CACHE_TTL_SECONDS: キャッシュの有効期間（書き込み時にも破棄する）
+# CATALOG_CACHE_REDIS_URL: 指定すると Redis を共有キャッシュとして使う（複数ワーカーで動かす場合）
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", 300))
+CATALOG_CACHE_REDIS_URL = os.getenv("CATALOG_CACHE_REDIS_URL")
+
+# プロセス内のメモリに保存するキャッシュ
+class LocalCacheBackend:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries  # これを超えたら有効期限切れのキャッシュを削除する（在庫は更新番号ごとにキーが変わるため）
+        self._entries = {}  # キー -> (値, 有効期限)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._entries) >= self.max_entries:
+                self._entries = {k: entry for k, entry in self._entries.items() if entry[1] >= now}
+                while len(self._entries) >= self.max_entries:
+                    del self._entries[next(iter(self._entries))]  # それでも多ければ古いものから削除
+            self._entries[key] = (value, now + ttl)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+# Redis に保存する共有キャッシュ（値は JSON で保存する）
+class RedisCacheBackend:
+    def __init__(self, url, prefix="catalog:"):
+        import redis  # 使う場合だけ必要なのでここで読み込む
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+
+    def delete(self, *keys):
+        self._client.delete(*[self._prefix + key for key in keys])
+
+def create_catalog_cache_backend():
+    if CATALOG_CACHE_REDIS_URL:
+        try:
+            return RedisCacheBackend(CATALOG_CACHE_REDIS_URL)
+        except ImportError:
+            logger.warning("redis がインストールされていないため、商品カタログはプロセス内でキャッシュします")
+    return LocalCacheBackend()
+
+# 商品カタログのキャッシュ（値は JSON にできる形で保存する）
+# キャッシュが使えない場合はデータベースから読み込むだけにする
+class CatalogCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get_or_load(self, key, loader):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"商品カタログのキャッシュ読み込みエラー: {str(e)}")
+            value = None
+        if value is None:
+            value = loader()
+            try:
+                self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"商品カタログのキャッシュ書き込みエラー: {str(e)}")
+        return value
+
+    def invalidate(self, *keys):
+        try:
+            self.backend.delete(*keys)
+        except Exception as e:
+            logger.warning(f"商品カタログのキャッシュ破棄エラー: {str(e)}")
+
+catalog_cache = CatalogCache(create_catalog_cache_backend(), CATALOG_CACHE_TTL_SECONDS)
+
+# meitex商品の一覧（全組織で共通）
+def load_meitex_catalog(db):
+    return [
+        {
+            "product_id": row.product_id,
+            "product_name": row.product_name,
+            "product_explanation": row.product_explanation,
+            "product_image_url": row.product_image_url,
+        }
+        for row in db.query(
+            IntegratedProduct.product_id,
             MeitexProductMaster.product_name,
-            MeitexProductMaster.product_image_url,
-            InventoryProduct.sales_amount,
-            InventoryProduct.stock_quantity
-        ).join(IntegratedProduct, InventoryProduct.product_id == IntegratedProduct.product_id
+            MeitexProductMaster.product_explanation,
+            MeitexProductMaster.product_image_url
         ).join(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id
-        ).filter(InventoryProduct.organization_id == organization_id).all()
+        ).all()
+    ]
+
+# 独自商品の一覧（organization_id を指定すればその組織の商品、product_ids を指定すればその商品）
+def load_independent_catalog(db, organization_id=None, product_ids=None):
+    query = db.query(
+        IntegratedProduct.product_id,
+        IndependentProductMaster.product_name,
+        IndependentProductMaster.product_explanation,
+        IndependentProductMaster.product_image_url
+    ).join(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
+    if organization_id is not None:
+        query = query.filter(IndependentProductMaster.organization_id == organization_id)
+    if product_ids is not None:
+        query = query.filter(IntegratedProduct.product_id.in_(product_ids))
+    return [
+        {
+            "product_id": row.product_id,
+            "product_name": row.product_name,
+            "product_explanation": row.product_explanation,
+            "product_image_url": row.product_image_url,
+        }
+        for row in query.all()
+    ]
 
-        independent_products = db.query(
+# 組織の在庫（販売価格と在庫数）の一覧
+# 商品（integrated_products）として登録されていない在庫は含めない
+def load_inventory_stock(db, organization_id):
+    return [
+        {
+            "product_id": row.product_id,
+            "sales_amount": float(row.sales_amount) if row.sales_amount is not None else None,
+            "stock_quantity": row.stock_quantity,
+        }
+        for row in db.query(
             InventoryProduct.product_id,
-            IndependentProductMaster.product_name,
-            IndependentProductMaster.product_image_url,
             InventoryProduct.sales_amount,
             InventoryProduct.stock_quantity
         ).join(IntegratedProduct, InventoryProduct.product_id == IntegratedProduct.product_id
-        ).join(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id
-        ).filter(InventoryProduct.organization_id == organization_id).all()
+        ).filter(InventoryProduct.organization_id == organization_id
+        ).order_by(InventoryProduct.product_id).all()
+    ]
 
-        #結合
-        all_products = meitex_products + independent_products
+# 組織のユーザーの一覧（ユーザーIDの順）
+def load_organization_users(db, organization_id):
+    return [
+        {"user_id": user_id, "user_name": user_name}
+        for user_id, user_name in db.query(UserInformation.user_id, UserInformation.user_name).filter(
+            UserInformation.organization_id == organization_id
+        ).order_by(UserInformation.user_id).all()
+    ]
+
+# 内容から版（短いハッシュ）を作る関数
+def content_version(content):
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+
+# 一覧と、その内容の版をまとめてキャッシュする関数（版は読み込んだときに一度だけ計算する）
+# 戻り値: {"version": 版, "items": 一覧}
+def get_versioned_catalog(key, loader):
+    def load():
+        items = loader()
+        return {"version": content_version(items), "items": items}
+    return catalog_cache.get_or_load(key, load)
+
+# キャッシュから読む関数（なければデータベースから読み込んでキャッシュする）
+def get_meitex_catalog_entry(db, organization_id=None):
+    return get_versioned_catalog("meitex_catalog", lambda: load_meitex_catalog(db))
+
+def get_independent_catalog_entry(db, organization_id):
+    return get_versioned_catalog(f"independent_catalog:{organization_id}", lambda: load_independent_catalog(db, organization_id))
+
+def get_organization_users_entry(db, organization_id):
+    return get_versioned_catalog(f"users:{organization_id}", lambda: load_organization_users(db, organization_id))
+
+def get_meitex_catalog(db):
+    return get_meitex_catalog_entry(db)["items"]
+
+def get_independent_catalog(db, organization_id):
+    return get_independent_catalog_entry(db, organization_id)["items"]
+
+def get_organization_users(db, organization_id):
+    return get_organization_users_entry(db, organization_id)["items"]
+
+# 一覧の ETag に含めるマスタ（scope ごとに、返す内容に含まれるもの）
+MASTER_DATA_BY_SCOPE = {
+    "users": (get_organization_users_entry,),
+    "inventory": (get_meitex_catalog_entry, get_independent_catalog_entry),
+    "messages": (get_organization_users_entry, get_meitex_catalog_entry, get_independent_catalog_entry),  # 送信者・受信者の名前と商品名・画像
+}
+
+# ユーザーと商品マスタの版を返す関数（一覧の ETag に含める）
+# ユーザーや meitex 商品は API を通さずに追加・変更されることがあり、更新番号では変更を検知できないため、
+# キャッシュした一覧を読み込んだときの版を使う（データベースを読むのはキャッシュがない場合だけ）
+# API を通さない変更は、キャッシュの有効期間（CATALOG_CACHE_TTL_SECONDS）が過ぎると ETag に反映される
+def get_master_data_version(db, organization_id, scope):
+    return content_version([get_entry(db, organization_id)["version"] for get_entry in MASTER_DATA_BY_SCOPE.get(scope, ())])
+
+# 在庫は組織の在庫の更新番号ごとにキャッシュする
+# 在庫を変更する処理は更新番号を増やすので、他のワーカーや、書き込みと同時に読み込んだリクエストが
+# 古い在庫をキャッシュしていても、更新後の番号では使われない（古いキャッシュは有効期間が過ぎると消える）
+def get_inventory_stock(db, organization_id):
+    version = get_change_version(db, organization_id, "inventory")
+    return catalog_cache.get_or_load(
+        f"stock:{organization_id}:{version}", lambda: load_inventory_stock(db, organization_id)
+    )
+
+# 書き込み時にキャッシュを破棄する関数（コミット後に呼ぶ）
+def invalidate_independent_catalog_cache(organization_id):
+    catalog_cache.invalidate(f"independent_catalog:{organization_id}")
+
+# 組織の在庫と、在庫に含まれる商品のカタログ情報を返す関数
+# 戻り値: (在庫の一覧, {商品ID: meitex商品}, {商品ID: 独自商品})
+def get_inventory_catalog(db, organization_id):
+    stock = get_inventory_stock(db, organization_id)
+    meitex = {product["product_id"]: product for product in get_meitex_catalog(db)}
+    independent = {product["product_id"]: product for product in get_independent_catalog(db, organization_id)}
+
+    # 他の組織の独自商品が在庫にある場合は、その分だけデータベースから読む
+    missing_ids = [item["product_id"] for item in stock if item["product_id"] not in meitex and item["product_id"] not in independent]
+    if missing_ids:
+        independent.update({product["product_id"]: product for product in load_independent_catalog(db, product_ids=missing_ids)})
+    return stock, meitex, independent
+
+#組織IDに応じて在庫情報を返すAPI
+@app.get("/products/{organization_id}", response_model=list[ProductResponse], tags=["Product Operations"])
+def get_products_by_organization(organization_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    print(organization_id)
+    try:
+        # 前回の取得から変更がなければ 304 を返す
+        headers, not_modified = check_not_modified(request, db, organization_id, "inventory")
+        if not_modified:
+            return not_modified
+        response.headers.update(headers)
+
+        # 在庫と商品カタログはキャッシュから読む
+        stock, meitex, independent = get_inventory_catalog(db, organization_id)
+
+        # meitex商品、独自商品の順に結合
+        all_products = [
+            {**item, **catalog[item["product_id"]]}
+            for catalog in (meitex, independent)
+            for item in stock
+            if item["product_id"] in catalog
+        ]
 
         if not all_products:
             print("miss")
             raise HTTPException(status_code=404, detail="No products found for this organization")
 
         # Pydantic モデルに変換して返す
-        return [ProductResponse.from_orm(product) for product in all_products]
+        return [ProductResponse(**product) for product in all_products]
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -423,21 +983,9 @@ def get_products_by_organization(organization_id: int, db: Session = Depends(get
 def get_products_by_organization(organization_id: int, db: Session = Depends(get_db)):
     
     try:
-        meitex_products = db.query(
-            IntegratedProduct.product_id,
-            MeitexProductMaster.product_name,
-            MeitexProductMaster.product_explanation,
-            MeitexProductMaster.product_image_url
-        ).join(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id
-        ).all()
-
-        independent_products = db.query(
-            IntegratedProduct.product_id,
-            IndependentProductMaster.product_name,
-            IndependentProductMaster.product_explanation,
-            IndependentProductMaster.product_image_url
-        ).join(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id
-        ).filter(IndependentProductMaster.organization_id == organization_id).all()
+        # 商品カタログはキャッシュから読む
+        meitex_products = get_meitex_catalog(db)
+        independent_products = get_independent_catalog(db, organization_id)
 
         #結合
         all_products = meitex_products + independent_products
@@ -447,7 +995,7 @@ def get_products_by_organization(organization_id: int, db: Session = Depends(get
             raise HTTPException(status_code=404, detail="No products found for this organization")
 
         # Pydantic モデルに変換して返す
-        product_list=[ProductResponseForAmbassador.from_orm(product) for product in all_products]
+        product_list=[ProductResponseForAmbassador(**product) for product in all_products]
         return {"products": product_list}
     
     except Exception as e:
@@ -455,46 +1003,206 @@ def get_products_by_organization(organization_id: int, db: Session = Depends(get
 
 #組織IDに応じて在庫情報を返すAPI
 @app.get("/inventory_products/{organization_id}")
-def get_inventory_products(organization_id: int, db: Session = Depends(get_db)):
+def get_inventory_products(organization_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
     try:
-        # データベースクエリ
-        results = (
+        # 前回の取得から変更がなければ 304 を返す
+        headers, not_modified = check_not_modified(request, db, organization_id, "inventory")
+        if not_modified:
+            return not_modified
+        response.headers.update(headers)
+
+        # 在庫と商品カタログはキャッシュから読む
+        stock, meitex, independent = get_inventory_catalog(db, organization_id)
+
+        # レスポンスデータ作成（独自商品の情報を優先）
+        products = []
+        for item in stock:
+            product = independent.get(item["product_id"]) or meitex.get(item["product_id"]) or {}
+            products.append({
+                "product_id": item["product_id"],
+                "sales_amount": int(item["sales_amount"]),
+                "stock_quantity": item["stock_quantity"],
+                "product_name": product.get("product_name"),
+                "product_explanation": product.get("product_explanation"),
+                "product_image_url": product.get("product_image_url")
+            })
+
+        return products
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+# 商品名を検索用に正規化する関数（全角・半角の統一、小文字化、カタカナをひらがなに、空白を除く）
+def normalize_product_name(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(
+        chr(ord(char) - 0x60) if "ァ" <= char <= "ヶ" else char
+        for char in text
+        if not char.isspace()
+    )
+
+# 商品名のあいまい検索用インデックス（meitex商品・チョコレートは全組織共通、独自商品は組織ごと）
+# 正規化した商品名のリストを事前に作っておき、検索時は rapidfuzz で照合するだけにする
+# 追加時はリストを作り直して差し替えるので、検索中のスレッドはロックなしで読める
+class ProductSearchIndex:
+    def __init__(self):
+        self._shared = ([], [])  # (正規化した商品名のリスト, 商品情報のリスト)
+        self._by_organization = {}  # 組織ID -> (正規化した商品名のリスト, 商品情報のリスト)
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # 最初の読み込みを1つのスレッドだけで行うためのロック
+        self._loads_in_progress = 0
+        self._added_during_load = []  # 読み込み中に追加された独自商品 [(組織ID, 商品情報), ...]
+
+    @staticmethod
+    def _build(entries):
+        return [normalize_product_name(entry["product_name"]) for entry in entries], entries
+
+    def load(self, db, chocolates_db):
+        with self._lock:
+            self._loads_in_progress += 1
+            added_from = len(self._added_during_load)
+        try:
+            shared, by_organization = self._read(db, chocolates_db)
+            with self._lock:
+                # 読み込み中に追加された独自商品は、読み込んだ一覧になければ加える（差し替えで消えないように）
+                for organization_id, entry in self._added_during_load[added_from:]:
+                    entries = by_organization.setdefault(organization_id, [])
+                    if all(existing["product_id"] != entry["product_id"] for existing in entries):
+                        entries.append(entry)
+                self._shared = self._build(shared)
+                self._by_organization = {
+                    organization_id: self._build(entries) for organization_id, entries in by_organization.items()
+                }
+                self._loaded = True
+        finally:
+            with self._lock:
+                self._loads_in_progress -= 1
+                if not self._loads_in_progress:
+                    self._added_during_load = []
+
+    # 商品マスタとチョコレートのデータを読み込む関数（(共通の商品情報のリスト, {組織ID: 独自商品の商品情報のリスト}) を返す）
+    def _read(self, db, chocolates_db):
+        shared = [
+            {"source": "meitex", "product_id": product["product_id"], "product_name": product["product_name"],
+             "product_image_url": product["product_image_url"]}
+            for product in load_meitex_catalog(db)
+            if product["product_name"]
+        ]
+        shared += [
+            {"source": "chocolate", "chocolate_id": chocolate.Index, "product_name": chocolate.Product_Name,
+             "product_image_url": chocolate.Image_Url}
+            for chocolate in chocolates_db.query(ChocolateDB.Index, ChocolateDB.Product_Name, ChocolateDB.Image_Url).all()
+            if chocolate.Product_Name
+        ]
+        by_organization = {}
+        for row in (
             db.query(
-                InventoryProduct.product_id,
-                InventoryProduct.sales_amount,
-                InventoryProduct.stock_quantity,
-                IndependentProductMaster.product_name.label("independent_product_name"),
-                IndependentProductMaster.product_explanation.label("independent_product_explanation"),
-                IndependentProductMaster.product_image_url.label("independent_product_image_url"),
-                MeitexProductMaster.product_name.label("meitex_product_name"),
-                MeitexProductMaster.product_explanation.label("meitex_product_explanation"),
-                MeitexProductMaster.product_image_url.label("meitex_product_image_url")
+                IntegratedProduct.product_id,
+                IndependentProductMaster.organization_id,
+                IndependentProductMaster.product_name,
+                IndependentProductMaster.product_image_url,
             )
-            .join(IntegratedProduct, InventoryProduct.product_id == IntegratedProduct.product_id)
-            .outerjoin(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
-            .outerjoin(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id)
-            .filter(InventoryProduct.organization_id == organization_id)
+            .join(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
             .all()
-        )
+        ):
+            if row.product_name:
+                by_organization.setdefault(row.organization_id, []).append(
+                    {"source": "independent", "product_id": row.product_id, "product_name": row.product_name,
+                     "product_image_url": row.product_image_url}
+                )
+        return shared, by_organization
+
+    # まだ読み込んでいなければ読み込む関数（同時に呼ばれた場合は、他のスレッドは読み込みが終わるまで待つ）
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            db = SessionLocal()
+            chocolates_db = chocolates_SessionLocal()
+            try:
+                self.load(db, chocolates_db)
+            finally:
+                db.close()
+                chocolates_db.close()
+
+    # 独自商品を追加したときに呼ぶ
+    def add_independent(self, organization_id, product_id, product_name, product_image_url):
+        if not product_name:
+            return
+        entry = {"source": "independent", "product_id": product_id, "product_name": product_name,
+                 "product_image_url": product_image_url}
+        with self._lock:
+            names, entries = self._by_organization.get(organization_id, ([], []))
+            self._by_organization[organization_id] = (
+                names + [normalize_product_name(product_name)],
+                entries + [entry],
+            )
+            if self._loads_in_progress:
+                self._added_during_load.append((organization_id, entry))
 
-        # レスポンスデータ作成
-        response = [
-            {
-                "product_id": result.product_id,
-                "sales_amount": int(result.sales_amount),
-                "stock_quantity": result.stock_quantity,
-                "product_name": result.independent_product_name or result.meitex_product_name,
-                "product_explanation": result.independent_product_explanation or result.meitex_product_explanation,
-                "product_image_url": result.independent_product_image_url or result.meitex_product_image_url
-            }
-            for result in results
+    # 商品名であいまい検索する関数（スコアの高い順に [(スコア, 商品情報), ...] を返す）
+    def search(self, query, organization_id=None, limit=10, score_cutoff=60):
+        normalized = normalize_product_name(query)
+        if not normalized:
+            return []
+        self.ensure_loaded()
+
+        choices = [self._shared]
+        if organization_id is not None and organization_id in self._by_organization:
+            choices.append(self._by_organization[organization_id])
+
+        results = []
+        for names, entries in choices:
+            for _, score, index in process.extract(
+                normalized, names, scorer=fuzz.WRatio, limit=limit, score_cutoff=score_cutoff
+            ):
+                # 同点の場合は、名前全体がより近い商品を先にする
+                results.append((score, fuzz.ratio(normalized, names[index]), entries[index]))
+        return [
+            (score, entry)
+            for score, _, entry in heapq.nlargest(limit, results, key=lambda result: result[:2])
         ]
 
-        return response
+product_search_index = ProductSearchIndex()
+
+@app.on_event("startup")
+def load_product_search_index():
+    try:
+        product_search_index.ensure_loaded()
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+        # 読み込めなかった場合は、最初の検索時に読み込む
+        logger.warning(f"商品検索インデックスの読み込みエラー: {str(e)}")
+
+# 商品名のあいまい検索エンドポイント（入力途中の名前や表記揺れでも候補を返す）
+# meitex商品・独自商品（organization_id を指定した場合）・チョコレートのデータを検索する
+@app.get("/api/snacks/search", tags=["Product Operations"])
+def search_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    organization_id: Optional[int] = Query(None),
+    limit: int = Query(10, ge=1, le=50),
+    min_score: float = Query(60, ge=0, le=100),  # この点数未満の候補は返さない
+):
+    try:
+        return {
+            "products": [
+                {**entry, "score": round(score, 1)}
+                for score, entry in product_search_index.search(q, organization_id, limit, min_score)
+            ]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品検索インデックスを読み込み直すエンドポイント（商品マスタを直接更新した場合に使う）
+@app.post("/api/snacks/search/reload", tags=["Product Operations"])
+def reload_product_search(db: Session = Depends(get_db), chocolates_db: Session = Depends(get_chocolates_db)):
+    try:
+        product_search_index.load(db, chocolates_db)
+        return {"message": "商品検索インデックスを読み込み直しました"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        
 # お菓子データを取得するエンドポイント（Candy用）
 @app.get("/candies", response_model=list[Candy])
 def get_candies(db: Session = Depends(get_db)):
@@ -526,16 +1234,55 @@ def get_chocolate(chocolate_id: int, db: Session = Depends(get_chocolates_db)):
         logger.error(f"チョコレートデータ取得エラー: {str(e)}")
         raise HTTPException(status_code=500, detail="サーバー内部エラー")
 
+# バーコードと商品名のインデックス（起動時に商品マスタを読み込み、add_product で追加する）
+# BARCODE_NEGATIVE_TTL_SECONDS: 見つからなかったバーコードを覚えておく秒数（この間はデータベースを検索しない）
+barcode_index = BarcodeIndex(negative_ttl=float(os.getenv("BARCODE_NEGATIVE_TTL_SECONDS", 60)))
+
+# 一度にまとめて変換できるバーコードの数
+BARCODE_LOOKUP_MAX = 500
+
+@app.on_event("startup")
+def load_barcode_index():
+    db = SessionLocal()
+    try:
+        logger.info(f"バーコードを読み込みました: {barcode_index.load(db)}件")
+    except Exception as e:
+        # 読み込めなかった場合は、最初の検索時に読み込む
+        logger.warning(f"バーコードの読み込みエラー: {str(e)}")
+    finally:
+        db.close()
+
 # バーコードから商品名を取得するエンドポイント
 @app.get("/get_product_name", tags=["Product Operations"])
 def get_product_name(barcode: str, db: Session = Depends(get_db)):
     try:
-        # バーコードに基づいて商品を検索
-        product = db.execute(select(Product).where(Product.barcode_number == barcode)).scalars().first()
-        if product:
-            return {"product_name": product.product_name}
+        # バーコードに基づいて商品を検索（メモリ上のインデックスから）
+        product_name = barcode_index.lookup(db, barcode)
+        if product_name is not None:
+            return {"product_name": product_name}
         else:
             raise HTTPException(status_code=404, detail="商品が見つかりません")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"商品検索時のエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail="サーバー内部エラー")
+
+# 複数のバーコードをまとめて商品名に変換するエンドポイント（入荷時に続けてスキャンした分を1回で変換する）
+# 結果はリクエストと同じ順に返し、見つからなかったバーコードの product_name は null にする
+@app.post("/get_product_names", tags=["Product Operations"])
+def get_product_names_by_barcodes(request: BarcodeLookupRequest, db: Session = Depends(get_db)):
+    if len(request.barcodes) > BARCODE_LOOKUP_MAX:
+        raise HTTPException(status_code=400, detail=f"バーコードは一度に{BARCODE_LOOKUP_MAX}件までです")
+    try:
+        names = barcode_index.lookup_many(db, request.barcodes)
+        return {
+            "products": [
+                {"barcode": barcode, "product_name": names[barcode]}
+                for barcode in request.barcodes
+            ],
+            "not_found": [barcode for barcode in dict.fromkeys(request.barcodes) if names[barcode] is None],
+        }
     except Exception as e:
         logger.error(f"商品検索時のエラー: {str(e)}")
         raise HTTPException(status_code=500, detail="サーバー内部エラー")
@@ -556,14 +1303,32 @@ def add_product(product: ProductCreate, db: Session = Depends(get_db)):
             )
             db.add(new_product)
             db.commit()
+            barcode_index.add(product.barcode, product.name)  # バーコードのインデックスにも追加
             return {"message": "商品が追加されました"}
     except Exception as e:
         logger.error(f"商品追加時のエラー: {str(e)}")
         raise HTTPException(status_code=500, detail="商品を追加できませんでした")
 
-# 新しい商品を商品マスタに追加するエンドポイント（名前とバーコードのみ）
+# 在庫数を stock_quantity = stock_quantity + n でまとめて加算する関数（{product_id: n} を渡す）
+def apply_stock_increments(db, organization_id, increments):
+    if not increments:
+        return
+    inventory_table = InventoryProduct.__table__
+    db.execute(
+        update(inventory_table)
+        .where(
+            inventory_table.c.organization_id == organization_id,
+            inventory_table.c.product_id == bindparam("target_product_id"),
+        )
+        .values(stock_quantity=func.coalesce(inventory_table.c.stock_quantity, 0) + bindparam("quantity")),
+        [{"target_product_id": product_id, "quantity": quantity} for product_id, quantity in increments.items()],
+    )
+
+# 入荷を登録し、在庫を増やすエンドポイント
+# 入荷情報・在庫・入荷明細を1つのトランザクションで登録する（途中で失敗した場合はすべて取り消す）
+# データベースへの同期的な処理なので、通常の def にしてスレッドプールで実行させる
 @app.post("/receiving_register")
-async def register_incoming_products(
+def register_incoming_products(
     request: IncomingRegisterRequest,
     db: Session = Depends(get_db)
 ):
@@ -572,51 +1337,76 @@ async def register_incoming_products(
     jst_timezone = pytz.timezone('Asia/Tokyo')
     jst_time = utc_time.astimezone(jst_timezone)
 
+    # 同じ商品が複数行ある場合は入荷数を合計する（入荷明細は商品ごとに1行）
+    quantities = {}
+    for item in request.items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.incoming_quantity
+
     # トランザクション開始
     try:
-        # IncomingInformation にデータを挿入
+        # IncomingInformation にデータを挿入（incoming_id を確定させる）
         incoming_info = IncomingInformation(
             incoming_date=jst_time.date(),
             purchase_amount=request.purchase_amount,
             user_id=request.user_id,  # リクエストからユーザーIDを使用
         )
         db.add(incoming_info)
-        db.commit()
-        db.refresh(incoming_info)
-
-        # 商品情報の挿入と在庫更新
-        for item in request.items:
-            # Inventory_products から商品を取得（組織IDも一致するもの）
-            inventory_product = db.query(InventoryProduct).filter(
-                InventoryProduct.product_id == item.product_id,
-                InventoryProduct.organization_id == request.organization_id
-            ).first()
-
-            if not inventory_product:
-                # 商品が存在しない場合、新規作成
-                inventory_product = InventoryProduct(
-                    product_id=item.product_id,
-                    organization_id=request.organization_id,
-                    sales_amount=0,  
-                    stock_quantity=item.incoming_quantity  
-                )
-                db.add(inventory_product)
-
-            else:
-                # 在庫数の更新（すでにあれば加算）
-                inventory_product.stock_quantity += item.incoming_quantity
+        db.flush()
+
+        # 在庫の記録を始める前の在庫数を保存（組織で初めての場合だけ）
+        ensure_inventory_baseline(db, request.organization_id)
+
+        # 在庫がすでにある商品を1回のクエリで取得
+        existing_ids = {
+            product_id
+            for (product_id,) in db.query(InventoryProduct.product_id).filter(
+                InventoryProduct.organization_id == request.organization_id,
+                InventoryProduct.product_id.in_(list(quantities))
+            ).all()
+        }
 
-            db.commit()  # 在庫の更新を確定
+        # 在庫数の更新（すでにあれば加算）
+        apply_stock_increments(
+            db, request.organization_id,
+            {product_id: quantity for product_id, quantity in quantities.items() if product_id in existing_ids}
+        )
 
-            # Incoming_Products にデータを追加
-            incoming_product = Incoming_Products(
-                product_id=item.product_id,
-                incoming_id=incoming_info.incoming_id,
-                incoming_quantity=item.incoming_quantity
+        # 商品が存在しない場合、まとめて新規作成
+        new_products = [
+            {"product_id": product_id, "organization_id": request.organization_id, "sales_amount": 0, "stock_quantity": quantity}
+            for product_id, quantity in quantities.items()
+            if product_id not in existing_ids
+        ]
+        if new_products:
+            try:
+                with db.begin_nested():  # セーブポイント
+                    db.execute(insert(InventoryProduct.__table__), new_products)
+            except IntegrityError:
+                # 同時に別の入荷で作成された場合は、1件ずつ作成し、作成済みなら加算する
+                for product in new_products:
+                    try:
+                        with db.begin_nested():
+                            db.add(InventoryProduct(**product))
+                    except IntegrityError:
+                        apply_stock_increments(db, request.organization_id, {product["product_id"]: product["stock_quantity"]})
+
+        # 在庫の増減を記録
+        record_inventory_events(db, request.organization_id, "intake", quantities, reference_id=incoming_info.incoming_id)
+
+        # Incoming_Products にデータをまとめて追加
+        if quantities:
+            db.execute(
+                insert(Incoming_Products.__table__),
+                [
+                    {"product_id": product_id, "incoming_id": incoming_info.incoming_id, "incoming_quantity": quantity}
+                    for product_id, quantity in quantities.items()
+                ],
             )
-            db.add(incoming_product)
 
+        alerts = check_low_stock(db, request.organization_id, quantities)  # 入荷で回復した商品の通知状態を戻す
+        bump_change_version(db, request.organization_id, "inventory")  # 在庫一覧の更新番号を増やす
         db.commit()  # すべての変更を確定
+        low_stock_alerts.emit(alerts)
         return {"message": "商品が正常に登録され、在庫が更新されました"}
 
     except Exception as e:
@@ -668,8 +1458,12 @@ async def upload_product(
             independent_product_id=new_product.independent_product_id
         )
         db.add(new_integrated_product)
+        bump_change_version(db, organization_id, "inventory")  # 商品一覧の更新番号を増やす
         db.commit()
         db.refresh(new_integrated_product)
+        invalidate_independent_catalog_cache(organization_id)
+        # 商品検索インデックスに追加
+        product_search_index.add_independent(organization_id, new_integrated_product.product_id, new_product.product_name, image_url)
 
         return {
             "message": "独自商品と統合製品が正常にアップロードされました",
@@ -703,8 +1497,11 @@ def update_price(
 
     # 値段を更新
     product.sales_amount = request.sales_amount
+    alerts = check_low_stock(db, organization_id, [product_id])
+    bump_change_version(db, organization_id, "inventory")  # 在庫一覧の更新番号を増やす
     db.commit()
     db.refresh(product)
+    low_stock_alerts.emit(alerts)
 
     # 成功レスポンス
     return {
@@ -716,20 +1513,197 @@ def update_price(
         }
     }
 
+BULK_UPDATE_MAX_ROWS = 5000  # 一括更新で1回に受け付ける行数の上限
+
+class BulkInventoryUpdateItem(BaseModel):
+    product_id: int
+    sales_amount: Optional[float] = None  # 指定しなければ変更しない
+    stock_quantity: Optional[int] = None  # 更新後の在庫数（指定しなければ変更しない）
+
+class BulkInventoryUpdateRequest(BaseModel):
+    items: List[BulkInventoryUpdateItem]
+
+# 販売価格・在庫数をまとめて更新する関数
+# rows: {"row": 行番号, "product_id", "sales_amount", "stock_quantity", "error": 読み込み時のエラー} のリスト
+# 全行を1回で検証し、1行でも問題があれば何も変更せず、行ごとの結果を付けて 400 を返す
+# 問題がなければ1つのトランザクションでまとめて更新する（在庫数の変更は "adjustment" として記録する）
+def apply_bulk_inventory_update(db, organization_id, rows):
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows to update")
+    if len(rows) > BULK_UPDATE_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Too many rows (max {BULK_UPDATE_MAX_ROWS})")
+
+    ensure_inventory_baseline(db, organization_id)
+
+    # 対象の在庫を1回のクエリで取得（更新が終わるまで他の更新を待たせる）
+    product_ids = list({row["product_id"] for row in rows if row["product_id"] is not None})
+    current = {
+        product_id: (sales_amount, stock_quantity)
+        for product_id, sales_amount, stock_quantity in db.query(
+            InventoryProduct.product_id, InventoryProduct.sales_amount, InventoryProduct.stock_quantity
+        ).filter(
+            InventoryProduct.organization_id == organization_id,
+            InventoryProduct.product_id.in_(product_ids)
+        ).with_for_update().all()
+    }
+
+    # 検証
+    results = []
+    seen_ids = set()
+    for row in rows:
+        result = {
+            "row": row["row"],
+            "product_id": row["product_id"],
+            "sales_amount": row["sales_amount"],
+            "stock_quantity": row["stock_quantity"],
+            "status": "ok",
+        }
+        if row.get("error"):
+            result.update(status="invalid", detail=row["error"])
+        elif row["sales_amount"] is None and row["stock_quantity"] is None:
+            result.update(status="invalid", detail="sales_amount or stock_quantity is required")
+        elif row["sales_amount"] is not None and row["sales_amount"] < 0:
+            result.update(status="invalid", detail="sales_amount must be 0 or greater")
+        elif row["stock_quantity"] is not None and row["stock_quantity"] < 0:
+            result.update(status="invalid", detail="stock_quantity must be 0 or greater")
+        elif row["product_id"] in seen_ids:
+            result.update(status="invalid", detail="Duplicate product_id")
+        elif row["product_id"] not in current:
+            result.update(status="not_found", detail=f"Product with ID {row['product_id']} not found")
+        seen_ids.add(row["product_id"])
+        results.append(result)
+
+    if any(result["status"] != "ok" for result in results):
+        db.rollback()
+        for result in results:
+            if result["status"] == "ok":
+                result["status"] = "not_applied"  # 問題はないが、他の行の問題で更新しなかった行
+        return JSONResponse(status_code=400, content={"detail": "Validation failed; nothing was updated", "results": results})
+
+    # まとめて更新
+    inventory_table = InventoryProduct.__table__
+    prices = [
+        {"target_product_id": row["product_id"], "new_sales_amount": row["sales_amount"]}
+        for row in rows if row["sales_amount"] is not None
+    ]
+    if prices:
+        db.execute(
+            update(inventory_table)
+            .where(
+                inventory_table.c.organization_id == organization_id,
+                inventory_table.c.product_id == bindparam("target_product_id"),
+            )
+            .values(sales_amount=bindparam("new_sales_amount")),
+            prices,
+        )
+    stock_changes = {
+        row["product_id"]: row["stock_quantity"] - (current[row["product_id"]][1] or 0)
+        for row in rows if row["stock_quantity"] is not None
+    }
+    if stock_changes:
+        db.execute(
+            update(inventory_table)
+            .where(
+                inventory_table.c.organization_id == organization_id,
+                inventory_table.c.product_id == bindparam("target_product_id"),
+            )
+            .values(stock_quantity=bindparam("new_stock_quantity")),
+            [
+                {"target_product_id": row["product_id"], "new_stock_quantity": row["stock_quantity"]}
+                for row in rows if row["stock_quantity"] is not None
+            ],
+        )
+        record_inventory_events(db, organization_id, "adjustment", stock_changes, note="一括更新")
+
+    alerts = check_low_stock(db, organization_id, stock_changes)
+    bump_change_version(db, organization_id, "inventory")  # 在庫一覧の更新番号を増やす
+    db.commit()
+    low_stock_alerts.emit(alerts)
+
+    for result in results:
+        sales_amount, stock_quantity = current[result["product_id"]]
+        result["previous_sales_amount"] = float(sales_amount) if sales_amount is not None else None
+        result["previous_stock_quantity"] = stock_quantity
+    return {"message": "Inventory updated successfully", "updated": len(results), "results": results}
+
+# 販売価格・在庫数をまとめて更新するエンドポイント（JSON）
+@app.put("/inventory_products/{organization_id}/bulk_update", tags=["Product Operations"])
+def bulk_update_inventory(organization_id: int, request: BulkInventoryUpdateRequest, db: Session = Depends(get_db)):
+    rows = [
+        {
+            "row": i + 1,
+            "product_id": item.product_id,
+            "sales_amount": item.sales_amount,
+            "stock_quantity": item.stock_quantity,
+        }
+        for i, item in enumerate(request.items)
+    ]
+    try:
+        return apply_bulk_inventory_update(db, organization_id, rows)
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+# CSVの1行を一括更新の行に変換する関数（空欄の列は変更しない）
+def parse_bulk_update_csv_row(row_number, record):
+    row = {"row": row_number, "product_id": None, "sales_amount": None, "stock_quantity": None}
+    try:
+        row["product_id"] = int(record["product_id"])
+    except (TypeError, ValueError):
+        row["error"] = "product_id must be an integer"
+        return row
+    for column, convert in (("sales_amount", float), ("stock_quantity", int)):
+        value = (record.get(column) or "").strip()
+        if not value:
+            continue
+        try:
+            row[column] = convert(value)
+        except ValueError:
+            row["error"] = f"{column} must be a number"
+    return row
+
+# 販売価格・在庫数をまとめて更新するエンドポイント（CSVファイル）
+# 1行目は見出し（product_id,sales_amount,stock_quantity）。価格だけ・在庫数だけの列でもよい
+@app.post("/inventory_products/{organization_id}/bulk_update/csv", tags=["Product Operations"])
+def bulk_update_inventory_csv(organization_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)):
+    try:
+        text = file.file.read().decode("utf-8-sig")  # Excel で保存した BOM 付きのCSVにも対応
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8")
+
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or "product_id" not in reader.fieldnames:
+        raise HTTPException(status_code=400, detail="CSV header must include product_id")
+    rows = [parse_bulk_update_csv_row(reader.line_num, record) for record in reader]
+    try:
+        return apply_bulk_inventory_update(db, organization_id, rows)
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
 #指定された組織IDに紐づくユーザー情報を取得するエンドポイント
 @app.get("/get_user_information/", response_model=list[UserInformationResponse], tags=["DateBase"])
-def get_user_information(organization_id: int, db: Session = Depends(get_db)):
+def get_user_information(organization_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
     try:
         if not isinstance(organization_id, int):
             raise HTTPException(status_code=400, detail="organization_id は整数で指定してください")
-        
-        user_information = db.query(UserInformation).filter(
-            UserInformation.organization_id == organization_id
-        ).all()
+
+        # 前回の取得から変更がなければ 304 を返す
+        headers, not_modified = check_not_modified(request, db, organization_id, "users")
+        if not_modified:
+            return not_modified
+        response.headers.update(headers)
+
+        # ユーザーの一覧はキャッシュから読む（ETag の版と同じ一覧）
+        user_information = get_organization_users(db, organization_id)
 
         if not user_information:
             raise HTTPException(status_code=404, detail="指定された組織にユーザーが見つかりません")
-        
+
         return user_information
     except HTTPException:
         raise
@@ -739,29 +1713,88 @@ def get_user_information(organization_id: int, db: Session = Depends(get_db)):
             detail=f"内部エラーが発生しました: {str(e)}"
         )
 
-#指定された組織IDに紐づくメッセージ情報をすべて取得するエンドポイント
-@app.get("/messages/", tags=["Message Operations"])
-def get_messages(organization_id: int, db: Session = Depends(get_db)):
+# メッセージに付いたコメントをまとめて取得する関数（{message_id: [コメント, ...]} を返す）
+# comments_per_message を指定すると、メッセージごとに新しい順でその件数までに絞る（表示は古い順）
+# 保管したメッセージのコメントは comment_model=ReplyCommentArchive で取得する
+def get_reply_comments_by_message(db, message_ids, comments_per_message=None, comment_model=ReplyComments):
+    comments = {message_id: [] for message_id in message_ids}
+    if not message_ids:
+        return comments
+
+    comment_user_alias = aliased(UserInformation)  # コメントしたユーザー用エイリアス
+    query = (
+        db.query(
+            comment_model.reply_comment_id,
+            comment_model.message_id,
+            comment_model.comment_user_id,
+            comment_model.comment_user_name_manual_input,
+            comment_model.message_content,
+            comment_model.send_date,
+            comment_user_alias.user_name.label("comment_user_name"),  # コメントユーザー名を取得
+        )
+        .outerjoin(comment_user_alias, comment_model.comment_user_id == comment_user_alias.user_id)
+    )
+    if comments_per_message is None:
+        query = query.filter(comment_model.message_id.in_(message_ids))
+    else:
+        # ウィンドウ関数でメッセージごとに新しい順の番号を付け、上限件数までに絞る
+        ranked = (
+            db.query(
+                comment_model.reply_comment_id,
+                func.row_number().over(
+                    partition_by=comment_model.message_id,
+                    order_by=comment_model.reply_comment_id.desc()
+                ).label("position")
+            )
+            .filter(comment_model.message_id.in_(message_ids))
+            .subquery()
+        )
+        query = (
+            query.join(ranked, ranked.c.reply_comment_id == comment_model.reply_comment_id)
+            .filter(ranked.c.position <= comments_per_message)
+        )
+
+    for comment in query.order_by(comment_model.reply_comment_id.asc()).all():  # reply_comment_idの昇順でソート
+        comments[comment.message_id].append(
+            {
+                "reply_comment_id": comment.reply_comment_id,
+                "comment_user_id": comment.comment_user_id,
+                "comment_user_name": comment.comment_user_name,
+                "comment_user_name_manual_input": comment.comment_user_name_manual_input,  # 手入力のコメントユーザー名
+                "message_content": comment.message_content,
+                "send_date": comment.send_date.isoformat() if comment.send_date else None,
+            }
+        )
+    return comments
+
+# 組織のメッセージを一覧用の列（送受信者名・商品名つき）で取得する関数
+# message_model に MessageArchive を渡すと保管したメッセージから取得する
+# limit を指定すると新しい順に limit 件、指定しない場合は全件を message_id の昇順で返す
+def query_organization_messages(db, organization_id, message_model=Message, before_message_id=None, limit=None):
     # UserInformationテーブルのエイリアスを作成
     sender_alias = aliased(UserInformation)
     receiver_alias = aliased(UserInformation)
-    comment_user_alias = aliased(UserInformation)  # コメントしたユーザー用エイリアス
 
-    # クエリの実行
-    messages = (
+    # まずメッセージだけを取得（コメントは別のクエリでまとめて取得するので、行が増えない）
+    query = (
         db.query(
-            Message,
-            IntegratedProduct,
-            IndependentProductMaster,
-            MeitexProductMaster,
-            ReplyComments,
+            message_model.message_id,
+            message_model.sender_user_id,
+            message_model.sender_user_name_manual_input,
+            message_model.receiver_user_id,
+            message_model.receiver_user_name_manual_input,
+            message_model.message_content,
+            message_model.product_id,
+            message_model.send_date,
+            message_model.count_of_likes,
             sender_alias.user_name.label("sender_user_name"),
             receiver_alias.user_name.label("receiver_user_name"),
-            comment_user_alias.user_name.label("comment_user_name"),  # コメントユーザー名を取得
+            func.coalesce(IndependentProductMaster.product_name, MeitexProductMaster.product_name).label("product_name"),
+            func.coalesce(IndependentProductMaster.product_image_url, MeitexProductMaster.product_image_url).label("product_image_url"),
         )
-        .join(sender_alias, Message.sender_user_id == sender_alias.user_id)
-        .join(receiver_alias, Message.receiver_user_id == receiver_alias.user_id)
-        .join(IntegratedProduct, Message.product_id == IntegratedProduct.product_id)
+        .join(sender_alias, message_model.sender_user_id == sender_alias.user_id)
+        .join(receiver_alias, message_model.receiver_user_id == receiver_alias.user_id)
+        .join(IntegratedProduct, message_model.product_id == IntegratedProduct.product_id)
         .outerjoin(
             IndependentProductMaster,
             IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id,
@@ -770,88 +1803,335 @@ def get_messages(organization_id: int, db: Session = Depends(get_db)):
             MeitexProductMaster,
             IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id,
         )
-        .outerjoin(ReplyComments, ReplyComments.message_id == Message.message_id)
-        .outerjoin(comment_user_alias, ReplyComments.comment_user_id == comment_user_alias.user_id)
         .filter(sender_alias.organization_id == organization_id)
         .filter(receiver_alias.organization_id == organization_id)
-        .order_by(ReplyComments.reply_comment_id.asc())  # reply_comment_idの昇順でソート
-        .all()
     )
-
-    if not messages:
+    if before_message_id is not None:
+        query = query.filter(message_model.message_id < before_message_id)
+    if limit is not None:
+        return query.order_by(message_model.message_id.desc()).limit(limit).all()
+    return query.order_by(message_model.message_id.asc()).all()
+
+#指定された組織IDに紐づくメッセージ情報を取得するエンドポイント
+# limit を指定すると新しい順に limit 件ずつ返し、次のページは next_before_message_id を before_message_id に渡して取得する
+# limit を指定しない場合は全件を message_id の昇順で返す
+# include_archived=true の場合は、保管した古いメッセージも合わせて返す（各メッセージに archived が付く）
+@app.get("/messages/", tags=["Message Operations"])
+def get_messages(
+    organization_id: int,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),  # 1ページの件数
+    before_message_id: Optional[int] = Query(None),  # この message_id より古いメッセージを取得（カーソル）
+    comments_per_message: Optional[int] = Query(None, ge=0, le=100),  # メッセージごとのコメント数の上限
+    include_archived: bool = Query(False),  # 保管したメッセージも含めるか
+    db: Session = Depends(get_db)
+):
+    # 前回の取得から変更がなければ 304 を返す（メッセージの検索はしない）
+    # ※ 書き込み待ちのいいね数は、書き込み時に更新番号が増えるまで ETag に反映されない
+    headers, not_modified = check_not_modified(request, db, organization_id, "messages")
+    if not_modified:
+        return not_modified
+    response.headers.update(headers)
+
+    messages = query_organization_messages(db, organization_id, Message, before_message_id, limit)
+    archived_ids = set()
+    if include_archived:
+        # 保管分も同じ条件で取得し、message_id の順に並べて結合する
+        archived = query_organization_messages(db, organization_id, MessageArchive, before_message_id, limit)
+        archived_ids = {message.message_id for message in archived}
+        messages = sorted(messages + archived, key=lambda message: message.message_id, reverse=limit is not None)
+        if limit is not None:
+            messages = messages[:limit]
+
+    if not messages and before_message_id is None:
         raise HTTPException(status_code=404, detail="No messages found for this organization")
 
+    # ページ内のメッセージのコメントを1回のクエリで取得（保管分は保管テーブルから）
+    message_ids = [message.message_id for message in messages]
+    comments = {}
+    comment_counts = {}
+    for comment_model, ids in (
+        (ReplyComments, [message_id for message_id in message_ids if message_id not in archived_ids]),
+        (ReplyCommentArchive, [message_id for message_id in message_ids if message_id in archived_ids]),
+    ):
+        if not ids:
+            continue
+        comments.update(get_reply_comments_by_message(db, ids, comments_per_message, comment_model))
+
+        # 上限を指定した場合は、メッセージごとのコメントの総数も返す
+        if comments_per_message is not None:
+            comment_counts.update(
+                db.query(comment_model.message_id, func.count(comment_model.reply_comment_id))
+                .filter(comment_model.message_id.in_(ids))
+                .group_by(comment_model.message_id)
+                .all()
+            )
+
     # メッセージごとのデータを構造化
-    result = {}
+    result = []
     for message in messages:
-        message_id = message.Message.message_id
-        if message_id not in result:
-            result[message_id] = {
-                "message_id": message.Message.message_id,
-                "sender_user_id": message.Message.sender_user_id,
-                "sender_user_name": message.sender_user_name,
-                "sender_user_name_manual_input": message.Message.sender_user_name_manual_input,  # 手入力の送信者名
-                "receiver_user_id": message.Message.receiver_user_id,
-                "receiver_user_name": message.receiver_user_name,
-                "receiver_user_name_manual_input": message.Message.receiver_user_name_manual_input,  # 手入力の受信者名
-                "message_content": message.Message.message_content,
-                "product_id": message.Message.product_id,
-                "product_name": (
-                    message.IndependentProductMaster.product_name
-                    if message.IndependentProductMaster
-                    else None
-                )
-                or (
-                    message.MeitexProductMaster.product_name
-                    if message.MeitexProductMaster
-                    else None
-                ),
-                "product_image_url": (
-                    message.IndependentProductMaster.product_image_url
-                    if message.IndependentProductMaster
-                    else None
-                )
-                or (
-                    message.MeitexProductMaster.product_image_url
-                    if message.MeitexProductMaster
-                    else None
-                ),
-                "send_date": message.Message.send_date.isoformat()
-                if message.Message.send_date
-                else None,
-                "reply_comments": [],
-                "count_of_likes": message.Message.count_of_likes,
-            }
-
-        # コメントを追加
-        if message.ReplyComments:
-            result[message_id]["reply_comments"].append(
-                {
-                    "reply_comment_id": message.ReplyComments.reply_comment_id,
-                    "comment_user_id": message.ReplyComments.comment_user_id,
-                    "comment_user_name": message.comment_user_name,
-                    "comment_user_name_manual_input": message.ReplyComments.comment_user_name_manual_input,  # 手入力のコメントユーザー名
-                    "message_content": message.ReplyComments.message_content,
-                    "send_date": message.ReplyComments.send_date.isoformat()
-                    if message.ReplyComments.send_date
-                    else None,
-                }
-            )
+        item = {
+            "message_id": message.message_id,
+            "sender_user_id": message.sender_user_id,
+            "sender_user_name": message.sender_user_name,
+            "sender_user_name_manual_input": message.sender_user_name_manual_input,  # 手入力の送信者名
+            "receiver_user_id": message.receiver_user_id,
+            "receiver_user_name": message.receiver_user_name,
+            "receiver_user_name_manual_input": message.receiver_user_name_manual_input,  # 手入力の受信者名
+            "message_content": message.message_content,
+            "product_id": message.product_id,
+            "product_name": message.product_name,
+            "product_image_url": message.product_image_url,
+            "send_date": message.send_date.isoformat() if message.send_date else None,
+            "reply_comments": comments[message.message_id],
+            # まだデータベースに書き込まれていないいいね数も加算する
+            "count_of_likes": (message.count_of_likes or 0) + (like_buffer.pending(message.message_id) if like_buffer else 0),
+        }
+        if comments_per_message is not None:
+            item["reply_comment_count"] = comment_counts.get(message.message_id, 0)
+        if include_archived:
+            item["archived"] = message.message_id in archived_ids
+        result.append(item)
+
+    data = {"messages": result}
+    if limit is not None:
+        # 次のページのカーソル（最後のページなら None）
+        data["next_before_message_id"] = message_ids[-1] if len(message_ids) == limit else None
+    return data
+
+# 集計値を1つ取得する関数（行がなければ0）
+def get_dashboard_counter(db, organization_id, counter_type, counter_key=""):
+    value = db.query(DashboardCounter.counter_value).filter_by(
+        organization_id=organization_id, counter_type=counter_type, counter_key=counter_key
+    ).scalar()
+    return value or 0
+
+# 集計用テーブルの値に n を加算する関数（UPDATE ... SET 列 = 列 + n、行がなければ追加）
+# keys には主キーの値を渡す
+def increment_counter_row(db, model, value_column, keys, n=1):
+    updated = db.query(model).filter_by(**keys).update(
+        {value_column: value_column + n}, synchronize_session=False
+    )
+    if updated:
+        return
+    try:
+        with db.begin_nested():  # セーブポイント（同時に同じ行が追加された場合はこの部分だけ取り消す）
+            db.add(model(**{value_column.key: n}, **keys))
+    except IntegrityError:
+        db.query(model).filter_by(**keys).update({value_column: value_column + n}, synchronize_session=False)
+
+# ダッシュボードの集計値に n を加算する関数
+def increment_dashboard_counter(db, organization_id, counter_type, counter_key, n=1):
+    increment_counter_row(
+        db, DashboardCounter, DashboardCounter.counter_value,
+        dict(organization_id=organization_id, counter_type=counter_type, counter_key=counter_key), n
+    )
 
-    return {"messages": list(result.values())}
+# 組織の集計値が作成済みかどうかを返す関数（目印の行 counter_type="initialized" の値が 1）
+def dashboard_counters_initialized(db, organization_id):
+    return bool(db.query(DashboardCounter.counter_value).filter_by(
+        organization_id=organization_id, counter_type="initialized", counter_key=""
+    ).scalar())
+
+# 組織の集計値の目印の行をロックし、集計値が作成済みかどうかを返す関数（コミットするまでロックしたまま）
+# メッセージの追加と集計値の作成をこのロックで順番に実行し、作成中に追加されたメッセージが
+# 作成時の集計にも追加時の加算にも含まれない、ということが起きないようにする
+# ロックは何も変えない UPDATE で取る（MySQL では行ロック、SQLite ではデータベースの書き込みロックになる）
+# 目印の行がなければ 0（未作成）で追加する
+def lock_dashboard_counters(db, organization_id):
+    keys = dict(organization_id=organization_id, counter_type="initialized", counter_key="")
+    def lock():
+        return db.query(DashboardCounter).filter_by(**keys).update(
+            {DashboardCounter.counter_value: DashboardCounter.counter_value}, synchronize_session=False
+        )
+    if not lock():
+        try:
+            with db.begin_nested():  # セーブポイント（同時に追加された場合はこの部分だけ取り消す）
+                db.add(DashboardCounter(counter_value=0, **keys))
+        except IntegrityError:
+            lock()
+    # ロックを待っている間にコミットされた値を読むため、FOR UPDATE を付けて読む（MySQL の一貫性読み取りでは古い値が見えるため）
+    return bool(db.query(DashboardCounter.counter_value).filter_by(**keys).with_for_update().scalar())
+
+# メッセージ追加時に送信者側（送信者の組織）の集計値を更新する関数
+# 集計値がまだ作成されていない組織は、初回表示時にまとめて作成するのでここでは加算しない
+def increment_sender_counters(db, organization_id, sender_name, product_id, send_date):
+    if not lock_dashboard_counters(db, organization_id):
+        return
+    increment_dashboard_counter(db, organization_id, "total", "")
+    if sender_name:
+        increment_dashboard_counter(db, organization_id, "sender", sender_name[:255])
+    if product_id is not None:
+        increment_dashboard_counter(db, organization_id, "product", str(product_id))
+        # 日ごとの商品別メッセージ数
+        increment_counter_row(
+            db, ProductDailyCount, ProductDailyCount.message_count,
+            dict(organization_id=organization_id, count_date=send_date.date(), product_id=product_id)
+        )
 
-#指定された組織IDに紐づくメッセージの回数を取得するエンドポイント
-@app.get("/send_messages/count/", tags=["DashBoard"])
-def get_messages_count(organization_id: int, db: Session = Depends(get_db)):
-    try:
-        messages_count = (
-            db.query(func.count(Message.message_id))
-            .join(UserInformation,
-                (Message.sender_user_id == UserInformation.user_id) 
-            )
+# メッセージ追加時に受信者側（受信者の組織）の集計値を更新する関数
+def increment_receiver_counters(db, organization_id, receiver_name):
+    if not receiver_name or not lock_dashboard_counters(db, organization_id):
+        return
+    increment_dashboard_counter(db, organization_id, "receiver", receiver_name[:255])
+
+# メッセージテーブル（と保管テーブル）から組織の集計値を計算する関数（{(counter_type, counter_key): 値} を返す）
+def compute_dashboard_counters(db, organization_id):
+    expected = {("initialized", ""): 1}
+    total = 0
+
+    # 保管した古いメッセージも数える（集計値は全期間の値のため）
+    for message_model in (Message, MessageArchive):
+        sender_name = func.coalesce(func.nullif(UserInformation.user_name, ""), message_model.sender_user_name_manual_input)
+        for name, count in (
+            db.query(sender_name, func.count(message_model.message_id))
+            .join(UserInformation, message_model.sender_user_id == UserInformation.user_id)
             .filter(UserInformation.organization_id == organization_id)
-            .scalar()
+            .group_by(sender_name)
+            .all()
+        ):
+            total += count
+            if name:
+                key = ("sender", name[:255])
+                expected[key] = expected.get(key, 0) + count
+
+        receiver_name = func.coalesce(func.nullif(UserInformation.user_name, ""), message_model.receiver_user_name_manual_input)
+        for name, count in (
+            db.query(receiver_name, func.count(message_model.message_id))
+            .join(UserInformation, message_model.receiver_user_id == UserInformation.user_id)
+            .filter(UserInformation.organization_id == organization_id)
+            .group_by(receiver_name)
+            .all()
+        ):
+            if name:
+                key = ("receiver", name[:255])
+                expected[key] = expected.get(key, 0) + count
+
+        for product_id, count in (
+            db.query(message_model.product_id, func.count(message_model.message_id))
+            .join(UserInformation, message_model.sender_user_id == UserInformation.user_id)
+            .filter(UserInformation.organization_id == organization_id)
+            .filter(message_model.product_id.isnot(None))
+            .group_by(message_model.product_id)
+            .all()
+        ):
+            key = ("product", str(product_id))
+            expected[key] = expected.get(key, 0) + count
+
+    expected[("total", "")] = total
+    return expected
+
+# メッセージテーブル（と保管テーブル）から商品ごと・日ごとのメッセージ数を計算する関数（{(商品ID, 日付): 値} を返す）
+def compute_product_daily_counts(db, organization_id):
+    daily_counts = {}
+    for message_model in (Message, MessageArchive):
+        send_day = func.date(message_model.send_date)
+        for product_id, count_date, count in (
+            db.query(message_model.product_id, send_day, func.count(message_model.message_id))
+            .join(UserInformation, message_model.sender_user_id == UserInformation.user_id)
+            .filter(UserInformation.organization_id == organization_id)
+            .filter(message_model.product_id.isnot(None))
+            .group_by(message_model.product_id, send_day)
+            .all()
+        ):
+            if isinstance(count_date, str):  # SQLite では文字列で返る
+                count_date = date.fromisoformat(count_date)
+            key = (product_id, count_date)
+            daily_counts[key] = daily_counts.get(key, 0) + count
+    return daily_counts
+
+# 集計値をメッセージテーブルと照合し、必要なら作り直す関数
+# verify_only=True の場合は差分を返すだけで書き換えない
+# 作り直す場合は、メッセージを読む前に目印の行をロックする（ロックを取るまで前のトランザクションの結果を読まないよう、先にコミットしておく）
+def rebuild_dashboard_counters(db, organization_id, verify_only=False):
+    if not verify_only:
+        db.commit()
+        lock_dashboard_counters(db, organization_id)
+    expected = compute_dashboard_counters(db, organization_id)
+    stored = {
+        (row.counter_type, row.counter_key): row.counter_value
+        for row in db.query(DashboardCounter).filter(DashboardCounter.organization_id == organization_id).all()
+    }
+    mismatches = []
+    for counter_type, counter_key in sorted(set(stored) | set(expected)):
+        stored_value = stored.get((counter_type, counter_key), 0)
+        expected_value = expected.get((counter_type, counter_key), 0)
+        if stored_value != expected_value:
+            mismatches.append({
+                "counter_type": counter_type,
+                "counter_key": counter_key,
+                "stored": stored_value,
+                "expected": expected_value,
+            })
+
+    # 日ごとの商品別メッセージ数も照合する
+    expected_daily = compute_product_daily_counts(db, organization_id)
+    stored_daily = {
+        (row.product_id, row.count_date): row.message_count
+        for row in db.query(ProductDailyCount).filter(ProductDailyCount.organization_id == organization_id).all()
+    }
+    for product_id, count_date in sorted(set(stored_daily) | set(expected_daily)):
+        stored_value = stored_daily.get((product_id, count_date), 0)
+        expected_value = expected_daily.get((product_id, count_date), 0)
+        if stored_value != expected_value:
+            mismatches.append({
+                "counter_type": "product_daily",
+                "counter_key": f"{product_id}:{count_date.isoformat()}",
+                "stored": stored_value,
+                "expected": expected_value,
+            })
+
+    if mismatches and not verify_only:
+        # 組織の集計値を入れ替え、目印の行を作成済み（1）にする（ロックしたまま同じトランザクション内で）
+        db.query(DashboardCounter).filter(
+            DashboardCounter.organization_id == organization_id, DashboardCounter.counter_type != "initialized"
+        ).delete(synchronize_session=False)
+        db.query(ProductDailyCount).filter(ProductDailyCount.organization_id == organization_id).delete(synchronize_session=False)
+        db.add_all([
+            DashboardCounter(organization_id=organization_id, counter_type=counter_type, counter_key=counter_key, counter_value=value)
+            for (counter_type, counter_key), value in expected.items()
+            if counter_type != "initialized"
+        ])
+        db.add_all([
+            ProductDailyCount(organization_id=organization_id, product_id=product_id, count_date=count_date, message_count=value)
+            for (product_id, count_date), value in expected_daily.items()
+        ])
+        db.query(DashboardCounter).filter_by(organization_id=organization_id, counter_type="initialized", counter_key="").update(
+            {DashboardCounter.counter_value: 1}, synchronize_session=False
         )
+    if not verify_only:
+        db.commit()  # ロックを解放する
+
+    return {"organization_id": organization_id, "mismatches": mismatches, "rebuilt": bool(mismatches) and not verify_only}
+
+# 集計値がまだない組織は、メッセージテーブルから作成する関数（初回表示時に1度だけ実行される）
+# 同時に別のリクエストが作成していた場合は、ロックが外れた後の照合で差分がなくなるので書き換えない
+def ensure_dashboard_counters(db, organization_id):
+    if dashboard_counters_initialized(db, organization_id):
+        return
+    rebuild_dashboard_counters(db, organization_id)
+
+# ダッシュボードの集計値をメッセージテーブルと照合・再作成するエンドポイント
+@app.post("/api/dashboard/counters/rebuild", tags=["DashBoard"])
+def rebuild_dashboard_counters_endpoint(
+    organization_id: int = Query(...),
+    verify_only: bool = Query(False),  # True なら差分の確認だけ行う
+    db: Session = Depends(get_db)
+):
+    try:
+        return rebuild_dashboard_counters(db, organization_id, verify_only=verify_only)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+#指定された組織IDに紐づくメッセージの回数を取得するエンドポイント
+@app.get("/send_messages/count/", tags=["DashBoard"])
+def get_messages_count(organization_id: int, db: Session = Depends(get_db)):
+    try:
+        # メッセージ数は dashboard_counters に集計済み
+        ensure_dashboard_counters(db, organization_id)
+        messages_count = get_dashboard_counter(db, organization_id, "total")
         
         return {
             "organization_id": organization_id,
@@ -864,36 +2144,605 @@ def get_messages_count(organization_id: int, db: Session = Depends(get_db)):
             detail=f"メッセージ数の取得中にエラーが発生しました: {str(e)}"
         )
 
+# 2人のユーザーIDを会話のキー（小さい方, 大きい方）に並べ替える関数
+def conversation_user_pair(user_id_a, user_id_b):
+    return (user_id_a, user_id_b) if user_id_a <= user_id_b else (user_id_b, user_id_a)
+
+# メッセージを会話の対応表に登録する関数（呼び出し元のトランザクションでコミットする）
+def add_message_conversation(db, message):
+    user_low_id, user_high_id = conversation_user_pair(message.sender_user_id, message.receiver_user_id)
+    db.add(MessageConversation(
+        message_id=message.message_id,
+        user_low_id=user_low_id,
+        user_high_id=user_high_id,
+        product_id=message.product_id,
+    ))
+
+# 会話の対応表に登録されていない既存メッセージをまとめて登録する関数（起動時に一度だけ自動で実行する）
+def backfill_message_conversations(db, batch_size=1000):
+    registered = 0
+    last_message_id = 0
+    while True:
+        rows = (
+            db.query(Message.message_id, Message.sender_user_id, Message.receiver_user_id, Message.product_id)
+            .filter(Message.message_id > last_message_id)
+            .filter(~(
+                db.query(MessageConversation.message_id)
+                .filter(MessageConversation.message_id == Message.message_id)
+                .exists()
+            ))
+            .order_by(Message.message_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        for row in rows:
+            add_message_conversation(db, row)
+        db.commit()  # バッチごとに確定
+        registered += len(rows)
+        last_message_id = rows[-1].message_id
+    return {"registered_messages": registered}
+
 #メッセージを取得するエンドポイント
+# 2人のユーザーと商品の会話を新しい順に返す（送信者・受信者の向きは問わない）
+# limit を指定すると limit 件ずつ返し、次のページは next_before_message_id を before_message_id に渡して取得する
 @app.get("/get_messages/", tags=["Message Operations"])
-def get_messages(sender_user_id: int, receiver_user_id: int, product_id: int, db: Session = Depends(get_db)):
-    messages = db.query(Message).filter(
-        ((Message.sender_user_id == sender_user_id) & (Message.receiver_user_id == receiver_user_id) & (Message.product_id == product_id)) |
-        ((Message.sender_user_id == receiver_user_id) & (Message.receiver_user_id == sender_user_id) & (Message.product_id == product_id))
-    ).order_by(Message.send_date.desc()).all()
-    
+def get_messages(
+    sender_user_id: int,
+    receiver_user_id: int,
+    product_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=200),  # 1ページの件数
+    before_message_id: Optional[int] = Query(None),  # この message_id より古いメッセージを取得（カーソル）
+    include_archived: bool = Query(False),  # 保管したメッセージも含めるか
+    db: Session = Depends(get_db)
+):
+    user_low_id, user_high_id = conversation_user_pair(sender_user_id, receiver_user_id)
+
+    # 会話の対応表の複合インデックスで絞り込み、必要な列だけを取得する（ユーザー情報は読み込まない）
+    query = (
+        db.query(
+            Message.message_id,
+            Message.sender_user_id,
+            Message.sender_user_name_manual_input,
+            Message.receiver_user_id,
+            Message.receiver_user_name_manual_input,
+            Message.product_id,
+            Message.message_content,
+            Message.send_date,
+            Message.count_of_likes,
+        )
+        .join(MessageConversation, MessageConversation.message_id == Message.message_id)
+        .filter(
+            MessageConversation.user_low_id == user_low_id,
+            MessageConversation.user_high_id == user_high_id,
+            MessageConversation.product_id == product_id,
+        )
+    )
+    if before_message_id is not None:
+        query = query.filter(MessageConversation.message_id < before_message_id)
+    query = query.order_by(MessageConversation.message_id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    messages = [ConversationMessageResponse.from_orm(message) for message in query.all()]
+
+    if include_archived:
+        # 保管したメッセージは会話の対応表がないので、送信者・受信者の両方向で検索する
+        archived_query = (
+            db.query(
+                MessageArchive.message_id,
+                MessageArchive.sender_user_id,
+                MessageArchive.sender_user_name_manual_input,
+                MessageArchive.receiver_user_id,
+                MessageArchive.receiver_user_name_manual_input,
+                MessageArchive.product_id,
+                MessageArchive.message_content,
+                MessageArchive.send_date,
+                MessageArchive.count_of_likes,
+            )
+            .filter(
+                ((MessageArchive.sender_user_id == sender_user_id) & (MessageArchive.receiver_user_id == receiver_user_id)) |
+                ((MessageArchive.sender_user_id == receiver_user_id) & (MessageArchive.receiver_user_id == sender_user_id))
+            )
+            .filter(MessageArchive.product_id == product_id)
+        )
+        if before_message_id is not None:
+            archived_query = archived_query.filter(MessageArchive.message_id < before_message_id)
+        archived_query = archived_query.order_by(MessageArchive.message_id.desc())
+        if limit is not None:
+            archived_query = archived_query.limit(limit)
+        messages += [ConversationMessageResponse.from_orm(message) for message in archived_query.all()]
+        messages.sort(key=lambda message: message.message_id, reverse=True)
+        if limit is not None:
+            messages = messages[:limit]
+
+    # limit を指定した場合はページ単位で返す
+    if limit is not None:
+        return ConversationPageResponse(
+            messages=messages,
+            next_before_message_id=messages[-1].message_id if len(messages) == limit else None,
+        )
+
     if not messages:
         return {"message": "No messages found between the specified users."}
     
     return messages
 
+# 会話の対応表に既存メッセージを登録するエンドポイント
+@app.post("/api/messages/conversations/backfill", tags=["Message Operations"])
+def backfill_conversations(db: Session = Depends(get_db)):
+    try:
+        return backfill_message_conversations(db)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 会話の対応表を導入する前のメッセージを、起動時に一度だけ登録する
+# （手動でバックフィルを呼ばなくても、既存の会話が /get_messages/ に出るようにする）
+@app.on_event("startup")
+def start_message_conversations_backfill():
+    start_maintenance_task("message_conversations_backfill", backfill_message_conversations)
+
+# 古いメッセージを保管テーブルへ移す日数（送信から この日数より前のメッセージが対象）
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", 365))
+
+# 送信から older_than_days 日より前のメッセージとそのコメントを保管テーブルへ移す関数
+# 移したメッセージの単語と全文検索の文書長は保管用のテーブルへ移し（include_archived を指定すると検索・ワードクラウドに含まれる）、
+# 会話の対応表・いいねの記録は削除し、月ごとの集計値を保管用の集計表に加算する
+# 最新のメッセージ（とコメント）はIDの再利用を防ぐため保管しない
+# ダッシュボードの集計値（全期間）はそのまま残す
+def archive_old_messages(db, older_than_days, organization_id=None, batch_size=500):
+    archived_at = datetime.now(japan_timezone).replace(tzinfo=None)
+    cutoff = archived_at - timedelta(days=older_than_days)
+    message_columns = [
+        "message_id", "sender_user_id", "sender_user_name_manual_input", "receiver_user_id",
+        "receiver_user_name_manual_input", "product_id", "message_content", "send_date", "count_of_likes",
+    ]
+    comment_columns = [
+        "reply_comment_id", "message_id", "comment_user_id", "comment_user_name_manual_input",
+        "message_content", "send_date",
+    ]
+    archived_messages = 0
+    archived_comments = 0
+    organization_ids = set()
+
+    # ID が最大のメッセージと、ID が最大のコメントが付いたメッセージは保管しない
+    # （SQLite などでは最大の行を削除すると同じIDが新しいメッセージに再利用され、次回の保管時に保管テーブルのIDと重なるため）
+    keep_message_ids = {
+        db.query(func.max(Message.message_id)).scalar(),
+        db.query(ReplyComments.message_id).order_by(ReplyComments.reply_comment_id.desc()).limit(1).scalar(),
+    } - {None}
+
+    while True:
+        query = (
+            db.query(
+                Message.message_id,
+                Message.product_id,
+                Message.send_date,
+                Message.count_of_likes,
+                UserInformation.organization_id,
+            )
+            .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
+            .filter(Message.send_date < cutoff)
+        )
+        if keep_message_ids:
+            query = query.filter(Message.message_id.notin_(keep_message_ids))
+        if organization_id is not None:
+            query = query.filter(UserInformation.organization_id == organization_id)
+        rows = query.order_by(Message.message_id).limit(batch_size).all()
+        if not rows:
+            break
+        message_ids = [row.message_id for row in rows]
+
+        # メッセージとコメントを保管テーブルへコピー
+        message_table = Message.__table__
+        comment_table = ReplyComments.__table__
+        db.execute(
+            insert(MessageArchive.__table__).from_select(
+                message_columns + ["archived_at"],
+                select(*[message_table.c[name] for name in message_columns], literal(archived_at, DateTime))
+                .where(message_table.c.message_id.in_(message_ids)),
+            )
+        )
+        db.execute(
+            insert(ReplyCommentArchive.__table__).from_select(
+                comment_columns,
+                select(*[comment_table.c[name] for name in comment_columns])
+                .where(comment_table.c.message_id.in_(message_ids)),
+            )
+        )
+        # 単語と文書長も保管テーブルへ移す（保管後もワードクラウドと全文検索で include_archived を指定すれば使える）
+        for source, target, columns in (
+            (MessageTerm, MessageTermArchive, ["message_id", "reply_comment_id", "organization_id", "product_id", "term", "term_count"]),
+            (SearchDocument, SearchDocumentArchive, ["organization_id", "message_id", "reply_comment_id", "document_length"]),
+        ):
+            source_table = source.__table__
+            db.execute(
+                insert(target.__table__).from_select(
+                    columns,
+                    select(*[source_table.c[name] for name in columns]).where(source_table.c.message_id.in_(message_ids)),
+                )
+            )
+
+        # 月ごとの集計値を計算して加算
+        comment_counts = dict(
+            db.query(ReplyComments.message_id, func.count(ReplyComments.reply_comment_id))
+            .filter(ReplyComments.message_id.in_(message_ids))
+            .group_by(ReplyComments.message_id)
+            .all()
+        )
+        summary = Counter()
+        for row in rows:
+            period = row.send_date.strftime("%Y-%m")
+            summary[(row.organization_id, period, "messages", "")] += 1
+            summary[(row.organization_id, period, "comments", "")] += comment_counts.get(row.message_id, 0)
+            summary[(row.organization_id, period, "likes", "")] += row.count_of_likes or 0
+            if row.product_id is not None:
+                summary[(row.organization_id, period, "product", str(row.product_id))] += 1
+        for (summary_organization_id, period, counter_type, counter_key), value in summary.items():
+            if value:
+                increment_counter_row(
+                    db, MessageArchiveSummary, MessageArchiveSummary.counter_value,
+                    dict(organization_id=summary_organization_id, period=period, counter_type=counter_type, counter_key=counter_key),
+                    value,
+                )
+
+        # 元のテーブルから削除（外部キーで参照している行から順に）
+        for model in (MessageTerm, SearchDocument, MessageConversation, Likes, ReplyComments, Message):
+            db.query(model).filter(model.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+        # メッセージ一覧の更新番号を増やす
+        batch_organization_ids = {row.organization_id for row in rows}
+        for changed_organization_id in batch_organization_ids:
+            bump_change_version(db, changed_organization_id, "messages")
+
+        db.commit()  # バッチごとに確定
+        archived_messages += len(rows)
+        archived_comments += sum(comment_counts.values())
+        organization_ids |= batch_organization_ids
+
+    # 単語を保管テーブルへ移したので、ワードクラウドを作り直す
+    for changed_organization_id in organization_ids:
+        wordcloud_image_cache.invalidate(changed_organization_id)
+
+    return {"archived_messages": archived_messages, "archived_comments": archived_comments, "cutoff": cutoff.isoformat()}
+
+# 古いメッセージを保管テーブルへ移すエンドポイント（定期的に実行する）
+@app.post("/api/messages/archive", tags=["Message Operations"])
+def archive_messages(
+    organization_id: Optional[int] = Query(None),
+    older_than_days: int = Query(MESSAGE_ARCHIVE_AFTER_DAYS, ge=1),
+    db: Session = Depends(get_db)
+):
+    try:
+        return archive_old_messages(db, older_than_days, organization_id)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 保管したメッセージの月ごとの集計値を返すエンドポイント
+@app.get("/api/messages/archive/summary", tags=["Message Operations"])
+def get_archive_summary(organization_id: int, db: Session = Depends(get_db)):
+    try:
+        periods = {}
+        for row in (
+            db.query(MessageArchiveSummary)
+            .filter(MessageArchiveSummary.organization_id == organization_id)
+            .order_by(MessageArchiveSummary.period)
+            .all()
+        ):
+            period = periods.setdefault(row.period, {"period": row.period, "messages": 0, "comments": 0, "likes": 0, "products": {}})
+            if row.counter_type == "product":
+                period["products"][row.counter_key] = row.counter_value
+            else:
+                period[row.counter_type] = row.counter_value
+        return list(periods.values())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 組織ごとのメッセージのイベント（新規メッセージ・コメント・いいね）を配信する仕組み（pub/sub）
+# 書き込み系のエンドポイントが publish し、SSE / WebSocket の接続がイベントを受け取る
+# ※ プロセス内で配信するため、複数ワーカーで動かす場合は同じワーカーに接続したクライアントにだけ届く
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", 200))  # 再接続時に再送できる直近のイベント数（組織ごと）
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 100))  # 1接続あたりの未送信イベントの上限
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", 15))  # 接続維持のためのハートビート間隔
+
+# 1つの接続（購読者）
+class EventSubscriber:
+    def __init__(self, organization_id, queue_size):
+        self.organization_id = organization_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.lagged = False  # 受信が追いつかずイベントを取りこぼした場合 True
+        self.after_sequence = 0  # 購読開始時点の連番（これ以前のイベントは再送で送るので、キューには入れない）
+
+class OrganizationEventHub:
+    def __init__(self, replay_size, queue_size):
+        self.replay_size = replay_size
+        self.queue_size = queue_size
+        # イベントIDは「起動ごとの識別子:組織ごとの連番」。再起動後に古いIDで再接続された場合を判別するため
+        self.epoch = uuid.uuid4().hex[:8]
+        self._sequences = {}  # 組織ID -> 最後のイベントの連番
+        self._replay = {}  # 組織ID -> 直近のイベント（deque）
+        self._subscribers = {}  # 組織ID -> 購読者の集合
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def attach_loop(self, loop):
+        # イベントループ（アプリ起動時に設定）。スレッドから安全にイベントを渡すために使う
+        self._loop = loop
+
+    def publish(self, organization_id, event_type, data):
+        # 同期エンドポイント（スレッドプール）からも呼べる
+        with self._lock:
+            sequence = self._sequences.get(organization_id, 0) + 1
+            self._sequences[organization_id] = sequence
+            event = {"id": f"{self.epoch}:{sequence}", "type": event_type, "data": data}
+            self._replay.setdefault(organization_id, deque(maxlen=self.replay_size)).append(event)
+            subscribers = list(self._subscribers.get(organization_id, ()))  # ロックの中で購読者をコピーする
+        if self._loop is not None and subscribers:
+            self._loop.call_soon_threadsafe(self._dispatch, subscribers, sequence, event)
+
+    def _dispatch(self, subscribers, sequence, event):
+        # イベントループ上で各購読者のキューに入れる
+        for subscriber in subscribers:
+            if subscriber.lagged or sequence <= subscriber.after_sequence:
+                continue  # 購読開始時の再送に含まれるイベントは二重に送らない
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # 受信が遅い接続はそれ以上溜めず、再接続（最後のイベントIDからの再送）を促す
+                subscriber.lagged = True
+
+    def subscribe(self, organization_id, last_event_id=None):
+        # 購読を開始し、(購読者, 再送するイベント, 再送しきれない場合 True) を返す
+        subscriber = EventSubscriber(organization_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(organization_id, set()).add(subscriber)
+            replay = list(self._replay.get(organization_id, ()))
+            subscriber.after_sequence = self._sequences.get(organization_id, 0)
+        if not last_event_id:
+            return subscriber, [], False
+
+        epoch, _, sequence = last_event_id.partition(":")
+        if epoch != self.epoch or not sequence.isdigit():
+            return subscriber, [], True  # 再起動前のIDなど、続きが分からない
+        sequence = int(sequence)
+        missed = [event for event in replay if int(event["id"].split(":")[1]) > sequence]
+        # 再送用のバッファから既に消えたイベントがある場合（連番は組織ごとなので、最古のイベントとの間が空いていれば取りこぼしがある）
+        # この組織ではまだ使われていない連番の場合も、続きが分からないので reset にする
+        reset = sequence > subscriber.after_sequence or (bool(replay) and int(replay[0]["id"].split(":")[1]) > sequence + 1)
+        return subscriber, missed, reset
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.organization_id)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.organization_id]
+
+message_event_hub = OrganizationEventHub(EVENT_REPLAY_SIZE, EVENT_QUEUE_SIZE)
+
+# アプリ起動時にイベントループを設定する
+@app.on_event("startup")
+async def attach_message_event_hub():
+    message_event_hub.attach_loop(asyncio.get_running_loop())
+
+# 購読者がイベントを受け取るまで待つ関数（ハートビート間隔を過ぎたら None を返す）
+async def wait_for_event(subscriber):
+    try:
+        return await asyncio.wait_for(subscriber.queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+
+# SSE（Server-Sent Events）で組織のメッセージのイベントを配信するエンドポイント
+# 再接続時はブラウザが送る Last-Event-ID ヘッダー（または last_event_id パラメーター）以降のイベントを再送する
+# event: reset が届いた場合は再送しきれない取りこぼしがあるので、クライアントは /messages/ を取得し直す
+@app.get("/api/messages/stream", tags=["Message Operations"])
+async def stream_message_events(
+    request: Request,
+    organization_id: int = Query(...),
+    last_event_id: Optional[str] = Query(None),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    subscriber, missed, reset = message_event_hub.subscribe(organization_id, last_event_id_header or last_event_id)
+
+    def format_event(event):
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+    async def event_stream():
+        try:
+            yield f"retry: 3000\n\n"
+            if reset:
+                yield "event: reset\ndata: {}\n\n"
+            for event in missed:
+                yield format_event(event)
+            while not await request.is_disconnected():
+                event = await wait_for_event(subscriber)
+                if event is not None:
+                    yield format_event(event)
+                if subscriber.lagged and subscriber.queue.empty():
+                    # 受信が追いつかなかったので接続を閉じる
+                    # ブラウザは Last-Event-ID を付けて自動で再接続し、取りこぼした分は再送される
+                    break
+                if event is None:
+                    yield ": heartbeat\n\n"  # コメント行（接続維持用）
+        finally:
+            message_event_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# WebSocketで組織のメッセージのイベントを配信するエンドポイント
+# 送信するJSON: {"id": ..., "type": "message" / "comment" / "like" / "reset" / "heartbeat", "data": {...}}
+# 再接続時は最後に受け取ったイベントIDを last_event_id パラメーターに付ける
+@app.websocket("/ws/messages/{organization_id}")
+async def websocket_message_events(websocket: WebSocket, organization_id: int, last_event_id: Optional[str] = None):
+    await websocket.accept()
+    subscriber, missed, reset = message_event_hub.subscribe(organization_id, last_event_id)
+    try:
+        if reset:
+            await websocket.send_json({"type": "reset", "data": {}})
+        for event in missed:
+            await websocket.send_json(event)
+        while True:
+            event = await wait_for_event(subscriber)
+            await websocket.send_json(event or {"type": "heartbeat", "data": {}})
+            if subscriber.lagged and subscriber.queue.empty():
+                # 受信が追いつかなかったので接続を閉じる（最後に受け取ったイベントIDを last_event_id に付けて再接続してもらう）
+                await websocket.close(code=1013)
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        message_event_hub.unsubscribe(subscriber)
+
+# いいね数を count_of_likes = count_of_likes + n でまとめて加算する関数（{message_id: n} を渡す）
+# 読み込んでから書き込むのではなく1つのUPDATE文で加算するので、同時にいいねされても数がずれない
+def apply_like_increments(db, increments):
+    if not increments:
+        return
+    message_table = Message.__table__
+    db.execute(
+        update(message_table)
+        .where(message_table.c.message_id == bindparam("target_message_id"))
+        .values(count_of_likes=func.coalesce(message_table.c.count_of_likes, 0) + bindparam("increment")),
+        [{"target_message_id": message_id, "increment": n} for message_id, n in increments.items()],
+    )
+
+# いいねをメモリ上で集約し、一定間隔でまとめてデータベースに書き込む仕組み（write-behind）
+# LIKE_FLUSH_INTERVAL_SECONDS が 0 の場合は使わず、いいねのたびに書き込む
+# ユーザーを指定したいいね（Likes に記録するもの）は、記録と同じトランザクションで書き込むので集約しない
+LIKE_FLUSH_INTERVAL_SECONDS = float(os.getenv("LIKE_FLUSH_INTERVAL_SECONDS", 1.0))
+
+class LikeBuffer:
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}  # message_id -> まだ書き込んでいないいいね数
+        self._organizations = {}  # message_id -> 組織ID（書き込み後のイベント配信用）
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 書き込み処理が同時に走らないようにする
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, message_id, organization_id, n=1):
+        with self._lock:
+            self._pending[message_id] = self._pending.get(message_id, 0) + n
+            self._organizations[message_id] = organization_id
+
+    def pending(self, message_id):
+        # まだ書き込んでいないいいね数（表示時に加算する）
+        return self._pending.get(message_id, 0)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                increments, self._pending = self._pending, {}
+                organizations, self._organizations = self._organizations, {}
+            if not increments:
+                return
+
+            db = SessionLocal()
+            try:
+                apply_like_increments(db, increments)
+                # いいねされたメッセージの組織ごとに、メッセージ一覧の更新番号を増やす
+                for organization_id in set(organizations.values()):
+                    bump_change_version(db, organization_id, "messages")
+                db.commit()
+                # 書き込み後のいいね数を組織の購読者に配信
+                for message_id, count_of_likes in (
+                    db.query(Message.message_id, Message.count_of_likes)
+                    .filter(Message.message_id.in_(list(increments)))
+                    .all()
+                ):
+                    message_event_hub.publish(
+                        organizations[message_id], "like",
+                        {"message_id": message_id, "count_of_likes": count_of_likes}
+                    )
+            except Exception as e:
+                # 失敗した分は次回に書き込む
+                db.rollback()
+                logger.error(f"いいね数の書き込みエラー: {str(e)}")
+                for message_id, n in increments.items():
+                    self.add(message_id, organizations[message_id], n)
+            finally:
+                db.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="like-buffer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # 停止時に残っているいいねを書き込む
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+like_buffer = LikeBuffer(LIKE_FLUSH_INTERVAL_SECONDS) if LIKE_FLUSH_INTERVAL_SECONDS > 0 else None
+
+@app.on_event("startup")
+def start_like_buffer():
+    if like_buffer is not None:
+        like_buffer.start()
+
+@app.on_event("shutdown")
+def stop_like_buffer():
+    if like_buffer is not None:
+        like_buffer.stop()
+
 # メッセージのいいね数を増やすエンドポイント
+# user_id を指定すると Likes テーブルに記録し、同じユーザーの2回目以降のいいねは数えない
 @app.put("/like_message/{message_id}", tags=["Message Operations"])
-def like_message(message_id: int, db: Session = Depends(get_db)):
+def like_message(message_id: int, user_id: Optional[int] = Query(None), db: Session = Depends(get_db)):
     try:
-        # メッセージを取得
-        message = db.query(Message).filter(Message.message_id == message_id).first()
+        # メッセージの存在確認と送信者の組織IDの取得（メッセージ本体やユーザー情報は読み込まない）
+        organization_id = (
+            db.query(UserInformation.organization_id)
+            .join(Message, Message.sender_user_id == UserInformation.user_id)
+            .filter(Message.message_id == message_id)
+            .scalar()
+        )
         
         # メッセージが存在しない場合のエラーハンドリング
-        if not message:
+        if organization_id is None:
             raise HTTPException(status_code=404, detail="メッセージが見つかりません")
-        
-        # いいね数を増やす
-        message.count_of_likes += 1
-        db.commit()
+
+        # 同じユーザーのいいねは1回だけ数える
+        # 記録といいね数の加算は同じトランザクションで書き込む（記録だけが残り、数えられないことがないように）
+        if user_id is not None:
+            try:
+                db.add(Likes(message_id=message_id, user_id=user_id))
+                db.flush()
+            except IntegrityError:
+                db.rollback()
+                return {"message": "既にいいねされています"}
+
+        # いいね数を増やす（write-behind の場合はメモリ上で集約し、まとめて書き込む）
+        # ユーザーを指定したいいねは記録と一緒に書き込むので、集約するのはユーザーを指定しないいいねだけ
+        if like_buffer is not None and user_id is None:
+            like_buffer.add(message_id, organization_id)
+        else:
+            apply_like_increments(db, {message_id: 1})
+            bump_change_version(db, organization_id, "messages")
+            db.commit()
+            count_of_likes = db.query(Message.count_of_likes).filter(Message.message_id == message_id).scalar()
+            # 組織の購読者にいいね数の変化を配信
+            message_event_hub.publish(organization_id, "like", {"message_id": message_id, "count_of_likes": count_of_likes})
         
         return {"message": "いいね数が増加しました"}
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error occurred: {e}")
         raise HTTPException(status_code=500, detail="いいね数の増加中にエラーが発生しました")
@@ -918,8 +2767,58 @@ def add_message(message_data: MessageCreate, db: Session = Depends(get_db)):
         print(f"send_date: {new_message.send_date}")
 
         db.add(new_message)
+        db.flush()  # message_id を確定させる
+        add_message_conversation(db, new_message)  # 会話の対応表に登録
+
+        # 送信者・受信者のユーザー情報（組織IDと名前）をまとめて取得
+        users = {
+            user.user_id: user
+            for user in db.query(UserInformation.user_id, UserInformation.user_name, UserInformation.organization_id)
+            .filter(UserInformation.user_id.in_([new_message.sender_user_id, new_message.receiver_user_id]))
+            .all()
+        }
+        sender = users.get(new_message.sender_user_id)
+        receiver = users.get(new_message.receiver_user_id)
+        organization_id = sender.organization_id if sender else None
+
+        # 表示名（ユーザー名を優先し、空なら手入力の名前）
+        sender_name = (sender.user_name if sender else None) or new_message.sender_user_name_manual_input
+        receiver_name = (receiver.user_name if receiver else None) or new_message.receiver_user_name_manual_input
+
+        if organization_id is not None:
+            # メッセージ本文の単語を保存（同じトランザクション内）
+            index_message_terms(db, new_message.message_id, organization_id, new_message.product_id, new_message.message_content)
+            # 送信者の名前を同一人物グループに登録（新しい名前のときだけ類似度を計算する）
+            register_message_names(db, organization_id, [sender_name])
+            # ダッシュボード用の集計値を更新（送信者の組織）
+            increment_sender_counters(db, organization_id, sender_name, new_message.product_id, new_message.send_date)
+        if receiver is not None:
+            register_message_names(db, receiver.organization_id, [receiver_name])
+            increment_receiver_counters(db, receiver.organization_id, receiver_name)
+
+        # メッセージ一覧の更新番号を増やす（送信者と受信者の組織）
+        for changed_organization_id in {user.organization_id for user in users.values()}:
+            bump_change_version(db, changed_organization_id, "messages")
+
         db.commit()
         db.refresh(new_message)
+
+        # この商品のワードクラウド画像のキャッシュを破棄し、組織の購読者に新しいメッセージを配信
+        if organization_id is not None:
+            wordcloud_image_cache.invalidate(organization_id, new_message.product_id)
+            message_event_hub.publish(organization_id, "message", {
+                "message_id": new_message.message_id,
+                "sender_user_id": new_message.sender_user_id,
+                "sender_user_name": sender.user_name,
+                "sender_user_name_manual_input": new_message.sender_user_name_manual_input,
+                "receiver_user_id": new_message.receiver_user_id,
+                "receiver_user_name": receiver.user_name if receiver else None,
+                "receiver_user_name_manual_input": new_message.receiver_user_name_manual_input,
+                "message_content": new_message.message_content,
+                "product_id": new_message.product_id,
+                "send_date": new_message.send_date.isoformat() if new_message.send_date else None,
+                "count_of_likes": new_message.count_of_likes,
+            })
         
         logger.info(f"メッセージが追加されました: {new_message.message_id}")
         return {"message": "メッセージが追加されました"}
@@ -943,8 +2842,41 @@ def add_comment(request: CommentRequest, db: Session = Depends(get_db)):
         send_date=datetime.now(japan_timezone)
     )
     db.add(new_comment)
+    db.flush()  # reply_comment_id を確定させる
+
+    # コメント先メッセージの商品IDと送信者の組織IDを取得し、コメントの単語を保存
+    parent = (
+        db.query(Message.product_id, UserInformation.organization_id)
+        .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
+        .filter(Message.message_id == request.message_id)
+        .first()
+    )
+    if parent:
+        index_message_terms(
+            db, request.message_id, parent.organization_id, parent.product_id,
+            new_comment.message_content, reply_comment_id=new_comment.reply_comment_id
+        )
+        # メッセージ一覧の更新番号を増やす
+        bump_change_version(db, parent.organization_id, "messages")
+
     db.commit()
     db.refresh(new_comment)
+
+    # 組織の購読者に新しいコメントを配信
+    if parent:
+        comment_user_name = db.query(UserInformation.user_name).filter(
+            UserInformation.user_id == new_comment.comment_user_id
+        ).scalar()
+        message_event_hub.publish(parent.organization_id, "comment", {
+            "message_id": new_comment.message_id,
+            "reply_comment_id": new_comment.reply_comment_id,
+            "comment_user_id": new_comment.comment_user_id,
+            "comment_user_name": comment_user_name,
+            "comment_user_name_manual_input": new_comment.comment_user_name_manual_input,
+            "message_content": new_comment.message_content,
+            "send_date": new_comment.send_date.isoformat() if new_comment.send_date else None,
+        })
+
     return {"message": "Comment added successfully", "comment": new_comment}
 
 
@@ -1009,50 +2941,108 @@ class PurchaseRequest(BaseModel):
     organization_id: int
     purchases: List[PurchaseItem]
 
+# 在庫数の手動調整（棚卸しの差分など）
+class InventoryAdjustmentRequest(BaseModel):
+    product_id: int
+    quantity_change: int  # 増やす場合はプラス、減らす場合はマイナス
+    note: Optional[str] = None
+
 # 在庫数を更新するエンドポイント
+# 購入はすべての商品の在庫が足りる場合だけ確定する（1つでも足りなければ全体を取り消し、商品ごとの結果を返す）
+# 在庫の減算は UPDATE ... WHERE stock_quantity >= 購入数 で行うので、同時に購入されても在庫がマイナスにならない
 @app.put("/inventory_products/purchase/", tags=["Product Operations"])
 def purchase_products(purchase_request: PurchaseRequest, db: Session = Depends(get_db)):
     try:
         organization_id = purchase_request.organization_id
-        results = []
 
+        # 同じ商品が複数行ある場合は購入数を合計する
+        quantities = {}
         for purchase in purchase_request.purchases:
-            # 在庫情報を取得
-            inventory_product = (
-                db.query(InventoryProduct)
-                .filter(
-                    InventoryProduct.organization_id == organization_id,
-                    InventoryProduct.product_id == purchase.product_id
-                )
-                .first()
-            )
-
-            # 商品が存在しない場合のエラーハンドリング
-            if not inventory_product:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"Product with ID {purchase.product_id} not found"
-                )
-
-            # 在庫数が不足している場合のエラーハンドリング
-            if inventory_product.stock_quantity < purchase.purchase_quantity:
+            if purchase.purchase_quantity <= 0:
                 raise HTTPException(
                     status_code=400,
-                    detail=f"Insufficient stock for product ID {purchase.product_id}"
+                    detail=f"Invalid purchase quantity for product ID {purchase.product_id}"
                 )
+            quantities[purchase.product_id] = quantities.get(purchase.product_id, 0) + purchase.purchase_quantity
+
+        # 在庫の記録を始める前の在庫数を保存（組織で初めての場合だけ）
+        ensure_inventory_baseline(db, organization_id)
+
+        # 商品IDの順に在庫を減らす（ロックを取る順番をそろえて、デッドロックを防ぐ）
+        inventory_table = InventoryProduct.__table__
+        failed_ids = []
+        for product_id in sorted(quantities):
+            updated = db.execute(
+                update(inventory_table)
+                .where(
+                    inventory_table.c.organization_id == organization_id,
+                    inventory_table.c.product_id == product_id,
+                    inventory_table.c.stock_quantity >= quantities[product_id],
+                )
+                .values(stock_quantity=inventory_table.c.stock_quantity - quantities[product_id])
+            ).rowcount
+            if not updated:
+                failed_ids.append(product_id)
+
+        # 更新後の在庫数（失敗した商品は現在の在庫数）を1回のクエリで取得
+        stock = dict(
+            db.query(InventoryProduct.product_id, InventoryProduct.stock_quantity)
+            .filter(
+                InventoryProduct.organization_id == organization_id,
+                InventoryProduct.product_id.in_(list(quantities))
+            )
+            .all()
+        )
 
-            # 在庫数を更新
-            inventory_product.stock_quantity -= purchase.purchase_quantity
-
-            # 結果を収集
+        # 結果を収集
+        results = []
+        for product_id, quantity in quantities.items():
+            if product_id not in stock:
+                status = "not_found"
+            elif product_id in failed_ids:
+                status = "insufficient_stock"
+            else:
+                status = "ok"
             results.append({
-                "product_id": purchase.product_id,
-                "purchased_quantity": purchase.purchase_quantity,
-                "remaining_stock": inventory_product.stock_quantity
+                "product_id": product_id,
+                "purchased_quantity": quantity if status == "ok" else 0,
+                "requested_quantity": quantity,
+                "remaining_stock": stock.get(product_id),
+                "status": status,
             })
 
+        if failed_ids:
+            # 1つでも失敗した場合はすべて取り消す
+            db.rollback()
+            for result in results:
+                if result["status"] == "ok":
+                    # 在庫は足りていたが取り消した商品
+                    result["remaining_stock"] += result["purchased_quantity"]  # 取り消し後の在庫数
+                    result["purchased_quantity"] = 0
+                    result["status"] = "rolled_back"
+            # 商品が存在しない場合は 404、在庫数が不足している場合は 400 を返す
+            first_failure = next(result for result in results if result["status"] not in ("ok", "rolled_back"))
+            if first_failure["status"] == "not_found":
+                status_code, detail = 404, f"Product with ID {first_failure['product_id']} not found"
+            else:
+                status_code, detail = 400, f"Insufficient stock for product ID {first_failure['product_id']}"
+            return JSONResponse(status_code=status_code, content={"detail": detail, "results": results})
+
+        # 在庫の増減を記録
+        record_inventory_events(
+            db, organization_id, "purchase",
+            {product_id: -quantity for product_id, quantity in quantities.items()}
+        )
+
+        # 在庫が閾値以下になった商品を確認
+        alerts = check_low_stock(db, organization_id, quantities)
+
+        # 在庫一覧の更新番号を増やす
+        bump_change_version(db, organization_id, "inventory")
+
         # データベースを保存
         db.commit()
+        low_stock_alerts.emit(alerts)
 
         # レスポンス作成
         return {
@@ -1066,62 +3056,755 @@ def purchase_products(purchase_request: PurchaseRequest, db: Session = Depends(g
         db.rollback()  # 失敗した場合はロールバック
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-#トークン取得・生成エンドポイント
-@app.get("/get_token/{organization_id}", tags=["Token"])
-def get_or_generate_token(organization_id: int, db: Session = Depends(get_db)):
-    # データベースから該当する組織を検索
-    organization = db.query(Organization).filter(Organization.organization_id == organization_id).first()
+# スナップショット以降の記録がこの件数を超えたら、新しいスナップショットを作る（時点の在庫数の計算で再生する記録を少なく保つ）
+INVENTORY_SNAPSHOT_EVERY = int(os.getenv("INVENTORY_SNAPSHOT_EVERY", 500))
+# スナップショットに含めない直近の記録の秒数（コミットが遅れている記録を取りこぼさないための余裕）
+INVENTORY_SNAPSHOT_SAFETY_SECONDS = int(os.getenv("INVENTORY_SNAPSHOT_SAFETY_SECONDS", 60))
+
+# 現在の日本時間（タイムゾーンなし。send_date などと同じ形式）
+def now_jst():
+    return datetime.now(japan_timezone).replace(tzinfo=None)
+
+# 日時を日本時間（タイムゾーンなし）にそろえる関数
+def to_naive_jst(value):
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(japan_timezone).replace(tzinfo=None)
+
+# 組織の最新のスナップショットを返す関数（at を指定した場合はその日時以前の最新）
+# スナップショットと記録の順番は、どちらも記録のID（ledger_entry_id）で判定する
+# at を指定した場合はその日時以前に作ったもの、up_to_entry_id を指定した場合はそのIDまでの記録を反映したものに限る
+def get_latest_inventory_snapshot(db, organization_id, at=None, up_to_entry_id=None):
+    query = db.query(InventorySnapshot).filter(InventorySnapshot.organization_id == organization_id)
+    if at is not None:
+        query = query.filter(InventorySnapshot.snapshot_at <= at)
+    if up_to_entry_id is not None:
+        query = query.filter(InventorySnapshot.last_ledger_entry_id <= up_to_entry_id)
+    return query.order_by(InventorySnapshot.last_ledger_entry_id.desc(), InventorySnapshot.snapshot_id.desc()).first()
+
+# スナップショットを保存する関数（{product_id: 在庫数} を渡す）
+def save_inventory_snapshot(db, organization_id, stock, last_ledger_entry_id, snapshot_at=None):
+    snapshot = InventorySnapshot(
+        organization_id=organization_id,
+        snapshot_at=snapshot_at or now_jst(),
+        last_ledger_entry_id=last_ledger_entry_id,
+    )
+    db.add(snapshot)
+    db.flush()
+    if stock:
+        db.execute(
+            insert(InventorySnapshotItem.__table__),
+            [
+                {"snapshot_id": snapshot.snapshot_id, "product_id": product_id, "stock_quantity": quantity}
+                for product_id, quantity in stock.items()
+            ],
+        )
+    return snapshot
+
+# 最初のスナップショットがあることを確認済みの (データベース, 組織ID)（確認後は在庫を変更するたびに検索しない）
+_inventory_baseline_organizations = set()
+
+# 在庫の記録を始める前の在庫数を、最初のスナップショットとして保存する関数
+# 在庫を変更する処理の前に呼ぶ（組織にスナップショットが1つでもあれば何もしない）
+# 同時に最初の書き込みがあった場合は、一意のインデックスで後の方の保存だけを取り消す（セーブポイント）
+def ensure_inventory_baseline(db, organization_id):
+    key = (str(db.get_bind().url), organization_id)
+    if key in _inventory_baseline_organizations:
+        return
+    exists = db.query(InventorySnapshot.snapshot_id).filter(InventorySnapshot.organization_id == organization_id).first()
+    if exists:
+        _inventory_baseline_organizations.add(key)  # コミット済みのスナップショットが見つかった場合だけ覚えておく
+        return
+    last_ledger_entry_id = db.query(func.max(InventoryLedgerEntry.ledger_entry_id)).filter(
+        InventoryLedgerEntry.organization_id == organization_id
+    ).scalar() or 0
+    stock = dict(
+        db.query(InventoryProduct.product_id, InventoryProduct.stock_quantity)
+        .filter(InventoryProduct.organization_id == organization_id)
+        .all()
+    )
+    try:
+        with db.begin_nested():  # セーブポイント
+            save_inventory_snapshot(
+                db, organization_id, {product_id: quantity or 0 for product_id, quantity in stock.items()}, last_ledger_entry_id
+            )
+    except IntegrityError:
+        pass  # 別のリクエストが先に作成した
+
+# 記録を再生して在庫数を計算する関数
+# snapshot の在庫数に、その後の記録（up_to_entry_id を指定した場合はそのIDまで）を加えた {product_id: 在庫数} を返す
+def replay_inventory_ledger(db, organization_id, snapshot, up_to_entry_id=None):
+    stock = dict(
+        db.query(InventorySnapshotItem.product_id, InventorySnapshotItem.stock_quantity)
+        .filter(InventorySnapshotItem.snapshot_id == snapshot.snapshot_id)
+        .all()
+    )
+    query = (
+        db.query(InventoryLedgerEntry.product_id, func.sum(InventoryLedgerEntry.quantity_change))
+        .filter(
+            InventoryLedgerEntry.organization_id == organization_id,
+            InventoryLedgerEntry.ledger_entry_id > snapshot.last_ledger_entry_id,
+        )
+    )
+    if up_to_entry_id is not None:
+        query = query.filter(InventoryLedgerEntry.ledger_entry_id <= up_to_entry_id)
+    for product_id, change in query.group_by(InventoryLedgerEntry.product_id).all():
+        stock[product_id] = stock.get(product_id, 0) + int(change)
+    return stock
+
+# 新しいスナップショットを作る関数（前回のスナップショット + その後の記録から計算する）
+# MySQL では記録のIDは追加した時点で決まり、コミットの順番とは限らない
+# （小さいIDの記録が後からコミットされることがある）ため、スナップショットには
+# INVENTORY_SNAPSHOT_SAFETY_SECONDS 秒より前の記録だけを含める（それ以降の記録は次のスナップショットか再生で反映される）
+def take_inventory_snapshot(db, organization_id):
+    previous = get_latest_inventory_snapshot(db, organization_id)
+    if previous is None:
+        ensure_inventory_baseline(db, organization_id)
+        return get_latest_inventory_snapshot(db, organization_id)
+    cutoff = now_jst() - timedelta(seconds=INVENTORY_SNAPSHOT_SAFETY_SECONDS)
+    if cutoff <= previous.snapshot_at:
+        return previous
+    last_ledger_entry_id = db.query(func.max(InventoryLedgerEntry.ledger_entry_id)).filter(
+        InventoryLedgerEntry.organization_id == organization_id,
+        InventoryLedgerEntry.created_at <= cutoff,
+    ).scalar() or 0
+    if last_ledger_entry_id <= previous.last_ledger_entry_id:
+        return previous  # 前回から記録がなければ作らない
+    stock = replay_inventory_ledger(db, organization_id, previous, up_to_entry_id=last_ledger_entry_id)
+    return save_inventory_snapshot(db, organization_id, stock, last_ledger_entry_id, snapshot_at=cutoff)
+
+# スナップショットは在庫を変更するトランザクションの外で、別のスレッド・セッションで作る
+inventory_snapshot_executor = ThreadPoolExecutor(max_workers=1)
+_scheduled_snapshot_organizations = set()  # スナップショットの作成待ちの組織
+_scheduled_snapshot_lock = threading.Lock()
+
+def schedule_inventory_snapshot(organization_id):
+    with _scheduled_snapshot_lock:
+        if organization_id in _scheduled_snapshot_organizations:
+            return
+        _scheduled_snapshot_organizations.add(organization_id)
+    inventory_snapshot_executor.submit(run_scheduled_inventory_snapshot, organization_id)
+
+def run_scheduled_inventory_snapshot(organization_id):
+    db = SessionLocal()
+    try:
+        take_inventory_snapshot(db, organization_id)
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # 別のワーカーが同じ位置のスナップショットを作成した
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"在庫のスナップショットの作成エラー: {str(e)}")
+    finally:
+        db.close()
+        with _scheduled_snapshot_lock:
+            _scheduled_snapshot_organizations.discard(organization_id)
+
+# 在庫の増減を記録する関数（{product_id: 増減数} を渡す。呼び出し元のトランザクションでコミットする）
+def record_inventory_events(db, organization_id, event_type, changes, reference_id=None, note=None):
+    changes = {product_id: change for product_id, change in changes.items() if change}
+    if not changes:
+        return
+    created_at = now_jst()
+    db.execute(
+        insert(InventoryLedgerEntry.__table__),
+        [
+            {
+                "organization_id": organization_id,
+                "product_id": product_id,
+                "event_type": event_type,
+                "quantity_change": change,
+                "created_at": created_at,
+                "reference_id": reference_id,
+                "note": note,
+            }
+            for product_id, change in changes.items()
+        ],
+    )
 
-    if not organization:
-        raise HTTPException(status_code=404, detail="Organization not found")
+    # 前回のスナップショットから記録が増えていれば、新しいスナップショットを作る
+    snapshot = get_latest_inventory_snapshot(db, organization_id)
+    if snapshot is not None:
+        pending = db.query(func.count(InventoryLedgerEntry.ledger_entry_id)).filter(
+            InventoryLedgerEntry.organization_id == organization_id,
+            InventoryLedgerEntry.ledger_entry_id > snapshot.last_ledger_entry_id,
+        ).scalar()
+        if pending >= INVENTORY_SNAPSHOT_EVERY:
+            schedule_inventory_snapshot(organization_id)
+
+# 指定した日時の在庫数を計算する関数（その日時以前のスナップショットがなければ None）
+# 日時は「その日時までに記録された最後の記録のID」に置き換え、スナップショットの選択と再生の両方をIDで判定する
+# （スナップショットの位置によって結果が変わらないようにするため）
+def get_stock_at(db, organization_id, at):
+    up_to_entry_id = db.query(func.max(InventoryLedgerEntry.ledger_entry_id)).filter(
+        InventoryLedgerEntry.organization_id == organization_id,
+        InventoryLedgerEntry.created_at <= at,
+    ).scalar() or 0
+    snapshot = get_latest_inventory_snapshot(db, organization_id, at, up_to_entry_id)
+    if snapshot is None:
+        return None
+    return replay_inventory_ledger(db, organization_id, snapshot, up_to_entry_id)
+
+# 期間中の商品ごとの消費量（購入数）を集計する関数（{product_id: 数量} を返す）
+def get_inventory_consumption(db, organization_id, since, until):
+    return {
+        product_id: -int(change)
+        for product_id, change in (
+            db.query(InventoryLedgerEntry.product_id, func.sum(InventoryLedgerEntry.quantity_change))
+            .filter(
+                InventoryLedgerEntry.organization_id == organization_id,
+                InventoryLedgerEntry.event_type == "purchase",
+                InventoryLedgerEntry.created_at >= since,
+                InventoryLedgerEntry.created_at < until,
+            )
+            .group_by(InventoryLedgerEntry.product_id)
+            .all()
+        )
+    }
 
-    # 現在の日本時間を取得（タイムゾーンあり）
-    current_time = datetime.now(japan_timezone)
+# 記録から計算した在庫数と、現在の在庫数（stock_quantity）を照合する関数
+# apply=True の場合は、差分を "reconciliation" として記録し、記録を在庫数に合わせる
+# apply=False の場合は照合するだけで、データベースには書き込まない
+def reconcile_inventory_ledger(db, organization_id, apply=False):
+    snapshot = get_latest_inventory_snapshot(db, organization_id)
+    if snapshot is None:
+        # まだ記録がない（最初のスナップショットは現在の在庫数から作るので、差分もない）
+        return {"organization_id": organization_id, "mismatches": [], "applied": False}
+    expected = replay_inventory_ledger(db, organization_id, snapshot)
+    actual = {
+        product_id: quantity or 0
+        for product_id, quantity in db.query(InventoryProduct.product_id, InventoryProduct.stock_quantity)
+        .filter(InventoryProduct.organization_id == organization_id)
+        .all()
+    }
+    mismatches = [
+        {"product_id": product_id, "ledger": expected.get(product_id, 0), "stock_quantity": actual.get(product_id, 0)}
+        for product_id in sorted(set(expected) | set(actual))
+        if expected.get(product_id, 0) != actual.get(product_id, 0)
+    ]
+    if mismatches and apply:
+        record_inventory_events(
+            db, organization_id, "reconciliation",
+            {mismatch["product_id"]: mismatch["stock_quantity"] - mismatch["ledger"] for mismatch in mismatches},
+            note="在庫数との照合による補正",
+        )
+        db.commit()
+    return {"organization_id": organization_id, "mismatches": mismatches, "applied": bool(mismatches) and apply}
 
-    # 既存トークンが有効か確認
-    if organization.qr_generation_token and organization.token_expiry_date:
-        # `organization.token_expiry_date` を日本時間に変換
-        expiry_date_jst = organization.token_expiry_date
-        if expiry_date_jst.tzinfo is None:  # タイムゾーンがない場合
-            expiry_date_jst = expiry_date_jst.replace(tzinfo=japan_timezone)
+# 在庫数を手動で調整するエンドポイント（棚卸しの差分など。調整後の在庫数がマイナスになる場合は 400）
+@app.post("/inventory_products/{organization_id}/adjustments", tags=["Product Operations"])
+def adjust_inventory(organization_id: int, request: InventoryAdjustmentRequest, db: Session = Depends(get_db)):
+    try:
+        if request.quantity_change == 0:
+            raise HTTPException(status_code=400, detail="quantity_change must not be 0")
+        ensure_inventory_baseline(db, organization_id)
+
+        inventory_table = InventoryProduct.__table__
+        updated = db.execute(
+            update(inventory_table)
+            .where(
+                inventory_table.c.organization_id == organization_id,
+                inventory_table.c.product_id == request.product_id,
+                inventory_table.c.stock_quantity + request.quantity_change >= 0,
+            )
+            .values(stock_quantity=inventory_table.c.stock_quantity + request.quantity_change)
+        ).rowcount
+        if not updated:
+            db.rollback()
+            exists = db.query(InventoryProduct.product_id).filter_by(
+                organization_id=organization_id, product_id=request.product_id
+            ).first()
+            if not exists:
+                raise HTTPException(status_code=404, detail=f"Product with ID {request.product_id} not found")
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for product ID {request.product_id}")
 
-        # 有効期限と現在時刻を比較
-        if expiry_date_jst > current_time:
-            return {
-                "token": organization.qr_generation_token
-            }
+        record_inventory_events(
+            db, organization_id, "adjustment", {request.product_id: request.quantity_change}, note=request.note
+        )
+        alerts = check_low_stock(db, organization_id, [request.product_id])
+        bump_change_version(db, organization_id, "inventory")  # 在庫一覧の更新番号を増やす
+        db.commit()
+        low_stock_alerts.emit(alerts)
 
-    # 新しいトークンを生成
-    new_token = jwt.encode(
-        {"organization_id": organization_id, "exp": current_time + timedelta(hours=1)},
-        SECRET_KEY,
-        algorithm=ALGORITHM,
-    )
+        stock_quantity = db.query(InventoryProduct.stock_quantity).filter_by(
+            organization_id=organization_id, product_id=request.product_id
+        ).scalar()
+        return {"message": "Inventory adjusted", "product_id": request.product_id, "stock_quantity": stock_quantity}
 
-    # 新しい有効期限を日本時間で設定
-    new_expiry_date = current_time + timedelta(hours=1)
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    # データベースを更新（日本時間で保存）
-    organization.qr_generation_token = new_token
-    organization.token_expiry_date = new_expiry_date
-    organization.token_status = True  # トークン状態を有効に設定
-    db.commit()
+# 指定した日時の在庫数を返すエンドポイント
+@app.get("/inventory_products/{organization_id}/stock_at", tags=["Product Operations"])
+def get_inventory_stock_at(organization_id: int, at: datetime, db: Session = Depends(get_db)):
+    try:
+        stock = get_stock_at(db, organization_id, to_naive_jst(at))
+        if stock is None:
+            raise HTTPException(status_code=404, detail="No inventory history before the specified time")
+        return {
+            "at": to_naive_jst(at).isoformat(),
+            "stock": [{"product_id": product_id, "stock_quantity": quantity} for product_id, quantity in sorted(stock.items())],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    #新しいトークンを返す
+# 期間中の商品ごとの消費量と1日あたりの消費量を返すエンドポイント（期間の指定がなければ直近30日）
+@app.get("/inventory_products/{organization_id}/consumption", tags=["Product Operations"])
+def get_inventory_consumption_rate(
+    organization_id: int,
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    db: Session = Depends(get_db)
+):
+    try:
+        until = to_naive_jst(until) if until else now_jst()
+        since = to_naive_jst(since) if since else until - timedelta(days=30)
+        if since >= until:
+            raise HTTPException(status_code=400, detail="since must be earlier than until")
+        days = (until - since).total_seconds() / 86400
+        consumption = get_inventory_consumption(db, organization_id, since, until)
+        return {
+            "since": since.isoformat(),
+            "until": until.isoformat(),
+            "products": [
+                {"product_id": product_id, "consumed_quantity": quantity, "per_day": round(quantity / days, 3)}
+                for product_id, quantity in sorted(consumption.items())
+            ],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品ごと・日ごとの消費量（購入数）を集計する関数（(product_id, 日付, 数量) のリストを返す）
+def load_daily_inventory_consumption(db, organization_id, since, until):
+    purchase_day = func.date(InventoryLedgerEntry.created_at)
+    rows = []
+    for product_id, purchase_date, change in (
+        db.query(InventoryLedgerEntry.product_id, purchase_day, func.sum(InventoryLedgerEntry.quantity_change))
+        .filter(
+            InventoryLedgerEntry.organization_id == organization_id,
+            InventoryLedgerEntry.event_type == "purchase",
+            InventoryLedgerEntry.created_at >= since,
+            InventoryLedgerEntry.created_at < until,
+        )
+        .group_by(InventoryLedgerEntry.product_id, purchase_day)
+        .all()
+    ):
+        if isinstance(purchase_date, str):  # SQLite では文字列で返る
+            purchase_date = date.fromisoformat(purchase_date)
+        rows.append((product_id, purchase_date, -int(change)))
+    return rows
+
+# 商品ごとの入荷の履歴（最後に入荷した日、1回あたりの平均入荷数）を集計する関数
+def load_inventory_intake_summary(db, organization_id):
     return {
-        "token": new_token
+        product_id: {
+            "last_intake_date": last_intake_date,
+            "average_intake_quantity": float(average_quantity) if average_quantity is not None else None,
+        }
+        for product_id, last_intake_date, average_quantity in (
+            db.query(
+                Incoming_Products.product_id,
+                func.max(IncomingInformation.incoming_date),
+                func.avg(Incoming_Products.incoming_quantity)
+            )
+            .join(IncomingInformation, Incoming_Products.incoming_id == IncomingInformation.incoming_id)
+            .join(UserInformation, IncomingInformation.user_id == UserInformation.user_id)
+            .filter(UserInformation.organization_id == organization_id)
+            .group_by(Incoming_Products.product_id)
+            .all()
+        )
     }
 
-class ValidateTokenRequest(BaseModel):
-    organization_id: int
-    qr_generation_token: str
+# 在庫切れの予測日を出す上限（集計した日数の何倍先まで予測するか。それより先は None にする）
+FORECAST_HORIZON_MULTIPLIER = 4
 
-# トークン有効性チェックAPI
-@app.post("/validate-token")
-@app.post("/validate-token/")
-def validate_token(request: ValidateTokenRequest, db: Session = Depends(get_db)):
-    # データベースから組織情報を取得
-    organization = db.query(Organization).filter(
+# 在庫の予測と発注の提案を返すエンドポイント
+# 直近 window_days 日の消費量から全商品の消費ペースと在庫切れまでの日数をまとめて計算し、在庫切れが近い順に返す
+# lead_time_days: 発注してから届くまでの日数、target_days: 届いてから何日分の在庫を持ちたいか
+@app.get("/inventory_products/{organization_id}/forecast", tags=["Product Operations"])
+def get_inventory_forecast(
+    organization_id: int,
+    window_days: int = Query(28, ge=7, le=365),
+    lead_time_days: int = Query(3, ge=0, le=90),
+    target_days: int = Query(14, ge=1, le=180),
+    db: Session = Depends(get_db)
+):
+    try:
+        stock, meitex, independent = get_inventory_catalog(db, organization_id)
+        product_ids = [item["product_id"] for item in stock]
+
+        # 今日を含む直近 window_days 日分の消費量を 商品数 × 日数 の配列にする
+        today = now_jst().date()
+        start_date = today - timedelta(days=window_days - 1)
+        rows = load_daily_inventory_consumption(
+            db, organization_id, datetime.combine(start_date, datetime.min.time()), datetime.combine(today + timedelta(days=1), datetime.min.time())
+        )
+        consumption = inventory_forecast.build_daily_matrix(product_ids, rows, start_date, window_days)
+        forecast = inventory_forecast.forecast_inventory(
+            [item["stock_quantity"] or 0 for item in stock],
+            consumption,
+            lead_time_days=lead_time_days,
+            target_days=target_days,
+            max_days=window_days * FORECAST_HORIZON_MULTIPLIER,
+        )
+        intake = load_inventory_intake_summary(db, organization_id)
+
+        products = []
+        for i, item in enumerate(stock):
+            product = meitex.get(item["product_id"]) or independent.get(item["product_id"]) or {}
+            days_remaining = float(forecast["days_remaining"][i])
+            intake_summary = intake.get(item["product_id"], {})
+            last_intake_date = intake_summary.get("last_intake_date")
+            products.append({
+                "product_id": item["product_id"],
+                "product_name": product.get("product_name"),
+                "stock_quantity": item["stock_quantity"] or 0,
+                "daily_rate": round(float(forecast["daily_rate"][i]), 3),
+                "short_rate": round(float(forecast["short_rate"][i]), 3),
+                "long_rate": round(float(forecast["long_rate"][i]), 3),
+                # 消費がない商品や、在庫切れが予測の上限より先の商品は None
+                "days_remaining": round(days_remaining, 1) if math.isfinite(days_remaining) else None,
+                "stockout_date": (today + timedelta(days=int(days_remaining))).isoformat() if math.isfinite(days_remaining) else None,
+                "reorder_point": round(float(forecast["reorder_point"][i]), 1),
+                "needs_reorder": bool(forecast["needs_reorder"][i]),
+                "suggested_order_quantity": int(forecast["suggested_quantity"][i]),
+                "last_intake_date": last_intake_date.isoformat() if last_intake_date else None,
+                "average_intake_quantity": intake_summary.get("average_intake_quantity"),
+            })
+        products.sort(key=lambda p: (p["days_remaining"] is None, p["days_remaining"] or 0, p["product_id"]))
+
+        return {
+            "organization_id": organization_id,
+            "generated_at": now_jst().isoformat(),
+            "window_days": window_days,
+            "lead_time_days": lead_time_days,
+            "target_days": target_days,
+            "products": products,
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# スナップショットを作るエンドポイント（夜間などに定期的に実行する）
+@app.post("/inventory_products/{organization_id}/snapshots", tags=["Product Operations"])
+def create_inventory_snapshot(organization_id: int, db: Session = Depends(get_db)):
+    try:
+        snapshot = take_inventory_snapshot(db, organization_id)
+        db.commit()
+        return {
+            "snapshot_id": snapshot.snapshot_id,
+            "snapshot_at": snapshot.snapshot_at.isoformat(),
+            "last_ledger_entry_id": snapshot.last_ledger_entry_id,
+        }
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 在庫少の通知先（カンマ区切りで複数指定できる。log: ログに出す / webhook: LOW_STOCK_WEBHOOK_URL に POST する / queue: プロセス内のキューに入れる）
+LOW_STOCK_ALERT_SINKS = [name.strip() for name in os.getenv("LOW_STOCK_ALERT_SINKS", "log").split(",") if name.strip()]
+LOW_STOCK_WEBHOOK_URL = os.getenv("LOW_STOCK_WEBHOOK_URL")
+LOW_STOCK_WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("LOW_STOCK_WEBHOOK_TIMEOUT_SECONDS", 5))
+LOW_STOCK_QUEUE_SIZE = int(os.getenv("LOW_STOCK_QUEUE_SIZE", 1000))  # キューに溜めておく通知の上限
+
+# ログに出す通知先
+class LogAlertSink:
+    def send(self, alert):
+        logger.warning(
+            f"在庫少: 組織ID {alert['organization_id']} 商品ID {alert['product_id']} "
+            f"在庫数 {alert['stock_quantity']}（閾値 {alert['threshold']}）"
+        )
+
+# webhook に POST する通知先（エンドポイントの応答を待たせないよう、別スレッドで送る）
+class WebhookAlertSink:
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def send(self, alert):
+        self._executor.submit(self._post, alert)
+
+    def _post(self, alert):
+        try:
+            requests.post(self.url, json=alert, timeout=self.timeout).raise_for_status()
+        except Exception as e:
+            logger.error(f"在庫少の通知（webhook）の送信エラー: {str(e)}")
+
+# プロセス内のキューに入れる通知先（同じプロセスの処理が get() で受け取る）
+# キューがいっぱいの場合は古い通知から捨てる
+class QueueAlertSink:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def send(self, alert):
+        while True:
+            try:
+                self.queue.put_nowait(alert)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+# 在庫少の通知を各通知先に送るクラス（1つの通知先で失敗しても、他の通知先には送る）
+class LowStockAlertDispatcher:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def emit(self, alerts):
+        for alert in alerts:
+            for sink in self.sinks:
+                try:
+                    sink.send(alert)
+                except Exception as e:
+                    logger.error(f"在庫少の通知エラー: {str(e)}")
+
+# 環境変数の設定から通知先を作る関数
+def create_low_stock_alert_sinks():
+    sinks = []
+    for name in LOW_STOCK_ALERT_SINKS:
+        if name == "log":
+            sinks.append(LogAlertSink())
+        elif name == "webhook":
+            if not LOW_STOCK_WEBHOOK_URL:
+                logger.warning("LOW_STOCK_WEBHOOK_URL が設定されていないため、在庫少の通知を webhook に送りません")
+                continue
+            sinks.append(WebhookAlertSink(LOW_STOCK_WEBHOOK_URL, LOW_STOCK_WEBHOOK_TIMEOUT_SECONDS))
+        elif name == "queue":
+            sinks.append(QueueAlertSink(LOW_STOCK_QUEUE_SIZE))
+        else:
+            logger.warning(f"不明な在庫少の通知先です: {name}")
+    return sinks
+
+low_stock_alerts = LowStockAlertDispatcher(create_low_stock_alert_sinks())
+
+# 在庫を変更した商品だけを閾値と比べ、新しく通知する在庫少のリストを返す関数
+# 在庫を変更する処理の中（コミット前）で呼び、コミット後に low_stock_alerts.emit() で通知する
+# 閾値以下になった商品は alert_active を True にし、閾値を上回った商品は False に戻す（回復するまで同じ通知を繰り返さない）
+def check_low_stock(db, organization_id, product_ids):
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return []
+    rows = (
+        db.query(
+            LowStockThreshold.product_id,
+            LowStockThreshold.threshold,
+            LowStockThreshold.alert_active,
+            InventoryProduct.stock_quantity
+        )
+        .join(
+            InventoryProduct,
+            (InventoryProduct.organization_id == LowStockThreshold.organization_id)
+            & (InventoryProduct.product_id == LowStockThreshold.product_id)
+        )
+        .filter(
+            LowStockThreshold.organization_id == organization_id,
+            LowStockThreshold.product_id.in_(product_ids)
+        )
+        .all()
+    )
+
+    threshold_table = LowStockThreshold.__table__
+    alerted_at = now_jst()
+    alerts = []
+    recovered_ids = []
+    for product_id, threshold, alert_active, stock_quantity in rows:
+        stock_quantity = stock_quantity or 0
+        if stock_quantity <= threshold and not alert_active:
+            # 別のリクエストが同時に通知した場合は通知しない（alert_active が False の行だけ更新できる）
+            updated = db.execute(
+                update(threshold_table)
+                .where(
+                    threshold_table.c.organization_id == organization_id,
+                    threshold_table.c.product_id == product_id,
+                    threshold_table.c.alert_active.is_(False),
+                )
+                .values(alert_active=True, alerted_at=alerted_at)
+            ).rowcount
+            if updated:
+                alerts.append({
+                    "organization_id": organization_id,
+                    "product_id": product_id,
+                    "stock_quantity": stock_quantity,
+                    "threshold": threshold,
+                    "alerted_at": alerted_at.isoformat(),
+                })
+        elif stock_quantity > threshold and alert_active:
+            recovered_ids.append(product_id)
+
+    if recovered_ids:
+        db.execute(
+            update(threshold_table)
+            .where(
+                threshold_table.c.organization_id == organization_id,
+                threshold_table.c.product_id.in_(recovered_ids),
+            )
+            .values(alert_active=False)
+        )
+    return alerts
+
+class LowStockThresholdItem(BaseModel):
+    product_id: int
+    threshold: Optional[int] = None  # None の場合は閾値を削除する
+
+class LowStockThresholdRequest(BaseModel):
+    thresholds: List[LowStockThresholdItem]
+
+# 在庫少の閾値を設定するエンドポイント（設定した商品はその場で在庫数と比べる）
+@app.put("/inventory_products/{organization_id}/low_stock_thresholds", tags=["Product Operations"])
+def set_low_stock_thresholds(organization_id: int, request: LowStockThresholdRequest, db: Session = Depends(get_db)):
+    try:
+        thresholds = {item.product_id: item.threshold for item in request.thresholds}  # 同じ商品は後の指定を使う
+        if any(threshold is not None and threshold < 0 for threshold in thresholds.values()):
+            raise HTTPException(status_code=400, detail="threshold must be 0 or greater")
+
+        threshold_table = LowStockThreshold.__table__
+        removed_ids = [product_id for product_id, threshold in thresholds.items() if threshold is None]
+        if removed_ids:
+            db.execute(
+                threshold_table.delete().where(
+                    threshold_table.c.organization_id == organization_id,
+                    threshold_table.c.product_id.in_(removed_ids),
+                )
+            )
+
+        values = {product_id: threshold for product_id, threshold in thresholds.items() if threshold is not None}
+        existing_ids = {
+            product_id
+            for (product_id,) in db.query(LowStockThreshold.product_id).filter(
+                LowStockThreshold.organization_id == organization_id,
+                LowStockThreshold.product_id.in_(list(values))
+            ).all()
+        }
+        if existing_ids:
+            db.execute(
+                update(threshold_table)
+                .where(
+                    threshold_table.c.organization_id == organization_id,
+                    threshold_table.c.product_id == bindparam("target_product_id"),
+                )
+                .values(threshold=bindparam("new_threshold")),
+                [{"target_product_id": product_id, "new_threshold": values[product_id]} for product_id in existing_ids],
+            )
+        new_rows = [
+            {"organization_id": organization_id, "product_id": product_id, "threshold": threshold, "alert_active": False}
+            for product_id, threshold in values.items()
+            if product_id not in existing_ids
+        ]
+        if new_rows:
+            db.execute(insert(threshold_table), new_rows)
+
+        alerts = check_low_stock(db, organization_id, values)
+        db.commit()
+        low_stock_alerts.emit(alerts)
+        return {"message": "Low stock thresholds updated", "updated": len(values), "removed": len(removed_ids), "alerts": alerts}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 在庫少の閾値と現在の状態を返すエンドポイント
+@app.get("/inventory_products/{organization_id}/low_stock_thresholds", tags=["Product Operations"])
+def get_low_stock_thresholds(organization_id: int, db: Session = Depends(get_db)):
+    try:
+        rows = (
+            db.query(LowStockThreshold, InventoryProduct.stock_quantity)
+            .outerjoin(
+                InventoryProduct,
+                (InventoryProduct.organization_id == LowStockThreshold.organization_id)
+                & (InventoryProduct.product_id == LowStockThreshold.product_id)
+            )
+            .filter(LowStockThreshold.organization_id == organization_id)
+            .order_by(LowStockThreshold.product_id)
+            .all()
+        )
+        return [
+            {
+                "product_id": threshold.product_id,
+                "threshold": threshold.threshold,
+                "stock_quantity": stock_quantity,
+                "alert_active": threshold.alert_active,
+                "alerted_at": threshold.alerted_at.isoformat() if threshold.alerted_at else None,
+            }
+            for threshold, stock_quantity in rows
+        ]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 記録と在庫数を照合するエンドポイント（apply=true で差分を補正として記録する）
+@app.post("/inventory_products/{organization_id}/ledger/reconcile", tags=["Product Operations"])
+def reconcile_inventory(organization_id: int, apply: bool = Query(False), db: Session = Depends(get_db)):
+    try:
+        return reconcile_inventory_ledger(db, organization_id, apply)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+#トークン取得・生成エンドポイント
+@app.get("/get_token/{organization_id}", tags=["Token"])
+def get_or_generate_token(organization_id: int, db: Session = Depends(get_db)):
+    # データベースから該当する組織を検索
+    organization = db.query(Organization).filter(Organization.organization_id == organization_id).first()
+
+    if not organization:
+        raise HTTPException(status_code=404, detail="Organization not found")
+
+    # 現在の日本時間を取得（タイムゾーンあり）
+    current_time = datetime.now(japan_timezone)
+
+    # 既存トークンが有効か確認
+    if organization.qr_generation_token and organization.token_expiry_date:
+        # `organization.token_expiry_date` を日本時間に変換
+        expiry_date_jst = organization.token_expiry_date
+        if expiry_date_jst.tzinfo is None:  # タイムゾーンがない場合
+            expiry_date_jst = expiry_date_jst.replace(tzinfo=japan_timezone)
+
+        # 有効期限と現在時刻を比較
+        if expiry_date_jst > current_time:
+            return {
+                "token": organization.qr_generation_token
+            }
+
+    # 新しいトークンを生成
+    new_token = jwt.encode(
+        {"organization_id": organization_id, "exp": current_time + timedelta(hours=1)},
+        SECRET_KEY,
+        algorithm=ALGORITHM,
+    )
+
+    # 新しい有効期限を日本時間で設定
+    new_expiry_date = current_time + timedelta(hours=1)
+
+    # データベースを更新（日本時間で保存）
+    organization.qr_generation_token = new_token
+    organization.token_expiry_date = new_expiry_date
+    organization.token_status = True  # トークン状態を有効に設定
+    db.commit()
+
+    #新しいトークンを返す
+    return {
+        "token": new_token
+    }
+
+class ValidateTokenRequest(BaseModel):
+    organization_id: int
+    qr_generation_token: str
+
+# トークン有効性チェックAPI
+@app.post("/validate-token")
+@app.post("/validate-token/")
+def validate_token(request: ValidateTokenRequest, db: Session = Depends(get_db)):
+    # データベースから組織情報を取得
+    organization = db.query(Organization).filter(
         Organization.organization_id == request.organization_id,
         Organization.qr_generation_token == request.qr_generation_token
     ).first()
@@ -1141,30 +3824,190 @@ def validate_token(request: ValidateTokenRequest, db: Session = Depends(get_db))
     #トークンが有効
     return {"status": "valid", "organization_name": organization.organization_name}
 
-@app.get("/api/messages/", tags=["DashBoard"])
-def get_latest_messages(organization_id: int, db: Session = Depends(get_db)):
-    #最新の3件のメッセージを取得
-    messages = (
-        db.query(Message)
-        .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
+# 組織に所属するユーザーのIDと名前を取得する関数（{user_id: user_name} を返す）
+def get_organization_user_names(db, organization_id):
+    return dict(
+        db.query(UserInformation.user_id, UserInformation.user_name)
         .filter(UserInformation.organization_id == organization_id)
+        .all()
+    )
+
+# 最新のメッセージを取得する関数
+# user_names には組織のユーザー {user_id: user_name} を渡す（送信者の絞り込みと名前の表示に使う）
+def get_latest_messages_data(db, user_names, limit=3):
+    if not user_names:
+        return []
+
+    messages = (
+        db.query(
+            Message.send_date,
+            Message.sender_user_id,
+            Message.sender_user_name_manual_input,
+            Message.receiver_user_id,
+            Message.receiver_user_name_manual_input,
+            Message.message_content,
+        )
+        .filter(Message.sender_user_id.in_(list(user_names)))
         .order_by(Message.send_date.desc())
-        .limit(3)
+        .limit(limit)
         .all()
     )
 
+    # 組織外の受信者がいれば、その名前だけ追加で取得
+    other_user_ids = {message.receiver_user_id for message in messages} - set(user_names)
+    if other_user_ids:
+        user_names = {
+            **user_names,
+            **dict(
+                db.query(UserInformation.user_id, UserInformation.user_name)
+                .filter(UserInformation.user_id.in_(other_user_ids))
+                .all()
+            ),
+        }
+
     #結果を整形しつつ格納
-    result = [
+    return [
         {
             "send_date": message.send_date.strftime("%Y-%m-%d %H:%M"),
-            "sender_name": message.sender_user_name_manual_input or message.sender.user_name,  # 手動入力を優先
-            "receiver_name": message.receiver_user_name_manual_input or message.receiver.user_name,  # 手動入力を優先
+            "sender_name": message.sender_user_name_manual_input or user_names.get(message.sender_user_id),  # 手動入力を優先
+            "receiver_name": message.receiver_user_name_manual_input or user_names.get(message.receiver_user_id),  # 手動入力を優先
             "message_content": message.message_content,
         }
         for message in messages
     ]
 
-    return result
+@app.get("/api/messages/", tags=["DashBoard"])
+def get_latest_messages(organization_id: int, db: Session = Depends(get_db)):
+    #最新の3件のメッセージを取得
+    return get_latest_messages_data(db, get_organization_user_names(db, organization_id))
+
+# 同じ人物とみなす名前の類似度の閾値（rapidfuzz の fuzz.ratio、0〜100）
+NAME_SIMILARITY_THRESHOLD = 60
+
+# 名前を同一人物グループに割り当てる関数（{名前: name_identity_id} を返す）
+# 登録済みの名前は対応表から取得し、新しい名前だけ rapidfuzz.process.cdist でまとめて類似度を計算する
+# names は優先順（メッセージ数の多い順など）に並べて渡す。先に処理した名前がグループの代表名になる
+def resolve_name_identities(db, organization_id, names):
+    names = list(dict.fromkeys(name for name in names if name))  # 重複と空の名前を除く（順序は保つ）
+    if not names:
+        return {}
+
+    resolved = dict(
+        db.query(NameAlias.alias_name, NameAlias.name_identity_id)
+        .filter(NameAlias.organization_id == organization_id, NameAlias.alias_name.in_(names))
+        .all()
+    )
+    new_names = [name for name in names if name not in resolved]
+    if not new_names:
+        return resolved
+
+    # 既存グループの代表名と、新しい名前同士の類似度を一括で計算（workers=-1 で全CPUを使用）
+    identities = (
+        db.query(NameIdentity.name_identity_id, NameIdentity.canonical_name)
+        .filter(NameIdentity.organization_id == organization_id)
+        .order_by(NameIdentity.name_identity_id)
+        .all()
+    )
+    identity_ids = [identity.name_identity_id for identity in identities]
+    existing_scores = process.cdist(
+        new_names, [identity.canonical_name for identity in identities], scorer=fuzz.ratio, workers=-1
+    )
+    new_scores = process.cdist(new_names, new_names, scorer=fuzz.ratio, workers=-1)
+
+    # 各名前に最も似ている既存グループ（閾値を超えた場合だけ使う）
+    rows = np.arange(len(new_names))
+    if identity_ids:
+        best_existing = existing_scores.argmax(axis=1)
+        best_existing_scores = existing_scores[rows, best_existing]
+    else:
+        best_existing = np.zeros(len(new_names), dtype=int)
+        best_existing_scores = np.zeros(len(new_names))
+    matches_existing = best_existing_scores > NAME_SIMILARITY_THRESHOLD
+
+    # 各名前に最も似ている、それより前の新しい名前（既存グループに入らなかった名前だけが新しいグループになれる）
+    candidate_scores = np.array(new_scores, dtype=float)
+    candidate_scores[np.triu_indices(len(new_names))] = -1  # 自分と後の名前は除く
+    candidate_scores[:, matches_existing] = -1
+    best_new = candidate_scores.argmax(axis=1)
+    best_new_scores = candidate_scores[rows, best_new]
+    # 既存グループより似ている場合は、前の名前と同じグループにする
+    joins_new = best_new_scores > np.maximum(best_existing_scores, NAME_SIMILARITY_THRESHOLD)
+
+    # 新しい名前を順番にグループへ割り当てる（似ているグループがなければ新しいグループを作る）
+    assigned = [None] * len(new_names)
+    for i, name in enumerate(new_names):
+        if joins_new[i]:
+            best_identity_id = assigned[best_new[i]]
+        elif matches_existing[i]:
+            best_identity_id = identity_ids[best_existing[i]]
+        else:
+            best_identity_id = None
+
+        if best_identity_id is None:
+            identity = NameIdentity(organization_id=organization_id, canonical_name=name[:255])
+            db.add(identity)
+            db.flush()  # name_identity_id を確定させる
+            best_identity_id = identity.name_identity_id
+
+        assigned[i] = best_identity_id
+        db.add(NameAlias(organization_id=organization_id, alias_name=name[:255], name_identity_id=best_identity_id))
+        resolved[name] = best_identity_id
+
+    db.flush()
+    return resolved
+
+# メッセージの送信者・受信者の名前を同一人物グループに登録する関数（add_message から呼ぶ）
+# 同時に同じ名前が登録された場合でもメッセージの追加は失敗させず、次回の集計時に登録する
+def register_message_names(db, organization_id, names):
+    try:
+        with db.begin_nested():  # セーブポイント（失敗時はこの部分だけ取り消す）
+            resolve_name_identities(db, organization_id, names)
+    except IntegrityError:
+        logger.info("名前の登録が競合したため、次回の集計時に登録します")
+
+# 送信・受信メッセージ数のランキングを同一人物グループ単位で集計する関数
+# 名前ごとのメッセージ数は dashboard_counters に集計済みなので、メッセージ全件は読まない
+# role: "sender"（送信数）または "receiver"（受信数）
+def get_name_leaderboard(db, organization_id, role, limit=5):
+    ensure_dashboard_counters(db, organization_id)
+    counter_type = "sender" if role == "sender" else "receiver"
+
+    # まだ対応表にない名前があれば、メッセージ数の多い順にグループへ割り当てる
+    unresolved = (
+        db.query(DashboardCounter.counter_key)
+        .outerjoin(
+            NameAlias,
+            (NameAlias.organization_id == DashboardCounter.organization_id) & (NameAlias.alias_name == DashboardCounter.counter_key)
+        )
+        .filter(DashboardCounter.organization_id == organization_id, DashboardCounter.counter_type == counter_type)
+        .filter(NameAlias.alias_name.is_(None))
+        .order_by(DashboardCounter.counter_value.desc(), DashboardCounter.counter_key)
+        .all()
+    )
+    if unresolved:
+        try:
+            resolve_name_identities(db, organization_id, [row.counter_key for row in unresolved])
+            db.commit()
+        except IntegrityError:
+            # 同時に別のリクエストが登録した場合は、その結果を使う
+            db.rollback()
+
+    # 同一人物グループごとにメッセージ数を合計（GROUP BY）
+    message_count = func.sum(DashboardCounter.counter_value)
+    return (
+        db.query(NameIdentity.canonical_name.label("name"), message_count.label("message_count"))
+        .select_from(DashboardCounter)
+        .join(
+            NameAlias,
+            (NameAlias.organization_id == DashboardCounter.organization_id) & (NameAlias.alias_name == DashboardCounter.counter_key)
+        )
+        .join(NameIdentity, NameAlias.name_identity_id == NameIdentity.name_identity_id)
+        .filter(DashboardCounter.organization_id == organization_id, DashboardCounter.counter_type == counter_type)
+        .group_by(NameIdentity.name_identity_id, NameIdentity.canonical_name)
+        .order_by(message_count.desc(), NameIdentity.name_identity_id)
+        .limit(limit)
+        .all()
+    )
 
 @app.get("/api/messages/send", response_model=List[MessageCountResponse], tags=["DashBoard"])
 def get_message_send_count(
@@ -1172,48 +4015,9 @@ def get_message_send_count(
     db: Session = Depends(get_db)
 ):
     try:
-        #データベースからメッセージ送信データを取得
-        raw_results = (
-            db.query(
-                Message.sender_user_name_manual_input.label("manual_name"),
-                UserInformation.user_name.label("default_name"),
-                func.count(Message.message_id).label("message_count")
-            )
-            .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
-            .filter(UserInformation.organization_id == organization_id)
-            .group_by(Message.sender_user_name_manual_input, UserInformation.user_name)
-            .order_by(desc("message_count"))
-            .all()
-        )
-
-        #名前ごとにカウントを集約
-        name_counts = {}
-        for result in raw_results:
-            name = result.default_name or result.manual_name   #デフォルトネームを優先
-            count = result.message_count
-
-            #既存の名前に類似している場合はそのグループに追加
-            added = False
-            for existing_name in name_counts:
-                if fuzz.ratio(name, existing_name) > 60:  #類似度の閾値、今は仮で60%で設定
-                    name_counts[existing_name] += count
-                    added = True
-                    break
-
-            if not added:
-                name_counts[name] = count
-
-        # 結果を降順にソートしてトップ5を返却
-        sorted_results = sorted(
-            [
-                {"sender_name": name, "message_count": count}
-                for name, count in name_counts.items()
-            ],
-            key=lambda x: x["message_count"],
-            reverse=True
-        )[:5]
-
-        return sorted_results
+        # 名前の揺れをまとめたグループごとに集計し、トップ5を返却
+        leaderboard = get_name_leaderboard(db, organization_id, "sender")
+        return [{"sender_name": row.name, "message_count": row.message_count} for row in leaderboard]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1224,99 +4028,167 @@ def get_message_receive_count(
     db: Session = Depends(get_db)
 ):
     try:
-        # データベースからメッセージ受信データを取得
-        raw_results = (
-            db.query(
-                Message.receiver_user_name_manual_input.label("manual_name"),
-                UserInformation.user_name.label("default_name"),
-                func.count(Message.message_id).label("message_count")
-            )
-            .join(UserInformation, Message.receiver_user_id == UserInformation.user_id)
-            .filter(UserInformation.organization_id == organization_id)
-            .group_by(Message.receiver_user_name_manual_input, UserInformation.user_name)
-            .order_by(desc("message_count"))
-            .all()
-        )
-
-        #名前ごとにカウントを集約
-        name_counts = {}
-        for result in raw_results:
-            name = result.default_name or result.manual_name  
-            count = result.message_count
-
-            #既存の名前に類似している場合はそのグループに追加
-            added = False
-            for existing_name in name_counts:
-                if fuzz.ratio(name, existing_name) > 60:  
-                    name_counts[existing_name] += count
-                    added = True
-                    break
-
-            if not added:
-                name_counts[name] = count
-
-        # 結果を降順にソートしてトップ5を返却
-        sorted_results = sorted(
-            [
-                {"receiver_name": name, "message_count": count}
-                for name, count in name_counts.items()
-            ],
-            key=lambda x: x["message_count"],
-            reverse=True
-        )[:5]
-
-        return sorted_results
+        # 名前の揺れをまとめたグループごとに集計し、トップ5を返却
+        leaderboard = get_name_leaderboard(db, organization_id, "receiver")
+        return [{"receiver_name": row.name, "message_count": row.message_count} for row in leaderboard]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 集計期間の単位（granularity）ごとに、今日を含む期間の開始日を返す関数
+def get_period_start(granularity, today):
+    if granularity == "daily":
+        return today
+    if granularity == "weekly":
+        return today - timedelta(days=today.weekday())  # 今週の月曜日
+    return today.replace(day=1)  # 今月の1日
+
+# 商品ランキングを集計する関数（商品名の解決も含めて1回のクエリで取得）
+# 期間の指定がなければ商品ごとの集計値（dashboard_counters）、あれば日ごとの集計値（product_daily_counts）を使う
+# since / until は日本時間の日付（until を含む）
+def get_snack_ranking_rows(db, organization_id, limit=3, since=None, until=None):
+    ensure_dashboard_counters(db, organization_id)
+    product_name = func.coalesce(MeitexProductMaster.product_name, IndependentProductMaster.product_name)
+
+    if since is None and until is None:
+        purchase_count = DashboardCounter.counter_value
+        query = (
+            db.query(product_name.label("product_name"), purchase_count.label("purchase_count"))
+            .select_from(DashboardCounter)
+            .join(IntegratedProduct, IntegratedProduct.product_id == cast(DashboardCounter.counter_key, Integer))
+            .filter(DashboardCounter.organization_id == organization_id, DashboardCounter.counter_type == "product")
+        )
+    else:
+        purchase_count = func.sum(ProductDailyCount.message_count)
+        query = (
+            db.query(product_name.label("product_name"), purchase_count.label("purchase_count"))
+            .select_from(ProductDailyCount)
+            .join(IntegratedProduct, IntegratedProduct.product_id == ProductDailyCount.product_id)
+            .filter(ProductDailyCount.organization_id == organization_id)
+        )
+        if since is not None:
+            query = query.filter(ProductDailyCount.count_date >= since)
+        if until is not None:
+            query = query.filter(ProductDailyCount.count_date <= until)
+        query = query.group_by(
+            IntegratedProduct.product_id, MeitexProductMaster.product_name, IndependentProductMaster.product_name
+        )
+
+    return (
+        query
+        .outerjoin(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id)
+        .outerjoin(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
+        .filter(product_name.isnot(None))  # 商品名が分からない商品は除く
+        .order_by(purchase_count.desc(), IntegratedProduct.product_id)
+        .limit(limit)
+        .all()
+    )
+
 #お菓子購入ランキングに関するAPI
+# granularity を指定すると、今日を含む日・週・月の期間で集計する（since を指定した場合はそちらを優先）
 @app.get("/api/snacks/ranking", response_model=List[SnackRankingResponse], tags=["DashBoard"])
 def get_snack_ranking(
     organization_id: int = Query(...),
+    limit: int = Query(3, ge=1, le=100),  # 取得する件数（デフォルトはトップ3）
+    since: Optional[date] = Query(None),  # 集計開始日（この日を含む）
+    until: Optional[date] = Query(None),  # 集計終了日（この日を含む）
+    granularity: Optional[str] = Query(None, pattern="^(daily|weekly|monthly)$"),  # daily / weekly / monthly
     db: Session = Depends(get_db)
 ):
     try:
-        product_counts = (
-            db.query(
-                Message.product_id,
-                func.count(Message.message_id).label("purchase_count")
-            )
-            .join(UserInformation, Message.sender_user_id == UserInformation.user_id)  # UserInformationからorganization_idを取得
-            .filter(UserInformation.organization_id == organization_id)  # organization_idでフィルタ
-            .group_by(Message.product_id)
-            .order_by(desc("purchase_count"))
-            .all()
-        )
+        if granularity and since is None:
+            since = get_period_start(granularity, datetime.now(japan_timezone).date())
 
-        #product_idをもとにproduct_nameを特定
-        ranking = []
-        for product_id, purchase_count in product_counts[:3]:  #トップ3を取得
-            product_name = None
+        ranking = get_snack_ranking_rows(db, organization_id, limit=limit, since=since, until=until)
+        return [{"product_name": row.product_name, "purchase_count": row.purchase_count} for row in ranking]
 
-            product = (
-                db.query(IntegratedProduct, MeitexProductMaster.product_name, IndependentProductMaster.product_name)
-                .outerjoin(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id)
-                .outerjoin(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
-                .filter(IntegratedProduct.product_id == product_id)
-                .first()
-            )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+# ダッシュボードの各項目を並行して集計するスレッドプール（同時に使うDB接続数の上限にもなる）
+DASHBOARD_WORKERS = int(os.getenv("DASHBOARD_WORKERS", 4))
+dashboard_executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix="dashboard")
+
+# アプリ終了時にスレッドプールを停止する
+@app.on_event("shutdown")
+def shutdown_dashboard_executor():
+    dashboard_executor.shutdown(wait=False, cancel_futures=True)
+
+# ダッシュボードの1項目を集計する関数（スレッドごとに別のDBセッションを使う）
+# 戻り値: (集計結果, エラーメッセージ, 所要時間[ms])
+def run_dashboard_section(section_function, *args):
+    started = time.perf_counter()
+    db = SessionLocal()
+    data, error = None, None
+    try:
+        data = section_function(db, *args)
+    except Exception as e:
+        logger.error(f"ダッシュボードの集計エラー: {str(e)}")
+        error = str(e)
+    finally:
+        db.close()
+    return data, error, round((time.perf_counter() - started) * 1000, 1)
 
+# ダッシュボードの各項目
+def dashboard_total_messages(db, organization_id):
+    return get_dashboard_counter(db, organization_id, "total")
 
-            if product:
-                product_name = product[1] or product[2]  
+def dashboard_latest_messages(db, organization_id):
+    return get_latest_messages_data(db, get_organization_user_names(db, organization_id))
 
-            if product_name:
-                ranking.append({
-                    "product_name": product_name,
-                    "purchase_count": purchase_count
-                })
+def dashboard_send_ranking(db, organization_id):
+    return [{"sender_name": row.name, "message_count": row.message_count} for row in get_name_leaderboard(db, organization_id, "sender")]
+
+def dashboard_receive_ranking(db, organization_id):
+    return [{"receiver_name": row.name, "message_count": row.message_count} for row in get_name_leaderboard(db, organization_id, "receiver")]
+
+def dashboard_snack_ranking(db, organization_id):
+    return [{"product_name": row.product_name, "purchase_count": row.purchase_count} for row in get_snack_ranking_rows(db, organization_id)]
 
-        return ranking
+def dashboard_wordcloud_frequencies(db, organization_id):
+    return build_wordcloud_frequencies(db, organization_id)
 
+DASHBOARD_SECTIONS = {
+    "total_messages": dashboard_total_messages,
+    "latest_messages": dashboard_latest_messages,
+    "send_ranking": dashboard_send_ranking,
+    "receive_ranking": dashboard_receive_ranking,
+    "snack_ranking": dashboard_snack_ranking,
+    "wordcloud_frequencies": dashboard_wordcloud_frequencies,
+}
+
+# ダッシュボードの全項目を1回のリクエストで返すエンドポイント
+# 各項目はスレッドプールで並行して集計し、項目ごとの所要時間（timings_ms）も返す
+@app.get("/api/dashboard/{organization_id}", tags=["DashBoard"])
+def get_dashboard(organization_id: int, db: Session = Depends(get_db)):
+    started = time.perf_counter()
+    try:
+        # 集計値の初回作成は並行処理の前に1度だけ行う
+        ensure_dashboard_counters(db, organization_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+    futures = {
+        name: dashboard_executor.submit(run_dashboard_section, section_function, organization_id)
+        for name, section_function in DASHBOARD_SECTIONS.items()
+    }
+
+    response = {"organization_id": organization_id}
+    timings = {}
+    errors = {}
+    for name, future in futures.items():
+        data, error, elapsed_ms = future.result()
+        response[name] = data
+        timings[name] = elapsed_ms
+        if error:
+            errors[name] = error
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    response["timings_ms"] = timings
+    if errors:
+        response["errors"] = errors  # 失敗した項目（他の項目は返す）
+    return response
+
 @app.get("/api/snacks/wordcloud", tags=["DashBoard"])
 def get_snack_wordcloud(
     organization_id: int = Query(...),
@@ -1351,67 +4223,866 @@ def get_snack_wordcloud(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# 形態素解析で特定の品詞をフィルタリングする関数
-def split_into_filtered_words(text):
-    tokenizer = Tokenizer()
-    # 抽出する品詞（名詞、動詞、形容詞、副詞）
-    allowed_pos = ["名詞", "動詞", "形容詞", "副詞"]
-    words = [
-        token.surface
-        for token in tokenizer.tokenize(text)
-        if any(pos in token.part_of_speech for pos in allowed_pos)  # 品詞が条件に一致するか
+# メッセージ（またはコメント）の単語と出現回数を message_terms に追加する関数
+# commit は呼び出し元で行う（メッセージ本体と同じトランザクションで保存するため）
+# words を渡した場合は形態素解析を省略する（ワーカープロセスでまとめて解析済みの場合）
+def index_message_terms(db, message_id, organization_id, product_id, text, reply_comment_id=None, words=None):
+    if not text:
+        return
+    if words is None:
+        words = split_into_filtered_words(text)
+    term_counts = Counter(word[:100] for word in words)  # カラム長に合わせて切り詰め
+    if term_counts:
+        # 全文検索用に文書の単語数を保存
+        db.add(SearchDocument(
+            organization_id=organization_id,
+            message_id=message_id,
+            reply_comment_id=reply_comment_id,
+            document_length=sum(term_counts.values()),
+        ))
+    db.add_all([
+        MessageTerm(
+            message_id=message_id,
+            reply_comment_id=reply_comment_id,
+            organization_id=organization_id,
+            product_id=product_id,
+            term=term,
+            term_count=count,
+        )
+        for term, count in term_counts.items()
+    ])
+
+# ワードクラウド生成用のプロセスプールの設定
+# WORDCLOUD_WORKERS: ワーカープロセス数（0ならリクエストのスレッド内で生成する）
+#   プロセスプールは uvicorn のワーカーごとに作られるので、既定値は少なめ（CPU数と2の小さい方）にしている
+#   uvicorn のワーカーが1つだけの場合は CPU 数まで増やしてよい
+# WORDCLOUD_DEADLINE_SECONDS: 1リクエストで画像生成を待つ最大秒数
+WORDCLOUD_WORKERS = int(os.getenv("WORDCLOUD_WORKERS", min(2, os.cpu_count() or 1)))
+WORDCLOUD_DEADLINE_SECONDS = float(os.getenv("WORDCLOUD_DEADLINE_SECONDS", 20))
+
+_wordcloud_executor = None
+_wordcloud_executor_lock = threading.Lock()
+
+# プロセスプールを取得する関数（初回呼び出し時に作成する）
+def get_wordcloud_executor():
+    global _wordcloud_executor
+    if WORDCLOUD_WORKERS <= 0:
+        return None
+    with _wordcloud_executor_lock:
+        if _wordcloud_executor is None:
+            # spawn方式で起動し、ワーカーは wordcloud_worker だけを読み込む
+            _wordcloud_executor = ProcessPoolExecutor(
+                max_workers=WORDCLOUD_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=wordcloud_worker.init_worker,
+                initargs=(font_path,),
+            )
+        return _wordcloud_executor
+
+# ワーカープロセスが異常終了した場合にプールを作り直すための関数
+def reset_wordcloud_executor():
+    global _wordcloud_executor
+    with _wordcloud_executor_lock:
+        if _wordcloud_executor is not None:
+            _wordcloud_executor.shutdown(wait=False, cancel_futures=True)
+            _wordcloud_executor = None
+
+# アプリ起動時にワーカープロセスを立ち上げ、フォントとトークナイザーを読み込ませておく
+# プロセスは必要になった分だけ起動されるので、ワーカー数と同じ数の処理を同時に渡し、すべて終わるまで待つ
+@app.on_event("startup")
+def warm_up_wordcloud_executor():
+    executor = get_wordcloud_executor()
+    if executor is None:
+        return
+    futures = [executor.submit(split_texts_into_filtered_words, []) for _ in range(WORDCLOUD_WORKERS)]
+    _, not_done = wait_futures(futures, timeout=WORDCLOUD_DEADLINE_SECONDS)
+    if not_done:
+        logger.warning("ワードクラウドのワーカープロセスの起動が制限時間内に終わりませんでした")
+
+# アプリ終了時にワーカープロセスを停止する
+@app.on_event("shutdown")
+def shutdown_wordcloud_executor():
+    reset_wordcloud_executor()
+
+# 複数のテキストを形態素解析する関数（プロセスプールがあればワーカーに分けて実行する）
+def split_texts_with_pool(texts, chunk_size=50):
+    executor = get_wordcloud_executor()
+    if executor is None or len(texts) <= chunk_size:
+        return split_texts_into_filtered_words(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    try:
+        return [words for chunk_words in executor.map(split_texts_into_filtered_words, chunks) for words in chunk_words]
+    except BrokenProcessPool:
+        reset_wordcloud_executor()
+        return split_texts_into_filtered_words(texts)
+
+# 起動時のバックフィルを実行するか（テストなどで止める場合は 0 にする）
+STARTUP_BACKFILL_ENABLED = os.getenv("STARTUP_BACKFILL_ENABLED", "1") != "0"
+
+# 移行作業を一度だけ実行する関数（起動時にバックグラウンドのスレッドで呼ぶ）
+# 別のワーカーや以前の起動ですでに登録されている場合は何もしない
+# 失敗した場合は completed_at が空のまま残るので、手動のバックフィルのエンドポイントで続きを実行する
+def run_maintenance_task_once(task_name, task):
+    db = SessionLocal()
+    try:
+        try:
+            db.add(MaintenanceTask(task_name=task_name, started_at=now_jst()))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return
+        result = task(db)
+        db.query(MaintenanceTask).filter(MaintenanceTask.task_name == task_name).update(
+            {MaintenanceTask.completed_at: now_jst()}, synchronize_session=False
+        )
+        db.commit()
+        logger.info(f"{task_name} が完了しました: {result}")
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"{task_name} のエラー: {str(e)}")
+    finally:
+        db.close()
+
+# 移行作業をバックグラウンドのスレッドで開始する関数（起動を待たせないため）
+def start_maintenance_task(task_name, task):
+    if not STARTUP_BACKFILL_ENABLED:
+        return
+    threading.Thread(target=run_maintenance_task_once, args=(task_name, task), name=task_name, daemon=True).start()
+
+# まだ単語が保存されていない既存のメッセージ・コメントを解析して保存する関数（バックフィル）
+def backfill_message_terms(db, organization_id=None, batch_size=500):
+    indexed_messages = 0
+    indexed_comments = 0
+
+    # メッセージ本文（単語が1つも保存されていないもの）
+    last_message_id = 0
+    while True:
+        query = (
+            db.query(Message.message_id, Message.product_id, Message.message_content, UserInformation.organization_id)
+            .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
+            .filter(Message.message_id > last_message_id)
+            .filter(~(
+                db.query(MessageTerm.message_term_id)
+                .filter(MessageTerm.message_id == Message.message_id, MessageTerm.reply_comment_id.is_(None))
+                .exists()
+            ))
+        )
+        if organization_id is not None:
+            query = query.filter(UserInformation.organization_id == organization_id)
+        rows = query.order_by(Message.message_id).limit(batch_size).all()
+        if not rows:
+            break
+        words_list = split_texts_with_pool([row.message_content for row in rows])
+        for row, words in zip(rows, words_list):
+            index_message_terms(db, row.message_id, row.organization_id, row.product_id, row.message_content, words=words)
+        db.commit()  # バッチごとに確定
+        indexed_messages += len(rows)
+        last_message_id = rows[-1].message_id
+
+    # コメント（単語が1つも保存されていないもの）
+    last_comment_id = 0
+    while True:
+        query = (
+            db.query(
+                ReplyComments.reply_comment_id,
+                ReplyComments.message_id,
+                ReplyComments.message_content,
+                Message.product_id,
+                UserInformation.organization_id,
+            )
+            .join(Message, ReplyComments.message_id == Message.message_id)
+            .join(UserInformation, Message.sender_user_id == UserInformation.user_id)
+            .filter(ReplyComments.reply_comment_id > last_comment_id)
+            .filter(~(
+                db.query(MessageTerm.message_term_id)
+                .filter(MessageTerm.reply_comment_id == ReplyComments.reply_comment_id)
+                .exists()
+            ))
+        )
+        if organization_id is not None:
+            query = query.filter(UserInformation.organization_id == organization_id)
+        rows = query.order_by(ReplyComments.reply_comment_id).limit(batch_size).all()
+        if not rows:
+            break
+        words_list = split_texts_with_pool([row.message_content for row in rows])
+        for row, words in zip(rows, words_list):
+            index_message_terms(
+                db, row.message_id, row.organization_id, row.product_id, row.message_content,
+                reply_comment_id=row.reply_comment_id, words=words
+            )
+        db.commit()
+        indexed_comments += len(rows)
+        last_comment_id = rows[-1].reply_comment_id
+
+    return {"indexed_messages": indexed_messages, "indexed_comments": indexed_comments}
+
+# 全文検索の BM25 のパラメータ（k1: 単語の出現回数の効き方、b: 文書長の補正の強さ）
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+# 単語は保存済みで、全文検索の文書長がまだない文書を登録する関数
+# （全文検索を追加する前に保存された単語から文書長を計算するので、形態素解析はやり直さない）
+def backfill_search_documents(db, organization_id=None):
+    query = (
+        db.query(
+            MessageTerm.organization_id,
+            MessageTerm.message_id,
+            MessageTerm.reply_comment_id,
+            func.sum(MessageTerm.term_count).label("document_length"),
+        )
+        .filter(~(
+            db.query(SearchDocument.search_document_id)
+            .filter(
+                SearchDocument.message_id == MessageTerm.message_id,
+                SearchDocument.reply_comment_id.is_not_distinct_from(MessageTerm.reply_comment_id),
+            )
+            .exists()
+        ))
+        .group_by(MessageTerm.organization_id, MessageTerm.message_id, MessageTerm.reply_comment_id)
+    )
+    if organization_id is not None:
+        query = query.filter(MessageTerm.organization_id == organization_id)
+    rows = query.all()
+    db.add_all([
+        SearchDocument(
+            organization_id=row.organization_id,
+            message_id=row.message_id,
+            reply_comment_id=row.reply_comment_id,
+            document_length=int(row.document_length),
+        )
+        for row in rows
+    ])
+    db.commit()
+    return len(rows)
+
+# 全文検索のインデックス（単語と文書長）を作り直す関数
+# 保存済みの単語と文書長を削除し、メッセージとコメントを解析し直す
+def rebuild_search_index(db, organization_id=None):
+    term_query = db.query(MessageTerm)
+    document_query = db.query(SearchDocument)
+    if organization_id is not None:
+        term_query = term_query.filter(MessageTerm.organization_id == organization_id)
+        document_query = document_query.filter(SearchDocument.organization_id == organization_id)
+    document_query.delete(synchronize_session=False)
+    term_query.delete(synchronize_session=False)
+    db.commit()
+
+    result = backfill_message_terms(db, organization_id)
+    # 解析し直した単語でワードクラウドを作り直す
+    if organization_id is not None:
+        wordcloud_image_cache.invalidate(organization_id)
+    else:
+        wordcloud_image_cache.clear()
+    return result
+
+# 組織のメッセージとコメントを全文検索する関数（BM25 でスコアの高い順に返す）
+# include_archived=True の場合は、保管したメッセージとコメントも検索する
+# 戻り値: (検索語の単語リスト, 一致した文書数, [(スコア, message_id, reply_comment_id, 保管済みか), ...])
+def search_message_documents(db, organization_id, text, limit=20, offset=0, product_id=None, include_archived=False):
+    terms = list(dict.fromkeys(word[:100] for word in split_into_filtered_words(text)))  # 重複を除いて順序は保つ
+    if not terms:
+        return terms, 0, []
+
+    sources = [(MessageTerm, SearchDocument, False)]
+    if include_archived:
+        sources.append((MessageTermArchive, SearchDocumentArchive, True))
+
+    # 組織の文書数と平均の文書長
+    document_count = 0
+    total_length = 0
+    for _, document_model, _ in sources:
+        count, length = db.query(
+            func.count(document_model.search_document_id), func.coalesce(func.sum(document_model.document_length), 0)
+        ).filter(document_model.organization_id == organization_id).one()
+        document_count += count
+        total_length += length
+    if not document_count:
+        return terms, 0, []
+    average_length = total_length / document_count
+
+    # 検索語を含む文書の出現回数（ポスティング）と文書長を取得
+    postings = []
+    for term_model, document_model, archived in sources:
+        query = (
+            db.query(
+                term_model.message_id,
+                term_model.reply_comment_id,
+                term_model.term,
+                term_model.term_count,
+                document_model.document_length,
+            )
+            .join(
+                document_model,
+                (document_model.message_id == term_model.message_id)
+                & document_model.reply_comment_id.is_not_distinct_from(term_model.reply_comment_id),
+            )
+            .filter(term_model.organization_id == organization_id, term_model.term.in_(terms))
+        )
+        if product_id is not None:
+            query = query.filter(term_model.product_id == product_id)
+        postings.extend((posting, archived) for posting in query.all())
+
+    # 単語ごとの文書頻度（その単語を含む文書の数）
+    document_frequencies = Counter(posting.term for posting, _ in postings)
+
+    # BM25 のスコアを文書ごとに合計
+    scores = {}
+    for posting, archived in postings:
+        df = document_frequencies[posting.term]
+        idf = math.log(1 + (document_count - df + 0.5) / (df + 0.5))
+        tf = posting.term_count
+        norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * posting.document_length / average_length)
+        key = (posting.message_id, posting.reply_comment_id, archived)
+        scores[key] = scores.get(key, 0.0) + idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+
+    # スコアの高い順（同点なら新しい順）に上位だけを取り出す
+    top = heapq.nlargest(
+        offset + limit, scores.items(),
+        key=lambda item: (item[1], item[0][0], item[0][1] or 0)
+    )[offset:]
+    return terms, len(scores), [
+        (score, message_id, reply_comment_id, archived) for (message_id, reply_comment_id, archived), score in top
     ]
-    return words
 
+# メッセージとコメントを全文検索するエンドポイント
+# include_archived=true の場合は、保管した古いメッセージとコメントも検索する（結果の archived が true になる）
+@app.get("/api/messages/search", tags=["Message Operations"])
+def search_messages(
+    organization_id: int,
+    q: str = Query(..., min_length=1, max_length=200),  # 検索語
+    product_id: Optional[int] = Query(None),  # 商品で絞り込む場合に指定
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    include_archived: bool = Query(False),
+    db: Session = Depends(get_db)
+):
+    try:
+        terms, total, hits = search_message_documents(db, organization_id, q, limit, offset, product_id, include_archived)
+
+        # 検索結果の本文をまとめて取得（保管済みの文書は保管テーブルから読む）
+        messages = {}
+        comments = {}
+        for archived, message_model, comment_model in ((False, Message, ReplyComments), (True, MessageArchive, ReplyCommentArchive)):
+            message_ids = {message_id for _, message_id, _, is_archived in hits if is_archived == archived}
+            comment_ids = {
+                reply_comment_id for _, _, reply_comment_id, is_archived in hits
+                if is_archived == archived and reply_comment_id is not None
+            }
+            if message_ids:
+                messages.update(
+                    ((message.message_id, archived), message)
+                    for message in db.query(
+                        message_model.message_id, message_model.message_content, message_model.product_id,
+                        message_model.send_date, message_model.sender_user_id, message_model.receiver_user_id,
+                    ).filter(message_model.message_id.in_(message_ids)).all()
+                )
+            if comment_ids:
+                comments.update(
+                    ((comment.reply_comment_id, archived), comment)
+                    for comment in db.query(
+                        comment_model.reply_comment_id, comment_model.message_content, comment_model.send_date,
+                        comment_model.comment_user_id,
+                    ).filter(comment_model.reply_comment_id.in_(comment_ids)).all()
+                )
+
+        results = []
+        for score, message_id, reply_comment_id, archived in hits:
+            message = messages.get((message_id, archived))
+            if message is None:
+                continue
+            item = {
+                "type": "message" if reply_comment_id is None else "comment",
+                "score": round(score, 4),
+                "message_id": message_id,
+                "reply_comment_id": reply_comment_id,
+                "product_id": message.product_id,
+                "sender_user_id": message.sender_user_id,
+                "receiver_user_id": message.receiver_user_id,
+                "message_content": message.message_content,
+                "send_date": message.send_date.isoformat() if message.send_date else None,
+                "archived": archived,
+            }
+            if reply_comment_id is not None:
+                comment = comments.get((reply_comment_id, archived))
+                if comment is None:
+                    continue
+                item.update({
+                    "comment_user_id": comment.comment_user_id,
+                    "comment_content": comment.message_content,
+                    "comment_send_date": comment.send_date.isoformat() if comment.send_date else None,
+                })
+            results.append(item)
+
+        return {"query_terms": terms, "total": total, "results": results}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 全文検索のインデックスを作り直すエンドポイント
+# rebuild=false の場合は、文書長がまだ登録されていない文書だけを追加する（単語の解析はやり直さない）
+@app.post("/api/messages/search/rebuild", tags=["Message Operations"])
+def rebuild_search(
+    organization_id: Optional[int] = Query(None),
+    rebuild: bool = Query(True),
+    db: Session = Depends(get_db)
+):
+    try:
+        if not rebuild:
+            result = backfill_message_terms(db, organization_id)
+            result["registered_documents"] = backfill_search_documents(db, organization_id)
+            return result
+        return rebuild_search_index(db, organization_id)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品IDから商品名を一括で取得する関数（{商品ID: 商品名} を返す）
+def get_product_names(db, product_ids):
+    product_ids = {product_id for product_id in product_ids if product_id is not None}
+    if not product_ids:
+        return {}
+    return dict(
+        db.query(
+            IntegratedProduct.product_id,
+            func.coalesce(MeitexProductMaster.product_name, IndependentProductMaster.product_name)
+        )
+        .outerjoin(MeitexProductMaster, IntegratedProduct.meitex_product_id == MeitexProductMaster.meitex_product_id)
+        .outerjoin(IndependentProductMaster, IntegratedProduct.independent_product_id == IndependentProductMaster.independent_product_id)
+        .filter(IntegratedProduct.product_id.in_(product_ids))
+        .all()
+    )
+
+# ワードクラウドに表示しない単語（ストップワード）
+# 環境変数 WORDCLOUD_STOPWORDS にカンマ区切りで追加できる
+DEFAULT_WORDCLOUD_STOPWORDS = {
+    "する", "し", "さ", "いる", "い", "ある", "あり", "なる", "なり", "れる", "られる", "できる", "でき",
+    "こと", "もの", "よう", "ため", "これ", "それ", "あれ", "ここ", "そこ", "さん", "くれ", "くれる",
+    "た", "だ", "です", "でし", "ます", "まし", "ない", "の", "ん", "て", "せ",
+}
+WORDCLOUD_STOPWORDS = DEFAULT_WORDCLOUD_STOPWORDS | {
+    word.strip() for word in os.getenv("WORDCLOUD_STOPWORDS", "").split(",") if word.strip()
+}
+# 1つのワードクラウドに表示する単語の最大数
+WORDCLOUD_TOP_N = int(os.getenv("WORDCLOUD_TOP_N", 200))
+
+# 集計に使う単語のテーブル（include_archived=True の場合は保管したメッセージの単語も使う）
+def message_term_models(include_archived=False):
+    return (MessageTerm, MessageTermArchive) if include_archived else (MessageTerm,)
+
+# 保存済みの単語を商品ごとに集計する関数（{商品ID: {単語: 出現回数}} を返す）
+# ストップワードの除外と集計はSQL（GROUP BY）で行う
+def get_product_term_frequencies(db, organization_id, product_ids=None, stopwords=None, include_archived=False):
+    stopwords = WORDCLOUD_STOPWORDS if stopwords is None else stopwords
+    frequencies = {}
+    for term_model in message_term_models(include_archived):
+        # 商品ID・単語ごとに出現回数を合計（メッセージ本文のみ）
+        query = (
+            db.query(
+                term_model.product_id,
+                term_model.term,
+                func.sum(term_model.term_count).label("term_count")
+            )
+            .filter(term_model.organization_id == organization_id)
+            .filter(term_model.reply_comment_id.is_(None))
+        )
+        if product_ids is not None:
+            query = query.filter(term_model.product_id.in_(product_ids))
+        if stopwords:
+            query = query.filter(term_model.term.notin_(stopwords))
+        for row in query.group_by(term_model.product_id, term_model.term).all():
+            product_frequencies = frequencies.setdefault(row.product_id, {})
+            product_frequencies[row.term] = product_frequencies.get(row.term, 0) + int(row.term_count)
+    return frequencies
+
+# 商品ごとのワードクラウドの「版」を取得する関数（{商品ID: (最新メッセージID, メッセージ数)} を返す）
+# 新しいメッセージが届くと値が変わるので、画像キャッシュのキーとして使う
+def get_wordcloud_watermarks(db, organization_id, product_ids=None, include_archived=False):
+    watermarks = {}
+    for term_model in message_term_models(include_archived):
+        query = (
+            db.query(
+                term_model.product_id,
+                func.max(term_model.message_id).label("latest_message_id"),
+                func.count(func.distinct(term_model.message_id)).label("message_count")
+            )
+            .filter(term_model.organization_id == organization_id)
+            .filter(term_model.reply_comment_id.is_(None))
+        )
+        if product_ids is not None:
+            query = query.filter(term_model.product_id.in_(product_ids))
+        for row in query.group_by(term_model.product_id).all():
+            latest_message_id, message_count = watermarks.get(row.product_id, (0, 0))
+            watermarks[row.product_id] = (max(latest_message_id, row.latest_message_id), message_count + row.message_count)
+    return watermarks
+
+# 商品IDごとの集計結果を1つにまとめ、出現回数の多い単語だけに絞る関数
+def merge_term_frequencies(term_frequencies, product_ids, top_n=None, min_count=1):
+    top_n = WORDCLOUD_TOP_N if top_n is None else top_n
+    merged = Counter()
+    for product_id in product_ids:
+        merged.update(term_frequencies.get(product_id, {}))
+    items = [(term, count) for term, count in merged.items() if count >= min_count]
+    if top_n and len(items) > top_n:
+        items = heapq.nlargest(top_n, items, key=lambda item: item[1])
+    return dict(items)
+
+# 同じ商品名の商品IDをまとめる関数（同じ商品名は1つのワードクラウドにまとめる）
+def group_product_ids_by_name(product_ids, product_names):
+    groups = {}
+    for product_id in sorted(product_ids, key=lambda p: (p is None, p or 0)):
+        groups.setdefault(product_names.get(product_id), []).append(product_id)
+    return groups
+
+# ワードクラウド画像のキャッシュ（LRU方式、件数とバイト数の上限つき）
+# キーは (組織ID, 商品IDのタプル, 版) なので、新しいメッセージが届けば自動的に別キーになる
+class WordCloudImageCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # キー -> PNGバイト列（古い順）
+        self._total_bytes = 0
+        self._lock = threading.Lock()  # 複数スレッドから同時に使われるためロックする
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)  # 最近使ったものとして末尾へ
+            return png
+
+    def put(self, key, png):
+        # 1枚で上限を超える画像はキャッシュしない
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= len(self._entries.pop(key))
+            self._entries[key] = png
+            self._total_bytes += len(png)
+            # 上限を超えた分は古いものから削除
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+
+    def invalidate(self, organization_id, product_id=None):
+        # 指定した組織（と商品）の画像を削除
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == organization_id and (product_id is None or product_id in key[1]):
+                    self._total_bytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        # すべての画像を削除
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+wordcloud_image_cache = WordCloudImageCache(
+    max_entries=int(os.getenv("WORDCLOUD_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(os.getenv("WORDCLOUD_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+)
+
+# 1商品分のワードクラウドを生成する関数（プロセスプールを使わない場合）
+def render_wordcloud_png(frequencies):
+    return wordcloud_worker.render_wordcloud_png(frequencies, font_path)
+
+# 複数商品のワードクラウドを並列に生成し、できあがった順に返すジェネレーター
+# jobs: {商品名: (キャッシュキー, {単語: 出現回数})}
+# (商品名, PNGバイト列) を順に返し、制限時間内に終わらなかった商品は (商品名, None) を返す
+def iter_wordclouds_parallel(jobs, deadline_seconds=None):
+    deadline_seconds = WORDCLOUD_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    executor = get_wordcloud_executor()
+    if executor is None:
+        # プロセスプールを使わない設定の場合は順番に生成
+        for product_name, (cache_key, frequencies) in jobs.items():
+            png = render_wordcloud_png(frequencies)
+            wordcloud_image_cache.put(cache_key, png)
+            yield product_name, png
+        return
+
+    # 生成が終わった画像はキャッシュに保存する（制限時間を過ぎて終わったものも次回使える）
+    def cache_result(cache_key):
+        def callback(future):
+            if not future.cancelled() and future.exception() is None:
+                wordcloud_image_cache.put(cache_key, future.result())
+        return callback
+
+    futures = {}
+    yielded = set()  # 結果を返した future
+    try:
+        for product_name, (cache_key, frequencies) in jobs.items():
+            future = executor.submit(wordcloud_worker.render_wordcloud_png, frequencies)
+            future.add_done_callback(cache_result(cache_key))
+            futures[future] = product_name
+
+        for future in as_completed(futures, timeout=deadline_seconds):
+            yielded.add(future)
+            yield futures[future], future.result()
+    except FuturesTimeoutError:
+        # 制限時間を過ぎた商品は None を返し、まだ始まっていない生成はキャンセル
+        # 制限時間を過ぎた直後に終わった商品は、画像を返す
+        for future, product_name in futures.items():
+            if future in yielded:
+                continue
+            if future.done() and not future.cancelled() and future.exception() is None:
+                yield product_name, future.result()
+            else:
+                future.cancel()
+                yield product_name, None
+    except BrokenProcessPool:
+        # ワーカーが異常終了した場合はプールを作り直す
+        reset_wordcloud_executor()
+        raise
+
+# 複数商品のワードクラウドを並列に生成する関数
+# 戻り値: ({商品名: PNGバイト列}, [制限時間内に終わらなかった商品名])
+def render_wordclouds_parallel(jobs, deadline_seconds=None):
+    results = {}
+    timed_out_products = []
+    for product_name, png in iter_wordclouds_parallel(jobs, deadline_seconds):
+        if png is None:
+            timed_out_products.append(product_name)
+        else:
+            results[product_name] = png
+    return results, timed_out_products
+
+# ワードクラウドの生成準備をする関数（データベースへの問い合わせはすべてここで行う）
+# 戻り値: (商品名の一覧, キャッシュにあった画像 {商品名: PNGバイト列}, 生成が必要な商品 jobs)
+def prepare_wordcloud_jobs(db, organization_id, product_ids=None, include_archived=False):
+    # 商品ごとの版を取得（形態素解析はメッセージ追加時に済んでいる）
+    watermarks = get_wordcloud_watermarks(db, organization_id, product_ids, include_archived)
+    if not watermarks:
+        return [], {}, {}
+
+    product_groups = group_product_ids_by_name(watermarks, get_product_names(db, watermarks))
+
+    # キャッシュにある画像はそのまま使い、ない商品だけ生成する
+    images = {}
+    missing_groups = {}
+    for product_name, group_product_ids in product_groups.items():
+        cache_key = (organization_id, tuple(group_product_ids), tuple(watermarks[p] for p in group_product_ids), include_archived)
+        png = wordcloud_image_cache.get(cache_key)
+        if png is None:
+            missing_groups[product_name] = (cache_key, group_product_ids)
+        else:
+            images[product_name] = png
+
+    jobs = {}
+    if missing_groups:
+        # キャッシュにない商品の単語だけを集計
+        term_frequencies = get_product_term_frequencies(
+            db, organization_id,
+            [product_id for _, group_product_ids in missing_groups.values() for product_id in group_product_ids],
+            include_archived=include_archived,
+        )
+        for product_name, (cache_key, group_product_ids) in missing_groups.items():
+            frequencies = merge_term_frequencies(term_frequencies, group_product_ids)
+            if frequencies:
+                jobs[product_name] = (cache_key, frequencies)
+
+    # 表示できる単語がない商品は除く
+    product_names = [product_name for product_name in product_groups if product_name in images or product_name in jobs]
+    return product_names, images, jobs
+
+# 既存のメッセージ・コメントの単語をまとめて保存するエンドポイント（初回導入時のバックフィル用）
+@app.post("/api/snacks/wordcloud/terms/backfill", tags=["DashBoard"])
+def backfill_wordcloud_terms(
+    organization_id: Optional[int] = Query(None),
+    db: Session = Depends(get_db)
+):
+    try:
+        return backfill_message_terms(db, organization_id)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 単語の保存を導入する前のメッセージ・コメントを、起動時に一度だけ解析して保存する
+# （手動でバックフィルを呼ばなくても、既存の履歴がワードクラウドと全文検索に出るようにする）
+def backfill_message_terms_on_startup(db):
+    result = backfill_message_terms(db)
+    result["search_documents"] = backfill_search_documents(db)
+    wordcloud_image_cache.clear()
+    return result
+
+@app.on_event("startup")
+def start_message_terms_backfill():
+    start_maintenance_task("message_terms_backfill", backfill_message_terms_on_startup)
+
+# include_archived=true の場合は、保管した古いメッセージの単語も含める（以下のワードクラウドのエンドポイントも同じ）
 @app.get("/api/snacks/wordcloud/images", tags=["DashBoard"])
 def generate_wordclouds(
     organization_id: int = Query(...),
+    include_archived: bool = Query(False),
     db: Session = Depends(get_db)
 ):
     try:
-        # データ取得
-        product_message_map = get_snack_wordcloud(organization_id, db)
+        # キャッシュの確認と、生成が必要な商品の単語の集計
+        product_names, images, jobs = prepare_wordcloud_jobs(db, organization_id, include_archived=include_archived)
 
         # データが存在しない場合
-        if not product_message_map:
+        if not product_names:
             raise HTTPException(status_code=404, detail="No messages found for this organization_id.")
 
-        # 商品ごとのワードクラウドを生成
-        wordclouds = {}
-        for product_name, messages in product_message_map.items():
-            combined_text = " ".join(messages)
-            
-            # テキストを特定品詞で分割
-            words = split_into_filtered_words(combined_text)
-            processed_text = " ".join(words)  # 単語を空白で連結
-            print(product_name)
-            print(processed_text)
-            
-            # 日本語対応のフォントを指定
-            wordcloud = WordCloud(
-                width=800,
-                height=400,
-                background_color="white",
-                font_path=font_path,  # 環境変数や指定パスを使用
-                #collocations=False  #連語を無効化
-            ).generate(processed_text)
-            
-            # 画像をメモリに保存し、Base64に変換
-            img_buffer = io.BytesIO()
-            wordcloud.to_image().save(img_buffer, format="PNG")
-            img_buffer.seek(0)
-            img_base64 = base64.b64encode(img_buffer.read()).decode("utf-8")
-            
-            # 商品名をキーに画像データを保存
-            wordclouds[product_name] = img_base64
+        # 商品ごとのワードクラウドを生成（プロセスプールで並列に生成）
+        rendered, timed_out_products = render_wordclouds_parallel(jobs)
+        images.update(rendered)
+
+        # 商品名をキーにBase64に変換した画像データを保存
+        wordclouds = {
+            product_name: base64.b64encode(images[product_name]).decode("utf-8")
+            for product_name in product_names
+            if product_name in images
+        }
 
         # JSON形式で全商品分のデータを返却
-        return {"wordclouds": wordclouds}
+        response = {"wordclouds": wordclouds}
+        if timed_out_products:
+            # 制限時間内に生成できなかった商品（次回のリクエストではキャッシュから返せる）
+            response["timed_out_products"] = timed_out_products
+        return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 商品名ごとの単語の出現回数を作る関数（{商品名: {単語: 出現回数}} を返す）
+def build_wordcloud_frequencies(db, organization_id, stopwords=None, top_n=None, min_count=1, include_archived=False):
+    term_frequencies = get_product_term_frequencies(db, organization_id, stopwords=stopwords, include_archived=include_archived)
+    product_groups = group_product_ids_by_name(term_frequencies, get_product_names(db, term_frequencies))
+    frequencies = {}
+    for product_name, product_ids in product_groups.items():
+        product_frequencies = merge_term_frequencies(term_frequencies, product_ids, top_n=top_n, min_count=min_count)
+        if product_frequencies:
+            frequencies[product_name] = product_frequencies
+    return frequencies
+
+# 商品ごとの単語の出現回数をJSONで返すエンドポイント（フロントエンドでワードクラウドを描画する場合に使う）
+@app.get("/api/snacks/wordcloud/frequencies", tags=["DashBoard"])
+def get_wordcloud_frequencies(
+    organization_id: int = Query(...),
+    top_n: int = Query(WORDCLOUD_TOP_N, ge=1, le=1000),  # 1商品あたりの最大単語数
+    min_count: int = Query(1, ge=1),  # この回数未満の単語は除く
+    stopwords: Optional[str] = Query(None),  # 追加で除外する単語（カンマ区切り）
+    include_archived: bool = Query(False),
+    db: Session = Depends(get_db)
+):
+    try:
+        extra_stopwords = {word.strip() for word in (stopwords or "").split(",") if word.strip()}
+        frequencies = build_wordcloud_frequencies(
+            db, organization_id, stopwords=WORDCLOUD_STOPWORDS | extra_stopwords, top_n=top_n, min_count=min_count,
+            include_archived=include_archived,
+        )
+
+        # データが存在しない場合
+        if not frequencies:
+            raise HTTPException(status_code=404, detail="No messages found for this organization_id.")
+
+        return {"frequencies": frequencies}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ワードクラウドを1商品ずつNDJSON形式（1行に1商品のJSON）で返すエンドポイント
+# キャッシュにある商品から先に返し、残りは生成が終わった順に返す
+@app.get("/api/snacks/wordcloud/images/stream", tags=["DashBoard"])
+def stream_wordclouds(
+    organization_id: int = Query(...),
+    include_archived: bool = Query(False),
+    db: Session = Depends(get_db)
+):
+    try:
+        # データベースへの問い合わせはレスポンスを返し始める前に済ませる
+        product_names, images, jobs = prepare_wordcloud_jobs(db, organization_id, include_archived=include_archived)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not product_names:
+        raise HTTPException(status_code=404, detail="No messages found for this organization_id.")
+
+    def to_line(product_name, png):
+        item = {"product_name": product_name}
+        if png is None:
+            item["timed_out"] = True  # 制限時間内に生成できなかった
+        else:
+            item["image"] = base64.b64encode(png).decode("utf-8")
+        return json.dumps(item, ensure_ascii=False) + "\n"
+
+    def generate():
+        for product_name, png in images.items():
+            yield to_line(product_name, png)
+        for product_name, png in iter_wordclouds_parallel(jobs):
+            yield to_line(product_name, png)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# 1商品のワードクラウドをPNG画像（バイナリ）のまま返すエンドポイント
+# ETag / Last-Modified を付けるので、変更がなければブラウザのキャッシュが使われる
+@app.get("/api/snacks/wordcloud/images/{product_id}.png", tags=["DashBoard"])
+def get_wordcloud_png(
+    product_id: int,
+    organization_id: int = Query(...),
+    include_archived: bool = Query(False),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    try:
+        watermarks = get_wordcloud_watermarks(db, organization_id, [product_id], include_archived)
+        if product_id not in watermarks:
+            raise HTTPException(status_code=404, detail="No messages found for this product.")
+
+        latest_message_id, message_count = watermarks[product_id]
+        etag = f'"wc-{organization_id}-{product_id}-{latest_message_id}-{message_count}{"-a" if include_archived else ""}"'
+
+        # 最新メッセージの送信日時を Last-Modified にする（日本時間で保存されている）
+        last_modified = None
+        send_date = db.query(Message.send_date).filter(Message.message_id == latest_message_id).scalar()
+        if send_date is None and include_archived:
+            send_date = db.query(MessageArchive.send_date).filter(MessageArchive.message_id == latest_message_id).scalar()
+        if send_date:
+            if send_date.tzinfo is None:
+                send_date = japan_timezone.localize(send_date)
+            last_modified = send_date.astimezone(timezone.utc).replace(microsecond=0)
+
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if last_modified:
+            headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+        # 変更がなければ 304 Not Modified を返す（画像は生成しない）
+        if if_none_match is not None:
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+        elif if_modified_since and last_modified:
+            try:
+                if last_modified <= parsedate_to_datetime(if_modified_since):
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass  # 日付の形式が不正な場合は無視する
+
+        cache_key = (organization_id, (product_id,), (watermarks[product_id],), include_archived)
+        png = wordcloud_image_cache.get(cache_key)
+        if png is None:
+            frequencies = merge_term_frequencies(
+                get_product_term_frequencies(db, organization_id, [product_id], include_archived=include_archived), [product_id]
+            )
+            if not frequencies:
+                raise HTTPException(status_code=404, detail="No words found for this product.")
+            rendered, _ = render_wordclouds_parallel({product_id: (cache_key, frequencies)})
+            png = rendered.get(product_id)
+            if png is None:
+                raise HTTPException(status_code=503, detail="Word cloud rendering timed out.", headers={"Retry-After": "5"})
+
+        return Response(content=png, media_type="image/png", headers=headers)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # アプリケーションの起動: 環境変数 PORT が指定されていればそれを使用
 if __name__ == '__main__':
     import uvicorn
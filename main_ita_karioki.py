@@ -5,8 +5,10 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker, Session
 from dotenv import load_dotenv
+from typing import List
 from pydantic import BaseModel  # Pydanticモデルをインポート
 from create_db import Product  # 商品モデルをインポート
+from barcode_index import BarcodeIndex  # バーコードのインデックス
 
 # 環境変数の読み込み
 load_dotenv()
@@ -53,16 +55,56 @@ class ProductCreate(BaseModel):
     barcode: str
     name: str
 
+class BarcodeLookupRequest(BaseModel):
+    barcodes: List[str]
+
+# バーコードと商品名のインデックス（起動時に商品マスタを読み込み、add_product で追加する）
+barcode_index = BarcodeIndex(negative_ttl=float(os.getenv("BARCODE_NEGATIVE_TTL_SECONDS", 60)))
+
+# 一度にまとめて変換できるバーコードの数
+BARCODE_LOOKUP_MAX = 500
+
+@app.on_event("startup")
+def load_barcode_index():
+    db = SessionLocal()
+    try:
+        barcode_index.load(db)
+    except Exception as e:
+        # 読み込めなかった場合は、最初の検索時に読み込む
+        logger.warning(f"バーコードの読み込みエラー: {str(e)}")
+    finally:
+        db.close()
+
 # バーコードから商品名を取得するエンドポイント
 @app.get("/get_product_name")
 def get_product_name(barcode: str, db: Session = Depends(get_db)):
     try:
-        # バーコードに基づいて商品を検索
-        product = db.execute(select(Product).where(Product.barcode_number == barcode)).scalars().first()
-        if product:
-            return {"product_name": product.product_name}
+        # バーコードに基づいて商品を検索（メモリ上のインデックスから）
+        product_name = barcode_index.lookup(db, barcode)
+        if product_name is not None:
+            return {"product_name": product_name}
         else:
             raise HTTPException(status_code=404, detail="商品が見つかりません")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"商品検索時のエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail="サーバー内部エラー")
+
+# 複数のバーコードをまとめて商品名に変換するエンドポイント
+@app.post("/get_product_names")
+def get_product_names(request: BarcodeLookupRequest, db: Session = Depends(get_db)):
+    if len(request.barcodes) > BARCODE_LOOKUP_MAX:
+        raise HTTPException(status_code=400, detail=f"バーコードは一度に{BARCODE_LOOKUP_MAX}件までです")
+    try:
+        names = barcode_index.lookup_many(db, request.barcodes)
+        return {
+            "products": [
+                {"barcode": barcode, "product_name": names[barcode]}
+                for barcode in request.barcodes
+            ],
+            "not_found": [barcode for barcode in dict.fromkeys(request.barcodes) if names[barcode] is None],
+        }
     except Exception as e:
         logger.error(f"商品検索時のエラー: {str(e)}")
         raise HTTPException(status_code=500, detail="サーバー内部エラー")
@@ -83,6 +125,7 @@ def add_product(product: ProductCreate, db: Session = Depends(get_db)):
             )
             db.add(new_product)
             db.commit()
+            barcode_index.add(product.barcode, product.name)  # バーコードのインデックスにも追加
             return {"message": "商品が追加されました"}
     except Exception as e:
         logger.error(f"商品追加時のエラー: {str(e)}")
@@ -0,0 +1,95 @@
+# テストからリポジトリ直下のモジュール（main.py など）を読み込めるようにする
+import os
+import sys
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py を読み込む前に、実際のデータベースや Azure に接続しないよう環境変数を設定する
+os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "app.db"))
+os.environ.setdefault("WORDCLOUD_WORKERS", "0")
+os.environ.setdefault("STARTUP_BACKFILL_ENABLED", "0")
+
+import main  # noqa: E402
+
+
+# テストごとに新しい SQLite のデータベースを作り、そのセッションを作る関数を返す
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        connect_args={"check_same_thread": False, "timeout": 30},  # 書き込みが重なった場合はロックが外れるまで待つ
+    )
+    main.Base.metadata.create_all(bind=engine)
+    # 組織IDをキーにしたプロセス内のキャッシュは、前のテストのデータベースの内容なので捨てる
+    main.catalog_cache.backend = main.LocalCacheBackend()
+    main.wordcloud_image_cache.clear()
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    yield db
+    db.close()
+
+
+# 組織1（ユーザー1〜3、meitex商品1・2の在庫）と組織2（ユーザー4）を登録する
+@pytest.fixture
+def organization(db):
+    db.add_all([
+        main.Organization(organization_id=1, organization_name="org1"),
+        main.Organization(organization_id=2, organization_name="org2"),
+    ])
+    db.add_all([
+        main.UserInformation(user_id=user_id, user_name=user_name, organization_id=organization_id)
+        for user_id, user_name, organization_id in [(1, "山田太郎", 1), (2, "鈴木花子", 1), (3, "佐藤", 1), (4, "other", 2)]
+    ])
+    db.add_all([
+        main.MeitexProductMaster(meitex_product_id=1, product_name="チョコレート", product_image_url="u1", product_explanation="e"),
+        main.MeitexProductMaster(meitex_product_id=2, product_name="クッキー", product_image_url="u2", product_explanation="e"),
+    ])
+    db.add_all([main.IntegratedProduct(product_id=1, meitex_product_id=1), main.IntegratedProduct(product_id=2, meitex_product_id=2)])
+    db.add_all([
+        main.InventoryProduct(product_id=product_id, organization_id=1, sales_amount=100, stock_quantity=10)
+        for product_id in (1, 2)
+    ])
+    db.commit()
+    return 1
+
+
+# main.add_message でメッセージを追加する関数を返す
+@pytest.fixture
+def add_message():
+    def add(db, text, sender_user_id=1, receiver_user_id=2, product_id=1):
+        return main.add_message(main.MessageCreate(
+            message_content=text,
+            sender_user_id=sender_user_id,
+            receiver_user_id=receiver_user_id,
+            sender_user_name_manual_input="",
+            receiver_user_name_manual_input="",
+            product_id=product_id,
+        ), db=db)
+    return add
+
+
+# テスト用のデータベースを使う TestClient（起動時の処理は実行しない）
+@pytest.fixture
+def client(session_factory):
+    def get_test_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = get_test_db
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
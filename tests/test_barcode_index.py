@@ -0,0 +1,94 @@
+# バーコードのインデックス（barcode_index.BarcodeIndex）のテスト
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+
+import main
+from barcode_index import BarcodeIndex
+from create_db import Product
+
+
+@pytest.fixture
+def products_db(db):
+    Product.__table__.create(bind=db.get_bind())
+    db.add_all([
+        Product(product_id=1, product_name="チョコ", barcode_number="4901"),
+        Product(product_id=2, product_name="チョコ（重複）", barcode_number="4901"),
+        Product(product_id=3, product_name="クッキー", barcode_number="4902"),
+        Product(product_id=4, product_name="バーコードなし"),
+    ])
+    db.commit()
+    return db
+
+
+# 実行された SELECT 文の数を数える
+@pytest.fixture
+def count_selects(products_db):
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    engine = products_db.get_bind()
+    event.listen(engine, "before_cursor_execute", before_execute)
+    yield statements
+    event.remove(engine, "before_cursor_execute", before_execute)
+
+
+def test_lookup_many_keeps_first_product_per_barcode(products_db):
+    index = BarcodeIndex()
+    assert index.load(products_db) == 2
+    assert index.lookup_many(products_db, ["4902", "4901", "0000"]) == {"4902": "クッキー", "4901": "チョコ", "0000": None}
+    assert index.lookup(products_db, "4901") == "チョコ"
+
+
+def test_known_and_missing_barcodes_do_not_query_again(products_db, count_selects):
+    index = BarcodeIndex(negative_ttl=60)
+    index.load(products_db)
+    count_selects.clear()
+
+    index.lookup_many(products_db, ["4901", "0000", "0000"])
+    assert len(count_selects) == 1  # 見つからなかったバーコードだけを1回で検索
+    index.lookup_many(products_db, ["4901", "4902", "0000"])
+    assert len(count_selects) == 1
+
+
+def test_products_added_elsewhere_are_found(products_db):
+    index = BarcodeIndex(negative_ttl=0)
+    index.load(products_db)
+    assert index.lookup(products_db, "4903") is None
+
+    # 他のワーカーで追加された商品（見つからなかった記録の期限切れ後に検索する）
+    products_db.add(Product(product_id=5, product_name="キャンディ", barcode_number="4903"))
+    products_db.commit()
+    assert index.lookup(products_db, "4903") == "キャンディ"
+
+    # このワーカーで追加した商品は見つからなかった記録を消して登録する
+    index.add("4904", "ガム")
+    assert index.lookup(products_db, "4904") == "ガム"
+
+
+def test_negative_cache_is_bounded(products_db):
+    index = BarcodeIndex(negative_ttl=60, max_negative_entries=2)
+    for barcode in ("a", "b", "c"):
+        index.lookup(products_db, barcode)
+    assert list(index._negative) == ["b", "c"]  # 古いものから削除する
+
+
+def test_bulk_lookup_endpoint_keeps_request_order(products_db, monkeypatch):
+    monkeypatch.setattr(main, "barcode_index", BarcodeIndex())
+    result = main.get_product_names_by_barcodes(main.BarcodeLookupRequest(barcodes=["4902", "0000", "4901", "0000"]), db=products_db)
+    assert result == {
+        "products": [
+            {"barcode": "4902", "product_name": "クッキー"},
+            {"barcode": "0000", "product_name": None},
+            {"barcode": "4901", "product_name": "チョコ"},
+            {"barcode": "0000", "product_name": None},
+        ],
+        "not_found": ["0000"],
+    }
+
+    with pytest.raises(HTTPException) as error:
+        main.get_product_names_by_barcodes(main.BarcodeLookupRequest(barcodes=["1"] * (main.BARCODE_LOOKUP_MAX + 1)), db=products_db)
+    assert error.value.status_code == 400
@@ -0,0 +1,64 @@
+# 販売価格・在庫数の一括更新（/inventory_products/{organization_id}/bulk_update）のテスト
+import main
+
+
+def inventory(db):
+    db.expire_all()
+    return {
+        product_id: (sales_amount, stock_quantity)
+        for product_id, sales_amount, stock_quantity in db.query(
+            main.InventoryProduct.product_id, main.InventoryProduct.sales_amount, main.InventoryProduct.stock_quantity
+        ).filter(main.InventoryProduct.organization_id == 1)
+    }
+
+
+def ledger(db):
+    return [
+        (entry.product_id, entry.event_type, entry.quantity_change)
+        for entry in db.query(main.InventoryLedgerEntry).order_by(main.InventoryLedgerEntry.ledger_entry_id)
+    ]
+
+
+def test_valid_rows_are_applied_together(client, db, organization):
+    response = client.put("/inventory_products/1/bulk_update", json={"items": [
+        {"product_id": 1, "sales_amount": 120, "stock_quantity": 7},
+        {"product_id": 2, "sales_amount": 80},
+    ]})
+    assert response.status_code == 200, response.text
+    results = response.json()["results"]
+    assert [(result["status"], result["previous_stock_quantity"]) for result in results] == [("ok", 10), ("ok", 10)]
+    assert inventory(db) == {1: (120, 7), 2: (80, 10)}
+    assert ledger(db)[-1] == (1, "adjustment", -3)  # 在庫数の変更だけを記録する
+
+
+def test_one_bad_row_rejects_the_whole_update(client, db, organization):
+    before_inventory, before_ledger = inventory(db), ledger(db)
+    response = client.put("/inventory_products/1/bulk_update", json={"items": [
+        {"product_id": 1, "sales_amount": 150},
+        {"product_id": 2, "stock_quantity": -1},
+        {"product_id": 99, "stock_quantity": 1},
+        {"product_id": 1, "stock_quantity": 3},
+        {"product_id": 2},
+    ]})
+    assert response.status_code == 400
+    assert [result["status"] for result in response.json()["results"]] == ["not_applied", "invalid", "not_found", "invalid", "invalid"]
+    assert inventory(db) == before_inventory
+    assert ledger(db) == before_ledger
+
+    # 他の組織の商品は見つからない扱い
+    response = client.put("/inventory_products/2/bulk_update", json={"items": [{"product_id": 1, "sales_amount": 1}]})
+    assert [result["status"] for result in response.json()["results"]] == ["not_found"]
+    assert client.put("/inventory_products/1/bulk_update", json={"items": []}).status_code == 400
+
+
+def test_csv_upload_reports_rows_by_line(client, db, organization):
+    csv_text = "product_id,sales_amount,stock_quantity\n1,110,\n2,abc,5\n"
+    response = client.post("/inventory_products/1/bulk_update/csv", files={"file": ("items.csv", csv_text.encode("utf-8-sig"))})
+    assert response.status_code == 400
+    assert [(result["row"], result["status"]) for result in response.json()["results"]] == [(2, "not_applied"), (3, "invalid")]
+    assert inventory(db)[1] == (100, 10)
+
+    csv_text = "product_id,stock_quantity\n2,4\n"
+    response = client.post("/inventory_products/1/bulk_update/csv", files={"file": ("items.csv", csv_text.encode("utf-8"))})
+    assert response.status_code == 200, response.text
+    assert inventory(db)[2] == (100, 4)
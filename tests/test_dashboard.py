@@ -0,0 +1,31 @@
+# ダッシュボードの一括取得（/api/dashboard/{organization_id}）のテスト
+import main
+
+
+def test_dashboard_returns_every_section(session_factory, db, organization, add_message, monkeypatch):
+    monkeypatch.setattr(main, "SessionLocal", session_factory)  # 各項目はスレッドごとに新しいセッションで集計する
+    add_message(db, "チョコレートありがとう")
+    add_message(db, "クッキーおいしい", sender_user_id=2, receiver_user_id=1, product_id=2)
+    add_message(db, "またチョコレート", product_id=1)
+
+    dashboard = main.get_dashboard(organization, db=db)
+
+    assert "errors" not in dashboard
+    assert set(main.DASHBOARD_SECTIONS) <= set(dashboard)
+    assert dashboard["total_messages"] == 3
+    assert dashboard["send_ranking"][0] == {"sender_name": "山田太郎", "message_count": 2}
+    assert dashboard["snack_ranking"][0] == {"product_name": "チョコレート", "purchase_count": 2}
+    assert set(dashboard["timings_ms"]) == set(main.DASHBOARD_SECTIONS) | {"total"}
+
+
+def test_failed_section_does_not_hide_the_others(session_factory, db, organization, monkeypatch):
+    monkeypatch.setattr(main, "SessionLocal", session_factory)
+
+    def fail(db, organization_id):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(main.DASHBOARD_SECTIONS, "snack_ranking", fail)
+    dashboard = main.get_dashboard(organization, db=db)
+    assert dashboard["errors"] == {"snack_ranking": "boom"}
+    assert dashboard["snack_ranking"] is None
+    assert dashboard["total_messages"] == 0
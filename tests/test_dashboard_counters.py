@@ -0,0 +1,54 @@
+# ダッシュボードの集計値（dashboard_counters）のテスト
+import threading
+
+import main
+
+
+def test_counters_follow_new_messages(db, organization, add_message):
+    add_message(db, "チョコレートありがとう")
+    main.ensure_dashboard_counters(db, organization)
+    assert main.get_dashboard_counter(db, organization, "total") == 1
+
+    # 作成済みの組織は、メッセージの追加時に加算される
+    add_message(db, "クッキーおいしい", sender_user_id=2, receiver_user_id=1, product_id=2)
+    assert main.get_dashboard_counter(db, organization, "total") == 2
+    assert main.rebuild_dashboard_counters(db, organization, verify_only=True)["mismatches"] == []
+
+
+def test_message_added_during_first_rebuild_is_counted(session_factory, db, organization, add_message, monkeypatch):
+    # 最初の集計値の作成中に別のリクエストがメッセージを追加しても、集計値から漏れないことを確かめる
+    add_message(db, "チョコレートありがとう")
+
+    writer_started = threading.Event()
+    writer_errors = []
+
+    def write_message():
+        writer_db = session_factory()
+        try:
+            writer_started.set()
+            add_message(writer_db, "作成中に届いたメッセージ", sender_user_id=2, receiver_user_id=1)
+        except Exception as e:
+            writer_errors.append(e)
+        finally:
+            writer_db.close()
+
+    writer = threading.Thread(target=write_message)
+    compute = main.compute_dashboard_counters
+
+    def compute_while_writing(db, organization_id):
+        # メッセージを数え終わって集計値を書き込む前に、別のスレッドがメッセージを追加する
+        expected = compute(db, organization_id)
+        writer.start()
+        writer_started.wait()
+        writer.join(timeout=0.5)  # 集計値の作成が終わるまでロックで待たされる
+        return expected
+
+    monkeypatch.setattr(main, "compute_dashboard_counters", compute_while_writing)
+    main.ensure_dashboard_counters(db, organization)
+    monkeypatch.setattr(main, "compute_dashboard_counters", compute)
+    writer.join()
+
+    assert writer_errors == []
+    db.expire_all()
+    assert main.get_dashboard_counter(db, organization, "total") == 2
+    assert main.rebuild_dashboard_counters(db, organization, verify_only=True)["mismatches"] == []
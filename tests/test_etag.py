@@ -0,0 +1,34 @@
+# 一覧のエンドポイントの ETag（304 Not Modified）のテスト
+import main
+
+
+def test_unchanged_lists_return_304_without_loading(client, db, organization, add_message, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("304 を返す前に一覧を読み込んだ")
+
+    add_message(db, "ありがとう")
+    for path, params in (
+        ("/messages/", {"organization_id": 1}),
+        ("/products/1", {}),
+        ("/inventory_products/1", {}),
+        ("/get_user_information/", {"organization_id": 1}),
+    ):
+        first = client.get(path, params=params)
+        assert first.status_code == 200, path
+        etag = first.headers["ETag"]
+
+        # 変更がなければ、一覧を読み込まずに 304 を返す
+        with monkeypatch.context() as patch:
+            for name in ("load_organization_users", "load_inventory_stock", "query_organization_messages"):
+                patch.setattr(main, name, fail)
+            assert client.get(path, params=params, headers={"If-None-Match": etag}).status_code == 304, path
+
+
+def test_new_message_changes_the_messages_etag(client, db, organization, add_message):
+    add_message(db, "ありがとう")
+    etag = client.get("/messages/", params={"organization_id": 1}).headers["ETag"]
+    add_message(db, "もう一度")
+    response = client.get("/messages/", params={"organization_id": 1}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["messages"]) == 2
@@ -0,0 +1,51 @@
+# inventory_forecast.forecast_inventory のテスト
+from datetime import date, timedelta
+
+import numpy as np
+
+from inventory_forecast import build_daily_matrix, forecast_inventory
+
+
+def test_sparse_old_consumption_is_not_forecast():
+    # 一番古い日に1回だけ購入がある商品は、消費ペースがほぼ 0 になる
+    # 在庫切れまでの日数が極端に大きくなるので、予測できないもの（inf）として扱う
+    for window_days in (28, 120, 365):
+        consumption = np.zeros((1, window_days))
+        consumption[0, 0] = 1
+        forecast = forecast_inventory([15], consumption, max_days=window_days * 4)
+
+        days_remaining = forecast["days_remaining"][0]
+        assert np.isinf(days_remaining)
+        assert not forecast["needs_reorder"][0]
+        assert forecast["suggested_quantity"][0] == 0
+        # 日付を作っても範囲外にならない
+        assert date.today() + timedelta(days=window_days * 4) > date.today()
+
+
+def test_steady_consumption_suggests_reorder():
+    consumption = np.full((2, 28), 2.0)
+    forecast = forecast_inventory([4, 100], consumption, lead_time_days=3, target_days=14)
+
+    np.testing.assert_allclose(forecast["daily_rate"], [2.0, 2.0])
+    np.testing.assert_allclose(forecast["days_remaining"], [2.0, 50.0])
+    assert forecast["needs_reorder"].tolist() == [True, False]
+    assert forecast["suggested_quantity"].tolist() == [30, 0]  # 2 × (3 + 14) - 4
+
+
+def test_no_consumption_is_infinite():
+    forecast = forecast_inventory([5], np.zeros((1, 28)))
+    assert np.isinf(forecast["days_remaining"][0])
+    assert forecast["suggested_quantity"][0] == 0
+
+
+def test_build_daily_matrix_sums_rows_and_ignores_out_of_range():
+    start = date(2026, 1, 1)
+    rows = [
+        (1, start, 2),
+        (1, start, 3),
+        (2, start + timedelta(days=2), 1),
+        (2, start + timedelta(days=5), 9),  # 期間外
+        (3, start, 9),  # 対象外の商品
+    ]
+    matrix = build_daily_matrix([1, 2], rows, start, 3)
+    assert matrix.tolist() == [[5, 0, 0], [0, 0, 1]]
@@ -0,0 +1,75 @@
+# いいね（like_message と LikeBuffer）のテスト
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def message_id(db, organization, add_message):
+    add_message(db, "ありがとう")
+    return db.query(main.Message.message_id).scalar()
+
+
+def count_of_likes(db, message_id):
+    db.expire_all()
+    return db.query(main.Message.count_of_likes).filter(main.Message.message_id == message_id).scalar() or 0
+
+
+@pytest.fixture
+def like_buffer(session_factory, monkeypatch):
+    # 自動では書き込まない（flush を呼んだときだけ書き込む）バッファを、テスト用のデータベースで使う
+    buffer = main.LikeBuffer(flush_interval=60)
+    monkeypatch.setattr(main, "like_buffer", buffer)
+    monkeypatch.setattr(main, "SessionLocal", session_factory)
+    return buffer
+
+
+def test_same_user_is_counted_once(db, message_id, monkeypatch):
+    monkeypatch.setattr(main, "like_buffer", None)
+    assert main.like_message(message_id, user_id=2, db=db) == {"message": "いいね数が増加しました"}
+    assert main.like_message(message_id, user_id=2, db=db) == {"message": "既にいいねされています"}
+    main.like_message(message_id, user_id=3, db=db)
+    assert count_of_likes(db, message_id) == 2
+
+
+def test_like_record_is_rolled_back_with_a_failed_increment(db, message_id, like_buffer, monkeypatch):
+    # いいね数の加算に失敗した場合は記録も残らず、もう一度いいねできる
+    def fail(db, increments):
+        raise RuntimeError("database is down")
+
+    apply = main.apply_like_increments
+    monkeypatch.setattr(main, "apply_like_increments", fail)
+    with pytest.raises(HTTPException):
+        main.like_message(message_id, user_id=2, db=db)
+    db.rollback()
+    assert db.query(main.Likes).count() == 0
+
+    monkeypatch.setattr(main, "apply_like_increments", apply)
+    main.like_message(message_id, user_id=2, db=db)
+    # ユーザーを指定したいいねはバッファを通さず、記録と一緒に書き込まれている
+    assert like_buffer.pending(message_id) == 0
+    assert count_of_likes(db, message_id) == 1
+    assert db.query(main.Likes).count() == 1
+
+
+def test_anonymous_likes_are_coalesced_and_retried(db, message_id, like_buffer, monkeypatch):
+    for _ in range(5):
+        main.like_message(message_id, user_id=None, db=db)
+    assert like_buffer.pending(message_id) == 5
+    assert count_of_likes(db, message_id) == 0
+
+    # 書き込みに失敗した分は、次の書き込みまで残る
+    apply = main.apply_like_increments
+
+    def fail(db, increments):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(main, "apply_like_increments", fail)
+    like_buffer.flush()
+    assert like_buffer.pending(message_id) == 5
+
+    monkeypatch.setattr(main, "apply_like_increments", apply)
+    like_buffer.flush()
+    assert like_buffer.pending(message_id) == 0
+    assert count_of_likes(db, message_id) == 5
@@ -0,0 +1,79 @@
+# 在庫少の通知（check_low_stock と閾値のエンドポイント）のテスト
+import pytest
+
+import main
+
+
+@pytest.fixture
+def alert_queue(monkeypatch):
+    sink = main.QueueAlertSink(maxsize=100)
+    monkeypatch.setattr(main, "low_stock_alerts", main.LowStockAlertDispatcher([sink]))
+    return sink.queue
+
+
+def drain(alert_queue):
+    alerts = []
+    while not alert_queue.empty():
+        alert = alert_queue.get_nowait()
+        alerts.append((alert["product_id"], alert["stock_quantity"]))
+    return alerts
+
+
+def purchase(client, product_id, quantity):
+    response = client.put("/inventory_products/purchase/", json={
+        "organization_id": 1, "purchases": [{"product_id": product_id, "purchase_quantity": quantity}],
+    })
+    assert response.status_code == 200, response.text
+
+
+def adjust(client, product_id, quantity_change):
+    response = client.post("/inventory_products/1/adjustments", json={"product_id": product_id, "quantity_change": quantity_change})
+    assert response.status_code == 200, response.text
+
+
+def set_thresholds(client, thresholds):
+    return client.put("/inventory_products/1/low_stock_thresholds", json={
+        "thresholds": [{"product_id": product_id, "threshold": threshold} for product_id, threshold in thresholds.items()],
+    })
+
+
+def test_alert_is_sent_once_until_stock_recovers(client, organization, alert_queue):
+    assert set_thresholds(client, {1: 5}).json()["alerts"] == []
+
+    purchase(client, 1, 5)  # 在庫 5（閾値以下になった）
+    purchase(client, 1, 1)  # 在庫 4（通知済み）
+    assert drain(alert_queue) == [(1, 5)]
+
+    adjust(client, 1, 3)  # 在庫 7（回復）
+    assert drain(alert_queue) == []
+    purchase(client, 1, 3)  # 在庫 4（再び閾値以下）
+    assert drain(alert_queue) == [(1, 4)]
+
+    thresholds = client.get("/inventory_products/1/low_stock_thresholds").json()
+    assert [(row["product_id"], row["alert_active"]) for row in thresholds] == [(1, True)]
+
+
+def test_setting_a_threshold_checks_current_stock(client, organization, alert_queue):
+    result = set_thresholds(client, {2: 10}).json()
+    assert [(alert["product_id"], alert["threshold"]) for alert in result["alerts"]] == [(2, 10)]
+    assert drain(alert_queue) == [(2, 10)]
+
+    # 閾値を変えても回復するまでは通知しない
+    assert set_thresholds(client, {2: 12}).json()["alerts"] == []
+    # 閾値を削除した商品は通知しない
+    assert set_thresholds(client, {2: None}).json()["removed"] == 1
+    purchase(client, 2, 1)
+    assert drain(alert_queue) == []
+
+    assert set_thresholds(client, {1: -1}).status_code == 400
+
+
+def test_failing_sink_does_not_stop_other_sinks():
+    class FailingSink:
+        def send(self, alert):
+            raise RuntimeError("down")
+
+    sink = main.QueueAlertSink(maxsize=2)
+    main.LowStockAlertDispatcher([FailingSink(), sink]).emit([{"product_id": n} for n in range(3)])
+    # キューがいっぱいの場合は古い通知から捨てる
+    assert [sink.queue.get_nowait()["product_id"] for _ in range(2)] == [1, 2]
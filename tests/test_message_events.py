@@ -0,0 +1,89 @@
+# 組織ごとのメッセージのイベント配信（OrganizationEventHub）のテスト
+import asyncio
+
+import main
+
+
+def event_sequence(event):
+    return int(event["id"].split(":")[1])
+
+
+def test_sequences_are_per_organization():
+    hub = main.OrganizationEventHub(replay_size=10, queue_size=10)
+    hub.publish(1, "message", {"n": 1})
+    hub.publish(2, "message", {"n": 2})
+    hub.publish(1, "like", {"n": 3})
+
+    subscriber, missed, reset = hub.subscribe(1, f"{hub.epoch}:0")
+    assert [(event_sequence(event), event["data"]) for event in missed] == [(1, {"n": 1}), (2, {"n": 3})]
+    assert not reset
+    subscriber, missed, reset = hub.subscribe(2, f"{hub.epoch}:1")
+    assert missed == [] and not reset
+
+
+def test_reconnect_replays_or_resets():
+    hub = main.OrganizationEventHub(replay_size=2, queue_size=10)
+    for n in range(3):
+        hub.publish(1, "message", {"n": n})
+
+    # 再送用のバッファに残っている続きは再送する
+    _, missed, reset = hub.subscribe(1, f"{hub.epoch}:1")
+    assert [event_sequence(event) for event in missed] == [2, 3] and not reset
+    # 最初のイベントは既にバッファから消えている
+    _, missed, reset = hub.subscribe(1, f"{hub.epoch}:0")
+    assert reset
+    # 再起動前のIDや、まだ使われていない連番は続きが分からない
+    assert hub.subscribe(1, "00000000:3")[2]
+    assert hub.subscribe(1, f"{hub.epoch}:9")[2]
+    # イベントIDなしの接続は新しいイベントだけを受け取る
+    assert hub.subscribe(1)[1:] == ([], False)
+
+
+def test_events_published_before_subscribing_are_not_delivered_twice():
+    async def scenario():
+        hub = main.OrganizationEventHub(replay_size=10, queue_size=10)
+        hub.attach_loop(asyncio.get_running_loop())
+        early, _, _ = hub.subscribe(1)
+        hub.publish(1, "message", {"n": 1})  # イベントループへの受け渡しはまだ終わっていない
+        subscriber, missed, _ = hub.subscribe(1, f"{hub.epoch}:0")
+        hub.publish(1, "message", {"n": 2})
+        hub.publish(2, "message", {"n": 3})
+        await asyncio.sleep(0)
+
+        assert [event["data"] for event in missed] == [{"n": 1}]
+        assert [subscriber.queue.get_nowait()["data"]] == [{"n": 2}]
+        assert subscriber.queue.empty()
+        assert early.queue.qsize() == 2
+
+        hub.unsubscribe(subscriber)
+        hub.publish(1, "message", {"n": 4})
+        await asyncio.sleep(0)
+        assert subscriber.queue.empty()
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_is_marked_lagged():
+    async def scenario():
+        hub = main.OrganizationEventHub(replay_size=10, queue_size=1)
+        hub.attach_loop(asyncio.get_running_loop())
+        subscriber, _, _ = hub.subscribe(1)
+        hub.publish(1, "message", {"n": 1})
+        hub.publish(1, "message", {"n": 2})
+        await asyncio.sleep(0)
+        assert subscriber.lagged
+        assert subscriber.queue.qsize() == 1
+
+    asyncio.run(scenario())
+
+
+def test_new_message_is_published_to_the_sender_organization(db, organization, add_message, monkeypatch):
+    hub = main.OrganizationEventHub(replay_size=10, queue_size=10)
+    monkeypatch.setattr(main, "message_event_hub", hub)
+    add_message(db, "ありがとう")
+
+    _, missed, _ = hub.subscribe(1, f"{hub.epoch}:0")
+    assert [event["type"] for event in missed] == ["message"]
+    assert missed[0]["data"]["sender_user_name"] == "山田太郎"
+    assert missed[0]["data"]["message_content"] == "ありがとう"
+    assert hub.subscribe(2, f"{hub.epoch}:0")[1] == []
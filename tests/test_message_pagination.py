@@ -0,0 +1,57 @@
+# メッセージ一覧のカーソル（before_message_id）によるページ分割のテスト
+import main
+
+
+def add_comment(db, message_id, text):
+    main.add_comment(main.CommentRequest(
+        message_id=message_id, comment_user_id=2, comment_user_name_manual_input="", message_content=text,
+    ), db=db)
+
+
+def collect_pages(client, path, params):
+    pages = []
+    cursor = None
+    while True:
+        page = client.get(path, params={**params, **({"before_message_id": cursor} if cursor else {})}).json()
+        pages.append([message["message_id"] for message in page["messages"]])
+        cursor = page["next_before_message_id"]
+        if cursor is None:
+            return pages
+
+
+def test_organization_feed_pages_follow_the_cursor(client, db, organization, add_message):
+    for n in range(5):
+        add_message(db, f"メッセージ{n}")
+    add_message(db, "他の組織", sender_user_id=4, receiver_user_id=4)
+    for n in range(3):
+        add_comment(db, 2, f"コメント{n}")
+
+    assert collect_pages(client, "/messages/", {"organization_id": 1, "limit": 2}) == [[5, 4], [3, 2], [1]]
+
+    # コメントが多くてもメッセージの件数は limit のまま（コメント数の上限と総数）
+    page = client.get("/messages/", params={"organization_id": 1, "limit": 2, "before_message_id": 3, "comments_per_message": 1}).json()
+    assert [message["message_id"] for message in page["messages"]] == [2, 1]
+    assert [len(message["reply_comments"]) for message in page["messages"]] == [1, 0]
+    assert [message["reply_comment_count"] for message in page["messages"]] == [3, 0]
+
+    # limit を指定しない場合は全件を昇順で返す
+    all_messages = client.get("/messages/", params={"organization_id": 1}).json()["messages"]
+    assert [message["message_id"] for message in all_messages] == [1, 2, 3, 4, 5]
+
+
+def test_page_boundary_ends_the_feed(client, db, organization, add_message):
+    for n in range(4):
+        add_message(db, f"メッセージ{n}")
+    # ちょうど割り切れる場合は、最後に空のページを返してカーソルを終える
+    assert collect_pages(client, "/messages/", {"organization_id": 1, "limit": 2}) == [[4, 3], [2, 1], []]
+
+
+def test_conversation_pages_include_both_directions(client, db, organization, add_message):
+    add_message(db, "1→2")  # 1
+    add_message(db, "2→1", sender_user_id=2, receiver_user_id=1)  # 2
+    add_message(db, "1→3", receiver_user_id=3)  # 3
+    add_message(db, "1→2 クッキー", product_id=2)  # 4
+    add_message(db, "1→2 again")  # 5
+
+    params = {"sender_user_id": 2, "receiver_user_id": 1, "product_id": 1, "limit": 2}
+    assert collect_pages(client, "/get_messages/", params) == [[5, 2], [1]]
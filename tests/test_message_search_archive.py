@@ -0,0 +1,71 @@
+# メッセージの全文検索（BM25）と古いメッセージの保管のテスト
+from datetime import datetime, timedelta
+
+import main
+
+
+def hits(db, text, **kwargs):
+    _, total, results = main.search_message_documents(db, 1, text, **kwargs)
+    return total, [(message_id, archived) for _, message_id, _, archived in results]
+
+
+def make_old(db, *message_ids, days=400):
+    db.query(main.Message).filter(main.Message.message_id.in_(message_ids)).update(
+        {main.Message.send_date: datetime.now() - timedelta(days=days)}, synchronize_session=False
+    )
+    db.commit()
+
+
+def message_ids(db, model):
+    return sorted(message_id for message_id, in db.query(model.message_id))
+
+
+def test_documents_matching_more_terms_rank_first(db, organization, add_message):
+    add_message(db, "チョコレートありがとう")  # 1
+    add_message(db, "おいしいチョコレートありがとう")  # 2
+    add_message(db, "クッキーありがとう", product_id=2)  # 3
+    add_message(db, "おいしいクッキー", sender_user_id=4, receiver_user_id=4)  # 組織2
+
+    assert hits(db, "おいしい チョコレート") == (2, [(2, False), (1, False)])
+    assert hits(db, "おいしい") == (1, [(2, False)])
+    assert hits(db, "ありがとう", product_id=2) == (1, [(3, False)])
+    assert hits(db, "ありがとう", limit=1, offset=1)[0] == 3
+    assert hits(db, "存在しない単語") == (0, [])
+
+
+def test_archived_messages_are_searchable_on_request(db, organization, add_message):
+    add_message(db, "古いチョコレート")  # 1
+    add_message(db, "古いクッキー", product_id=2)  # 2
+    add_message(db, "新しいチョコレート")  # 3
+    make_old(db, 1, 2)
+
+    result = main.archive_old_messages(db, older_than_days=30)
+    assert (result["archived_messages"], message_ids(db, main.MessageArchive)) == (2, [1, 2])
+    assert message_ids(db, main.Message) == [3]
+
+    assert hits(db, "チョコレート") == (1, [(3, False)])
+    assert hits(db, "チョコレート", include_archived=True) == (2, [(3, False), (1, True)])
+    assert "クッキー" not in main.build_wordcloud_frequencies(db, 1)
+    assert main.build_wordcloud_frequencies(db, 1, include_archived=True)["クッキー"]["古い"] == 1
+
+    # 集計値（全期間）は保管したメッセージも含めて数える
+    main.ensure_dashboard_counters(db, 1)
+    assert main.get_dashboard_counter(db, 1, "total") == 3
+
+
+def test_newest_message_is_kept_so_ids_are_not_reused(db, organization, add_message):
+    add_message(db, "一つ目")
+    add_message(db, "二つ目")
+    make_old(db, 1, 2)
+
+    main.archive_old_messages(db, older_than_days=30)
+    assert message_ids(db, main.MessageArchive) == [1]
+    assert message_ids(db, main.Message) == [2]
+
+    # 次のメッセージは保管済みのIDを再利用しない
+    add_message(db, "三つ目")
+    assert message_ids(db, main.Message) == [2, 3]
+    make_old(db, 2, 3)
+    main.archive_old_messages(db, older_than_days=30)
+    assert message_ids(db, main.MessageArchive) == [1, 2]
+    assert message_ids(db, main.Message) == [3]
@@ -0,0 +1,34 @@
+# 名前の揺れをまとめた送信・受信ランキング（resolve_name_identities / get_name_leaderboard）のテスト
+import main
+
+
+def leaderboard(db, role):
+    return [(row.name, row.message_count) for row in main.get_name_leaderboard(db, 1, role)]
+
+
+def test_similar_names_share_one_identity(db, organization):
+    resolved = main.resolve_name_identities(db, 1, ["佐藤一郎", "田中", "佐藤 一郎", "佐藤一郎", ""])
+    assert set(resolved) == {"佐藤一郎", "田中", "佐藤 一郎"}
+    assert resolved["佐藤一郎"] == resolved["佐藤 一郎"] != resolved["田中"]
+
+    # 2回目以降は対応表から取得し、既存グループの代表名と比べて割り当てる
+    again = main.resolve_name_identities(db, 1, ["佐藤  一郎", "田中"])
+    assert again == {"佐藤  一郎": resolved["佐藤一郎"], "田中": resolved["田中"]}
+    canonical = dict(db.query(main.NameIdentity.name_identity_id, main.NameIdentity.canonical_name))
+    assert canonical[resolved["佐藤一郎"]] == "佐藤一郎"  # 先に処理した名前が代表名
+
+    # 別の組織の名前は別のグループ
+    assert main.resolve_name_identities(db, 2, ["佐藤一郎"])["佐藤一郎"] not in canonical
+
+
+def test_leaderboard_counts_name_variants_together(db, organization, add_message):
+    add_message(db, "1")
+    add_message(db, "2")
+    main.add_message(main.MessageCreate(
+        message_content="3", sender_user_id=1, receiver_user_id=2,
+        sender_user_name_manual_input="山田 太郎", receiver_user_name_manual_input="鈴木 花子", product_id=1,
+    ), db=db)
+    add_message(db, "4", sender_user_id=2, receiver_user_id=3)
+
+    assert leaderboard(db, "sender") == [("山田太郎", 3), ("鈴木花子", 1)]
+    assert leaderboard(db, "receiver") == [("鈴木花子", 3), ("佐藤", 1)]
@@ -0,0 +1,73 @@
+# 商品名のあいまい検索（ProductSearchIndex）のテスト
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import main
+
+
+@pytest.fixture
+def chocolates_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chocolates.db'}", connect_args={"check_same_thread": False})
+    main.ChocolatesBase.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = Session()
+    db.add(main.ChocolateDB(Index=1, Product_Name="ダークチョコレート", Image_Url="c1"))
+    db.commit()
+    db.close()
+    yield Session
+    engine.dispose()
+
+
+@pytest.fixture
+def search_index(session_factory, chocolates_session_factory, organization, monkeypatch):
+    monkeypatch.setattr(main, "SessionLocal", session_factory)
+    monkeypatch.setattr(main, "chocolates_SessionLocal", chocolates_session_factory)
+    return main.ProductSearchIndex()
+
+
+def test_search_normalizes_width_and_kana(search_index, db):
+    db.add(main.IndependentProductMaster(independent_product_id=1, organization_id=1, product_name="ポテトチップス", product_image_url="u10"))
+    db.add(main.IntegratedProduct(product_id=10, independent_product_id=1))
+    db.commit()
+    results = search_index.search("ﾎﾟﾃﾄﾁｯﾌﾟｽ", organization_id=1)
+    assert results[0][1]["product_id"] == 10
+    # 他の組織の独自商品は検索しない
+    assert all(entry.get("product_id") != 10 for _, entry in search_index.search("ぽてとちっぷす", organization_id=2))
+    # 名前全体が近い商品が先になる
+    assert [entry["product_name"] for _, entry in search_index.search("ちょこれーと")][:2] == ["チョコレート", "ダークチョコレート"]
+
+
+def test_concurrent_first_searches_load_once(search_index, monkeypatch):
+    loads = []
+    read = main.ProductSearchIndex._read
+
+    def slow_read(self, db, chocolates_db):
+        loads.append(1)
+        time.sleep(0.2)
+        return read(self, db, chocolates_db)
+
+    monkeypatch.setattr(main.ProductSearchIndex, "_read", slow_read)
+    threads = [threading.Thread(target=search_index.search, args=("クッキー",)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+
+
+def test_product_added_during_load_is_kept(search_index, monkeypatch):
+    read = main.ProductSearchIndex._read
+
+    def read_while_adding(self, db, chocolates_db):
+        loaded = read(self, db, chocolates_db)
+        # 読み込み後、差し替える前に独自商品が追加された
+        self.add_independent(1, 11, "せんべい", "u11")
+        return loaded
+
+    monkeypatch.setattr(main.ProductSearchIndex, "_read", read_while_adding)
+    search_index.ensure_loaded()
+    assert search_index.search("せんべい", organization_id=1)[0][1]["product_id"] == 11
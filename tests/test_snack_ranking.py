@@ -0,0 +1,43 @@
+# お菓子購入ランキング（get_snack_ranking_rows）の期間指定のテスト
+from datetime import datetime, timedelta
+
+import main
+
+
+def ranking(db, **kwargs):
+    return [(row.product_name, row.purchase_count) for row in main.get_snack_ranking_rows(db, 1, **kwargs)]
+
+
+def test_ranking_is_limited_to_the_requested_days(db, organization, add_message):
+    # 10日前のメッセージは直接追加し、集計値は作り直しで日ごとの集計に含める
+    today = datetime.now(main.japan_timezone).date()
+    old_day = today - timedelta(days=10)
+    db.add_all([
+        main.Message(sender_user_id=1, receiver_user_id=2, product_id=2, message_content="old",
+                     send_date=datetime.combine(old_day, datetime.min.time()) + timedelta(hours=12))
+        for _ in range(3)
+    ])
+    db.commit()
+    main.rebuild_dashboard_counters(db, 1)
+
+    # 今日のメッセージはメッセージ追加時の加算で日ごとの集計に含まれる
+    add_message(db, "今日のチョコ", product_id=1)
+    add_message(db, "今日のチョコ2", product_id=1)
+    add_message(db, "今日のクッキー", product_id=2)
+
+    assert ranking(db) == [("クッキー", 4), ("チョコレート", 2)]
+    assert ranking(db, since=today) == [("チョコレート", 2), ("クッキー", 1)]
+    assert ranking(db, since=old_day, until=old_day) == [("クッキー", 3)]
+    assert ranking(db, since=today, limit=1) == [("チョコレート", 2)]
+    assert ranking(db, until=old_day - timedelta(days=1)) == []
+
+
+def test_other_organizations_are_not_counted(db, organization, add_message):
+    db.add(main.UserInformation(user_id=5, user_name="other2", organization_id=2))
+    db.commit()
+    add_message(db, "他の組織", sender_user_id=4, receiver_user_id=5, product_id=1)
+    add_message(db, "自分の組織", product_id=2)
+
+    today = datetime.now(main.japan_timezone).date()
+    assert ranking(db, since=today) == [("クッキー", 1)]
+    assert ranking(db) == [("クッキー", 1)]
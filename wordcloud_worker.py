@@ -0,0 +1,63 @@
+# ワードクラウド画像の生成と形態素解析をワーカープロセスで行うためのモジュール
+# ワーカープロセスが main.py（Azureやデータベースの初期化）を読み込まずに済むよう、別ファイルにしている
+import io
+
+from wordcloud import WordCloud
+from janome.tokenizer import Tokenizer
+
+# ワーカープロセスごとに1つだけ作るフォントパスとトークナイザー
+_font_path = None
+_tokenizer = None
+
+
+def get_tokenizer():
+    # Janomeのトークナイザー（辞書の読み込みが重いので、プロセス内で1つだけ作って使い回す）
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer
+
+
+# 形態素解析で特定の品詞をフィルタリングする関数
+def split_into_filtered_words(text):
+    tokenizer = get_tokenizer()
+    # 抽出する品詞（名詞、動詞、形容詞、副詞）
+    allowed_pos = ["名詞", "動詞", "形容詞", "副詞"]
+    words = [
+        token.surface
+        for token in tokenizer.tokenize(text)
+        if any(pos in token.part_of_speech for pos in allowed_pos)  # 品詞が条件に一致するか
+    ]
+    return words
+
+
+# 複数のテキストをまとめて形態素解析する関数（バックフィル時にワーカーへ渡す）
+def split_texts_into_filtered_words(texts):
+    return [split_into_filtered_words(text) if text else [] for text in texts]
+
+
+# 単語の出現回数からワードクラウドのPNG画像（バイト列）を生成する関数
+def render_wordcloud_png(frequencies, font_path=None):
+    # 日本語対応のフォントを指定
+    wordcloud = WordCloud(
+        width=800,
+        height=400,
+        background_color="white",
+        font_path=font_path or _font_path,  # 環境変数や指定パスを使用
+        #collocations=False  #連語を無効化
+    ).generate_from_frequencies(frequencies)
+
+    # 画像をメモリに保存
+    img_buffer = io.BytesIO()
+    wordcloud.to_image().save(img_buffer, format="PNG")
+    return img_buffer.getvalue()
+
+
+# ワーカープロセス起動時に1度だけ呼ばれる初期化関数
+# フォントとトークナイザーを先に読み込んでおき、最初のリクエストが遅くならないようにする
+def init_worker(font_path):
+    global _font_path
+    _font_path = font_path
+    get_tokenizer()
+    # 小さな画像を1枚描画して、フォントと描画ライブラリを読み込んでおく
+    WordCloud(width=32, height=32, font_path=font_path).generate_from_frequencies({"warmup": 1})